@@ -0,0 +1,171 @@
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import state_spaces
+from reward_engine import reward_frame_features
+
+# action keys of create_distinct_action_mapping
+direction_keys = {0, 1, 2, 3}
+button_keys = {4, 5, 6, 7, 8, 9}
+parry_keys = {5, 8}  # drive parry, with forward drive rush
+impact_keys = {6, 9}  # drive impact, drive reversal in blockstun
+ex_keys = [{4, 5}, {7, 9}]
+
+drive_bar = 10000
+# drive levels: 0 empty, 1 less than a bar, 2 less than two bars, 3 two bars or more
+drive_levels = 4
+# frame state bits of player 0
+AIR, HITSTUN, BLOCKSTUN, ACTIVE = 1, 2, 4, 8
+state_bit_count = 16
+
+# act_st names where player 0 can not act, is in the air or is in a move that is only ended by its frames
+locked_states = {'DAMAGE', 'PIYO', 'SLEEP', 'CATCH', 'FLYING', 'UKEMI', 'SJUMP_DMG', 'GETUP', 'NOKI', 'WIN'}
+blocking_states = {'DEF', 'JDEF'}
+air_states = {'JUMP', 'JUMP_NORM', 'JUMP_RET', 'SJUMP', 'SJUMP_NORM', 'SJUMP_RET', 'WJUMP', 'WSJUMP', 'TJUMP',
+              'FALL', 'JDEF'}
+attack_states = {'ATCK', 'ATCK_LAND', 'SPECIAL', 'SUPER', 'PARRY'}
+mask_frame_features = ['act_st', 'posY', 'hitstun', 'blockstun', 'mActionFrame', 'mEndFrame', 'drive']
+
+
+def load_act_st_names(data_path: str = None) -> Dict[str, str]:
+    # act_st value -> name
+    with open(os.path.join(state_spaces.default_data_path if data_path is None else data_path, "act_st.json")) as f:
+        return json.load(f)
+
+
+def create_action_rule_masks(action_mapping: List[Tuple[int, ...]]) -> Dict[str, np.ndarray]:
+    # actions grouped by what they need, computed once from the keys of every action
+    keys = [set(action) for action in action_mapping]
+    return {
+        "neutral": np.array([len(k) == 0 for k in keys]),
+        "parry": np.array([parry_keys <= k for k in keys]),
+        "impact": np.array([impact_keys <= k for k in keys]),
+        "ex": np.array([any(ex <= k for ex in ex_keys) for k in keys]),
+        # single buttons without a direction, the only inputs that change an air action
+        "air": np.array([len(k) == 0 or (len(k) == 1 and k <= button_keys) for k in keys]),
+    }
+
+
+def allowed_actions(rules: Dict[str, np.ndarray], act_st_name: str, state_bits: int, drive_level: int) -> np.ndarray:
+    # actions that change the game in this state, the neutral action is always allowed
+    allowed = np.ones(len(rules["neutral"]), dtype=bool)
+    if drive_level < 1:
+        allowed &= ~rules["parry"]
+    if drive_level < 2:
+        allowed &= ~rules["impact"]
+    if drive_level < 3:
+        allowed &= ~rules["ex"]
+
+    if state_bits & HITSTUN or act_st_name in locked_states:
+        allowed &= rules["neutral"]
+    elif state_bits & BLOCKSTUN or act_st_name in blocking_states:
+        # drive reversal costs two bars
+        allowed &= rules["neutral"] | (rules["impact"] if drive_level >= 3 else False)
+    elif state_bits & ACTIVE and act_st_name in attack_states:
+        # drive rush cancels
+        allowed &= rules["neutral"] | (rules["parry"] if drive_level >= 2 else False)
+    elif state_bits & AIR or act_st_name in air_states:
+        allowed &= rules["air"]
+
+    if not allowed.any():
+        allowed[:] = True
+    return allowed | rules["neutral"]
+
+
+class ActionMaskTable:
+    # valid actions of player 0 for MaskablePPO, precomputed for every act_st, drive level and state bits
+    # so a mask is one table lookup, rules follow the keys of create_distinct_action_mapping
+    def __init__(self, action_mapping: List[Tuple[int, ...]], game_env_format: List[str] = None,
+                 data_path: str = None):
+        self.action_count = len(action_mapping)
+        act_st_names = load_act_st_names(data_path)
+        # act_st value -> row, the last row is for values missing from act_st.json
+        self.act_st_rows = {value: row for row, value in enumerate(act_st_names)}
+        self.unknown_act_st_row = len(act_st_names)
+        names = list(act_st_names.values()) + ['NONE']
+
+        rules = create_action_rule_masks(action_mapping)
+        self.table = np.zeros((len(names), drive_levels, state_bit_count, self.action_count), dtype=bool)
+        for row, name in enumerate(names):
+            for drive_level in range(drive_levels):
+                for state_bits in range(state_bit_count):
+                    self.table[row, drive_level, state_bits] = allowed_actions(rules, name, state_bits, drive_level)
+        self.table.setflags(write=False)
+
+        # dense act_st value -> row lookup used by the batch api
+        values = np.array([int(value) for value in act_st_names], dtype=np.int64)
+        self.act_st_min = int(values.min())
+        self.act_st_lookup = np.full(values.max() - values.min() + 1, self.unknown_act_st_row, dtype=np.int64)
+        self.act_st_lookup[values - self.act_st_min] = np.arange(len(values))
+
+        self.columns = None
+        if game_env_format is not None:
+            self.columns = [1 + game_env_format.index(feature) for feature in mask_frame_features]
+
+    def mask(self, game_state: List[str]) -> np.ndarray:
+        # mask of a raw frame row, a read only row of the table
+        act_st, pos_y, hitstun, blockstun, action_frame, end_frame, drive = \
+            [game_state[column] for column in self.columns]
+        row = self.act_st_rows.get(act_st, self.unknown_act_st_row)
+        drive = float(drive)
+        drive_level = 0 if drive <= 0 else 1 if drive < drive_bar else 2 if drive < 2 * drive_bar else 3
+        state_bits = ((AIR if float(pos_y) > 0 else 0) | (HITSTUN if float(hitstun) > 0 else 0) |
+                      (BLOCKSTUN if float(blockstun) > 0 else 0) |
+                      (ACTIVE if float(action_frame) < float(end_frame) else 0))
+        return self.table[row, drive_level, state_bits]
+
+    def masks(self, act_st: np.ndarray, pos_y: np.ndarray, hitstun: np.ndarray = None, blockstun: np.ndarray = None,
+              action_frame: np.ndarray = None, end_frame: np.ndarray = None, drive: np.ndarray = None) -> np.ndarray:
+        # (N, actions) masks of N frames from the raw values, missing (None or nan) values count as 0, without
+        # end_frame every attack act_st counts as an active move
+        act_st = np.asarray(act_st, dtype=np.int64)
+        count = len(act_st)
+
+        def values(array):
+            if array is None:
+                return np.zeros(count)
+            return np.nan_to_num(np.asarray(array, dtype=np.float64).reshape(count))
+
+        index = act_st - self.act_st_min
+        in_table = (index >= 0) & (index < len(self.act_st_lookup))
+        rows = np.full(count, self.unknown_act_st_row, dtype=np.int64)
+        rows[in_table] = self.act_st_lookup[index[in_table]]
+
+        drive = values(drive)
+        drive_level = np.where(drive <= 0, 0, np.where(drive < drive_bar, 1, np.where(drive < 2 * drive_bar, 2, 3)))
+
+        state_bits = (AIR * (values(pos_y) > 0) | HITSTUN * (values(hitstun) > 0) |
+                      BLOCKSTUN * (values(blockstun) > 0))
+        if end_frame is None:
+            state_bits |= ACTIVE
+        else:
+            state_bits |= ACTIVE * (values(action_frame) < values(end_frame))
+        return self.table[rows, drive_level, state_bits]
+
+    def masks_from_frames(self, frames: np.ndarray) -> np.ndarray:
+        # masks of (N, columns) parsed raw frame rows
+        frames = np.asarray(frames, dtype=np.float64)
+        return self.masks(*[frames[:, column] for column in self.columns])
+
+    def masks_from_columns(self, columns: Dict[str, np.ndarray], act_st_mapping: Dict[str, int] = None) -> np.ndarray:
+        # masks of recorded episodes from the columns of an EpisodeDataset or recorder chunk, act_st is decoded
+        # from its one hot or index observation, hitstun and blockstun come from frame_values when recorded
+        act_st_values = np.array([int(value) for value in (state_spaces.load_act_st() if act_st_mapping is None
+                                                           else act_st_mapping)], dtype=np.int64)
+        act_st = np.asarray(columns['obs/0_act_st'])
+        if act_st.shape[1] == 1:
+            slots = act_st[:, 0].astype(np.int64)
+        else:
+            slots = np.where(act_st.any(axis=1), np.argmax(act_st, axis=1), len(act_st_values))
+        act_st = np.append(act_st_values, -2)[np.minimum(slots, len(act_st_values))]  # -2 is no act_st value
+
+        hitstun = blockstun = None
+        if 'frame_values' in columns:
+            frame_values = np.asarray(columns['frame_values'])
+            hitstun = frame_values[:, 0, reward_frame_features.index('hitstun')]
+            blockstun = frame_values[:, 0, reward_frame_features.index('blockstun')]
+        return self.masks(act_st, columns['obs/0_posY'], hitstun=hitstun, blockstun=blockstun,
+                          drive=columns['obs/0_drive'])
@@ -1,4 +1,7 @@
 from itertools import product
+from typing import List, Tuple
+
+import numpy as np
 
 
 def create_distinct_action_mapping():
@@ -68,3 +71,31 @@ def create_modern_luke_action_mapping():
     # total_actions = throw_di + normal_inputs
 
     return total_actions
+
+
+class ActionTable:
+    # compiles an action mapping once so a step only indexes precomputed rows
+    # key_matrix[action] are the pressed keys, one_hot[action] the prev_action observation and
+    # action_lines[action] the pre-encoded ",<keys>,0" tail of the action buffer line, only the frame is prepended
+    # key_lines[action] are the ",<keys>" of player 1, appended after the reset column in two player lines
+    def __init__(self, action_mapping: List[Tuple[int, ...]], key_count: int):
+        self.action_mapping = action_mapping
+        self.action_count = len(action_mapping)
+        self.key_count = key_count
+
+        self.key_matrix = np.zeros((self.action_count, key_count), dtype=np.int8)
+        for action, keys in enumerate(action_mapping):
+            for key in keys:
+                if not 0 <= key < key_count:
+                    raise ValueError(f"Invalid key:{key} in action:{action}, expected 0 to {key_count - 1}.")
+                self.key_matrix[action, key] = 1
+
+        self.one_hot = np.eye(self.action_count, dtype=np.int8)
+        self.no_action = np.zeros(self.action_count, dtype=np.int8)
+        # rows are shared between steps
+        self.key_matrix.setflags(write=False)
+        self.one_hot.setflags(write=False)
+        self.no_action.setflags(write=False)
+
+        self.key_lines = [''.join(f",{key}" for key in row) for row in self.key_matrix.tolist()]
+        self.action_lines = [key_line + ",0" for key_line in self.key_lines]
@@ -0,0 +1,215 @@
+import argparse
+import os
+import zlib
+from typing import Iterator, List
+
+import numpy as np
+
+# fixed width binary frame record generated from game_env.format
+# header: version, flags, schema hash, frame number followed by one struct per player in format order
+BINARY_FRAME_VERSION = 1
+
+# every other feature is stored as int32
+float_features = {
+    'posX',
+    'posY',
+    'spdX',
+    'spdY',
+    'aclX',
+    'aclY',
+    'pushback',
+    'absolute_range',
+    'relative_range',
+}
+
+frame_header_dtype = np.dtype([
+    ('version', '<u2'),
+    ('flags', '<u2'),
+    ('schema_hash', '<u4'),
+    ('frame', '<i8'),
+])
+
+
+def create_player_dtype(game_env_format: List[str]) -> np.dtype:
+    return np.dtype([(name, '<f4' if name in float_features else '<i4') for name in game_env_format])
+
+
+frame_dtypes = {}  # game env format -> (frame dtype, schema hash)
+
+
+def compile_frame_format(game_env_format: List[str]):
+    key = tuple(game_env_format)
+    if key not in frame_dtypes:
+        player_dtype = create_player_dtype(game_env_format)
+        frame_dtype = np.dtype([
+            ('header', frame_header_dtype),
+            ('players', player_dtype, (2,)),
+        ])
+        schema = ",".join(f"{name}:{player_dtype[name].str}" for name in game_env_format)
+        frame_dtypes[key] = (frame_dtype, zlib.crc32(f"{BINARY_FRAME_VERSION};{schema}".encode()))
+    return frame_dtypes[key]
+
+
+def create_frame_dtype(game_env_format: List[str]) -> np.dtype:
+    return compile_frame_format(game_env_format)[0]
+
+
+def create_schema_hash(game_env_format: List[str]) -> int:
+    return compile_frame_format(game_env_format)[1]
+
+
+def check_schema(frames: np.ndarray, game_env_format: List[str]):
+    if len(frames) == 0:
+        return
+    expected_hash = create_schema_hash(game_env_format)
+    versions = frames['header']['version']
+    hashes = frames['header']['schema_hash']
+    if np.any(versions != BINARY_FRAME_VERSION):
+        raise ValueError(
+            f"Unsupported binary frame version expected={BINARY_FRAME_VERSION} actual={np.unique(versions).tolist()}")
+    if np.any(hashes != expected_hash):
+        raise ValueError(
+            f"Binary frames were written with a different game_env.format "
+            f"expected={expected_hash:#010x} actual={[f'{h:#010x}' for h in np.unique(hashes)]}")
+
+
+def decode_frames(buffer, game_env_format: List[str], check: bool = True) -> np.ndarray:
+    # zero copy view of the buffer as frame records
+    frames = np.frombuffer(buffer, dtype=create_frame_dtype(game_env_format))
+    if check:
+        check_schema(frames, game_env_format)
+    return frames
+
+
+def rows_to_frames(rows: List[List[str]], game_env_format: List[str]) -> np.ndarray:
+    # rows are split csv frames as read from game_env_buffer.buf
+    frames = np.zeros(len(rows), dtype=create_frame_dtype(game_env_format))
+    if len(rows) == 0:
+        return frames
+
+    values = np.asarray(rows, dtype=np.float64)
+    frames['header']['version'] = BINARY_FRAME_VERSION
+    frames['header']['schema_hash'] = create_schema_hash(game_env_format)
+    frames['header']['frame'] = values[:, 0]
+
+    player_values = values[:, 1:1 + 2 * len(game_env_format)].reshape(len(rows), 2, len(game_env_format))
+    for i, name in enumerate(game_env_format):
+        frames['players'][name] = player_values[:, :, i]
+
+    return frames
+
+
+def encode_frames(rows: List[List[str]], game_env_format: List[str]) -> bytes:
+    return rows_to_frames(rows, game_env_format).tobytes()
+
+
+def frames_to_columns(frames: np.ndarray, game_env_format: List[str]) -> np.ndarray:
+    # (N, 1 + 2 * features) array in the csv column order, accepted by ObservationEncoder.encode_batch
+    columns = np.empty((len(frames), 1 + 2 * len(game_env_format)), dtype=np.float64)
+    columns[:, 0] = frames['header']['frame']
+    for i, name in enumerate(game_env_format):
+        columns[:, 1 + i] = frames['players'][name][:, 0]
+        columns[:, 1 + len(game_env_format) + i] = frames['players'][name][:, 1]
+    return columns
+
+
+def read_csv_capture(csv_path: str, game_env_format: List[str], stats: dict = None) -> Iterator[List[str]]:
+    # valid split rows of a capture of csv frames, one per line
+    # torn rows with the wrong number of values are skipped, a trailing reset ack column is dropped
+    expected_length = (len(game_env_format) * 2) + 1
+    stats = {} if stats is None else stats
+    stats.setdefault('skipped', 0)
+    with open(csv_path, 'r') as f:
+        for line in f:
+            row = line.strip().split(",")
+            if len(row) == expected_length + 1:
+                row = row[:expected_length]
+            if len(row) != expected_length:
+                stats['skipped'] += 1
+                continue
+            try:
+                [float(value) for value in row]
+            except ValueError:
+                stats['skipped'] += 1
+                continue
+            yield row
+
+
+def convert_csv_capture(csv_path: str, binary_path: str, game_env_format: List[str], chunk_size: int = 4096) -> dict:
+    # converts a capture of csv frames to binary frame records
+    written = 0
+    stats = {}
+    chunk = []
+    with open(binary_path, 'wb') as out:
+        for row in read_csv_capture(csv_path, game_env_format, stats):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                out.write(encode_frames(chunk, game_env_format))
+                written += len(chunk)
+                chunk = []
+        if chunk:
+            out.write(encode_frames(chunk, game_env_format))
+            written += len(chunk)
+
+    return {"written": written, "skipped": stats['skipped']}
+
+
+class FrameCaptureWriter:
+    # writes the raw frames an env reads as binary frame records, one <episode id>.bin file per episode
+    # frames are encoded in batches of buffer_frames so a frame only costs a list append
+    # the episode is written to <episode id>.bin.part and renamed when it ends, readers only pick up ended episodes
+    def __init__(self, path: str, game_env_format: List[str], buffer_frames: int = 256):
+        self.path = path
+        self.game_env_format = game_env_format
+        self.row_length = (len(game_env_format) * 2) + 1
+        self.buffer_frames = buffer_frames
+        os.makedirs(path, exist_ok=True)
+        self.rows = []
+        self.file = None
+        self.episode_path = None
+
+    def start_episode(self, episode_id: str):
+        self.end_episode()
+        self.episode_path = os.path.join(self.path, f"{episode_id}.bin")
+        self.file = open(f"{self.episode_path}.part", 'wb')
+
+    def write(self, row: List[str]):
+        self.rows.append(row[:self.row_length])  # without the reset ack column
+        if len(self.rows) >= self.buffer_frames:
+            self.flush()
+
+    def flush(self):
+        if self.file is not None and self.rows:
+            self.file.write(encode_frames(self.rows, self.game_env_format))
+            self.file.flush()
+        self.rows = []
+
+    def end_episode(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+            os.replace(f"{self.episode_path}.part", self.episode_path)
+
+    def close(self):
+        self.end_episode()
+
+
+def load_binary_capture(binary_path: str, game_env_format: List[str], check: bool = True) -> np.ndarray:
+    frames = np.memmap(binary_path, dtype=create_frame_dtype(game_env_format), mode='r')
+    if check:
+        check_schema(frames, game_env_format)
+    return frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a csv frame capture to binary frame records.")
+    parser.add_argument('csv_path')
+    parser.add_argument('binary_path')
+    parser.add_argument('--format', default="env/game_env.format", help="game_env.format the capture was written with")
+    args = parser.parse_args()
+
+    with open(args.format, 'r') as format_file:
+        capture_format = format_file.readline().strip().split(",")
+
+    print(convert_csv_capture(args.csv_path, args.binary_path, capture_format))
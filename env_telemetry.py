@@ -0,0 +1,158 @@
+import bisect
+import time
+from typing import Dict, List
+
+import numpy as np
+
+# latency buckets from 1us to 1s, the last bucket holds everything slower
+latency_bucket_edges = np.geomspace(1e-6, 1.0, 61).tolist()
+telemetry_counters = ['frames', 'dropped_frames', 'duplicate_frames', 'invalid_frames', 'torn_reads']
+
+
+class LatencyHistogram:
+    # fixed log spaced buckets so histograms of several envs and processes can be summed
+    def __init__(self):
+        self.counts = [0] * (len(latency_bucket_edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect.bisect_right(latency_bucket_edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self) -> dict:
+        return {"counts": list(self.counts), "count": self.count, "total": self.total, "max": self.max}
+
+    def clear(self):
+        self.counts = [0] * (len(latency_bucket_edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+def histogram_percentile(counts: np.ndarray, q: float) -> float:
+    # upper edge of the bucket holding the q-th percentile
+    rank = np.searchsorted(np.cumsum(counts), q / 100.0 * counts.sum())
+    return latency_bucket_edges[min(rank, len(latency_bucket_edges) - 1)]
+
+
+class EnvTelemetry:
+    # counts frame gaps and keeps rolling latency histograms of every step phase of an SF6AgentEnv
+    # the env and game state methods are wrapped by attach, an env without telemetry runs unchanged
+    # histograms cover the time since the last snapshot, counters are totals
+    def __init__(self):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.frames = 0
+        self.dropped_frames = 0
+        self.duplicate_frames = 0
+        self.last_frame = None
+        self.game_env_state = None
+
+    def wrap(self, obj, method_name: str, phase: str):
+        method = getattr(obj, method_name)
+        histogram = self.histograms.setdefault(phase, LatencyHistogram())
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            result = method(*args, **kwargs)
+            histogram.add(perf_counter() - start)
+            return result
+
+        setattr(obj, method_name, timed)
+
+    def wrap_frame_wait(self, game_env_state):
+        method = game_env_state.wait_for_game_env_update
+        histogram = self.histograms.setdefault('wait_for_game_env_update', LatencyHistogram())
+        perf_counter = time.perf_counter
+
+        def wait_for_game_env_update(*args, **kwargs):
+            start = perf_counter()
+            updated = method(*args, **kwargs)
+            histogram.add(perf_counter() - start)
+            if updated:
+                self.count_frame(int(game_env_state.current_game_env_frame))
+            return updated
+
+        game_env_state.wait_for_game_env_update = wait_for_game_env_update
+
+    def count_frame(self, frame: int):
+        # the game writes every frame number once, gaps are frames the agent never saw
+        if self.last_frame is not None:
+            gap = frame - self.last_frame
+            if gap > 1:
+                self.dropped_frames += gap - 1
+            elif gap <= 0:
+                self.duplicate_frames += 1
+        self.last_frame = frame
+        self.frames += 1
+
+    def attach(self, env):
+        game_env_state = env.game_env_state
+        self.game_env_state = game_env_state
+        self.wrap_frame_wait(game_env_state)
+        self.wrap(game_env_state, 'send_action_line', 'send_action_line')
+        self.wrap(game_env_state, 'get_current_game_state', 'get_current_game_state')
+        self.wrap(game_env_state, 'get_current_game_state_flat', 'get_current_game_state')
+        self.wrap(game_env_state, 'send_reset', 'reset')
+        self.wrap(env, '_calc_reward', '_calc_reward')
+        if env.recorder is not None:
+            self.wrap(env.recorder, 'record', 'history')
+        self.wrap(env, 'step', 'step')
+
+    def snapshot(self, clear: bool = True) -> dict:
+        # plain python values so snapshots can be sent from SubprocVecEnv workers
+        snapshot = {
+            "counters": {
+                "frames": self.frames,
+                "dropped_frames": self.dropped_frames,
+                "duplicate_frames": self.duplicate_frames,
+                "invalid_frames": self.game_env_state.invalid_frames if self.game_env_state is not None else 0,
+                "torn_reads": self.game_env_state.game_env_transport.torn_reads
+                if self.game_env_state is not None else 0,
+            },
+            "histograms": {phase: histogram.snapshot() for phase, histogram in self.histograms.items()},
+        }
+        if clear:
+            for histogram in self.histograms.values():
+                histogram.clear()
+        return snapshot
+
+
+def summarize_telemetry(snapshots: List[dict]) -> Dict[str, float]:
+    # merges the snapshots of several envs into flat scalars
+    summary = {name: float(sum(snapshot['counters'][name] for snapshot in snapshots)) for name in telemetry_counters}
+
+    phases = {}
+    for snapshot in snapshots:
+        for phase, histogram in snapshot['histograms'].items():
+            merged = phases.setdefault(phase, {"counts": np.zeros(len(latency_bucket_edges) + 1, dtype=np.int64),
+                                               "count": 0, "total": 0.0, "max": 0.0})
+            merged['counts'] += histogram['counts']
+            merged['count'] += histogram['count']
+            merged['total'] += histogram['total']
+            merged['max'] = max(merged['max'], histogram['max'])
+
+    for phase, merged in phases.items():
+        if merged['count'] == 0:
+            continue
+        summary[f"{phase}/count"] = float(merged['count'])
+        summary[f"{phase}/mean_us"] = merged['total'] / merged['count'] * 1e6
+        summary[f"{phase}/p50_us"] = histogram_percentile(merged['counts'], 50) * 1e6
+        summary[f"{phase}/p90_us"] = histogram_percentile(merged['counts'], 90) * 1e6
+        summary[f"{phase}/p99_us"] = histogram_percentile(merged['counts'], 99) * 1e6
+        summary[f"{phase}/max_us"] = merged['max'] * 1e6
+    return summary
+
+
+def publish_telemetry(summary: Dict[str, float], writer, step: int = None, prefix: str = "telemetry"):
+    # writer is a tensorboard SummaryWriter or a stable baselines3 logger
+    for name, value in summary.items():
+        if hasattr(writer, 'add_scalar'):
+            writer.add_scalar(f"{prefix}/{name}", value, step)
+        else:
+            writer.record(f"{prefix}/{name}", value)
@@ -0,0 +1,118 @@
+import json
+import struct
+import zlib
+from typing import Dict, Tuple
+
+import numpy as np
+
+# packed episode chunk: magic, version, header length, json header, zlib compressed column payload
+# the header holds the original dtype and shape of every column so chunks decode to the exact recorded layout
+codec_magic = b"SF6C"
+codec_version = 1
+codec_prefix = struct.Struct("<4sHI")
+packed_chunk_extension = ".sf6c"
+
+
+def encode_column(values: np.ndarray, float_dtype=None) -> Tuple[dict, np.ndarray]:
+    # 'index' one hot rows as the index of the set slot (the column width for all zero rows)
+    # 'bits' other 0/1 columns as np.packbits bitfields, 'raw' everything else in the smallest exact dtype
+    # floats are kept as they are unless float_dtype is given (float16 is lossy)
+    length = values.shape[0]
+    meta = {"dtype": values.dtype.str, "shape": list(values.shape[1:])}
+    flat = values.reshape(length, -1)
+    width = flat.shape[1]
+
+    is_binary = values.size > 0 and (values.dtype == np.bool_ or np.issubdtype(values.dtype, np.integer)) \
+        and bool(((flat == 0) | (flat == 1)).all())
+    if is_binary:
+        set_count = flat.sum(axis=1)
+        if width > 1 and bool((set_count <= 1).all()):
+            stored = np.argmax(flat, axis=1).astype(np.min_scalar_type(width))
+            stored[set_count == 0] = width
+            meta["kind"] = 'index'
+        else:
+            stored = np.packbits(flat.astype(np.bool_), axis=1)
+            meta["kind"] = 'bits'
+    elif values.size > 0 and np.issubdtype(values.dtype, np.integer):
+        stored_dtype = np.result_type(np.min_scalar_type(int(values.min())), np.min_scalar_type(int(values.max())))
+        stored = flat.astype(stored_dtype)
+        meta["kind"] = 'raw'
+    elif float_dtype is not None and np.issubdtype(values.dtype, np.floating):
+        stored = flat.astype(float_dtype)
+        meta["kind"] = 'raw'
+    else:
+        stored = flat
+        meta["kind"] = 'raw'
+
+    stored = np.ascontiguousarray(stored)
+    meta["stored_dtype"] = stored.dtype.str
+    meta["stored_shape"] = list(stored.shape)
+    return meta, stored
+
+
+def decode_column(meta: dict, stored: np.ndarray) -> np.ndarray:
+    dtype = np.dtype(meta["dtype"])
+    shape = tuple(meta["shape"])
+    length = stored.shape[0]
+    width = int(np.prod(shape, dtype=np.int64))
+
+    if meta["kind"] == 'index':
+        values = np.zeros((length, width), dtype=dtype)
+        rows = np.flatnonzero(stored < width)
+        values[rows, stored[rows]] = 1
+    elif meta["kind"] == 'bits':
+        values = np.unpackbits(stored, axis=1, count=width).astype(dtype)
+    else:
+        values = stored.astype(dtype)
+    return values.reshape((length,) + shape)
+
+
+def encode_chunk(chunk: Dict[str, np.ndarray], float_dtype=None, compress_level: int = 6) -> bytes:
+    columns = []
+    payload = []
+    offset = 0
+    for name, values in chunk.items():
+        meta, stored = encode_column(np.asarray(values), float_dtype=float_dtype)
+        meta["name"] = name
+        meta["offset"] = offset
+        columns.append(meta)
+        payload.append(stored.tobytes())
+        offset += stored.nbytes
+
+    header = json.dumps({"columns": columns, "compress_level": compress_level}).encode()
+    data = b"".join(payload)
+    if compress_level > 0:
+        data = zlib.compress(data, compress_level)
+    return codec_prefix.pack(codec_magic, codec_version, len(header)) + header + data
+
+
+def decode_chunk(data: bytes) -> Dict[str, np.ndarray]:
+    magic, version, header_length = codec_prefix.unpack_from(data)
+    if magic != codec_magic:
+        raise ValueError("Not a packed episode chunk.")
+    if version != codec_version:
+        raise ValueError(f"Unsupported packed episode chunk version {version}.")
+    header_end = codec_prefix.size + header_length
+    header = json.loads(data[codec_prefix.size:header_end])
+    payload = data[header_end:]
+    if header["compress_level"] > 0:
+        payload = zlib.decompress(payload)
+
+    chunk = {}
+    for meta in header["columns"]:
+        stored_dtype = np.dtype(meta["stored_dtype"])
+        stored_shape = tuple(meta["stored_shape"])
+        count = int(np.prod(stored_shape, dtype=np.int64))
+        stored = np.frombuffer(payload, dtype=stored_dtype, count=count, offset=meta["offset"]).reshape(stored_shape)
+        chunk[meta["name"]] = decode_column(meta, stored)
+    return chunk
+
+
+def write_packed_chunk(path: str, chunk: Dict[str, np.ndarray], float_dtype=None, compress_level: int = 6):
+    with open(path, 'wb') as f:
+        f.write(encode_chunk(chunk, float_dtype=float_dtype, compress_level=compress_level))
+
+
+def read_packed_chunk(path: str) -> Dict[str, np.ndarray]:
+    with open(path, 'rb') as f:
+        return decode_chunk(f.read())
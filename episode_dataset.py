@@ -0,0 +1,313 @@
+import argparse
+import glob
+import json
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from gymnasium import spaces
+
+from episode_codec import packed_chunk_extension, read_packed_chunk
+from episode_recorder import episode_open_marker
+from reward_engine import reward_frame_features
+
+# a dataset directory holds one raw binary file per column, rows of every episode are appended back to back
+# meta.json describes the columns and sources already converted, episodes.npy holds (start row, length) per episode
+# derived_columns in meta.json are reward columns added by reward_engine.relabel_dataset, not recorded columns
+dataset_meta_file = "meta.json"
+dataset_episodes_file = "episodes.npy"
+recorded_columns = {
+    'action': (np.int32, ()),
+    'reward': (np.float32, ()),
+    'frame': (np.int64, ()),
+    'frame_values': (np.float32, (2, len(reward_frame_features))),
+}
+# reward features that are also observations, episodes recorded without frame values are filled from them
+observed_reward_features = ['current_HP', 'drive', 'super', 'posX']
+
+
+def column_file_name(column: str) -> str:
+    return f"{column.replace('/', '.')}.bin"
+
+
+def create_dataset_columns(observation_space: spaces.Dict) -> Dict[str, Tuple[np.dtype, tuple]]:
+    columns = {f"obs/{key}": (space.dtype, space.shape) for key, space in observation_space.spaces.items()}
+    columns.update(recorded_columns)
+    return columns
+
+
+def frame_values_from_observations(chunk: Dict[str, np.ndarray]) -> np.ndarray:
+    # features that are not observed (hitstun and blockstun) are nan
+    length = len(chunk['action'])
+    frame_values = np.full((length, 2, len(reward_frame_features)), np.nan, dtype=np.float32)
+    for player_id in [0, 1]:
+        for feature in observed_reward_features:
+            key = f"obs/{player_id}_{feature}"
+            if key in chunk:
+                frame_values[:, player_id, reward_frame_features.index(feature)] = chunk[key].reshape(length)
+    return frame_values
+
+
+def find_chunks(episode_path: str) -> List[str]:
+    # npz and packed chunks written by EpisodeRecorder
+    return sorted(glob.glob(os.path.join(episode_path, "chunk_*.npz")) +
+                  glob.glob(os.path.join(episode_path, f"chunk_*{packed_chunk_extension}")))
+
+
+def read_recorded_episode(episode_path: str) -> Iterable[Dict[str, np.ndarray]]:
+    for chunk_path in find_chunks(episode_path):
+        if chunk_path.endswith(packed_chunk_extension):
+            chunk = read_packed_chunk(chunk_path)
+        else:
+            with np.load(chunk_path) as chunk:
+                chunk = {key: chunk[key] for key in chunk.files}
+        if 'frame_values' not in chunk:
+            chunk['frame_values'] = frame_values_from_observations(chunk)
+        yield chunk
+
+
+def read_json_episode(json_path: str, observation_space: spaces.Dict) -> Iterable[Dict[str, np.ndarray]]:
+    # history files written by the json dump of older SF6AgentEnv versions
+    # observation i + 1 follows action i, rewards are rebuilt from the hp difference as in _calc_reward
+    with open(json_path, 'r') as f:
+        history = json.load(f)
+
+    observations = history['observations']
+    actions = history['actions']
+    length = min(len(observations), len(actions) + 1)
+    if length == 0:
+        return
+
+    chunk = {
+        f"obs/{key}": np.asarray([observation[key] for observation in observations[:length]], dtype=space.dtype)
+        .reshape((length,) + space.shape)
+        for key, space in observation_space.spaces.items()
+    }
+    chunk['action'] = np.full(length, -1, dtype=np.int32)
+    if length > 1:
+        chunk['action'][1:] = np.argmax(np.asarray(actions[:length - 1]), axis=1)
+
+    hp_0 = chunk['obs/0_current_HP'][:, 0].astype(np.float32)
+    hp_1 = chunk['obs/1_current_HP'][:, 0].astype(np.float32)
+    chunk['reward'] = np.zeros(length, dtype=np.float32)
+    chunk['reward'][1:] = np.diff(hp_0) - np.diff(hp_1)
+    chunk['frame'] = np.full(length, -1, dtype=np.int64)
+    chunk['frame_values'] = frame_values_from_observations(chunk)
+    yield chunk
+
+
+def is_recorded_episode(episode_path: str) -> bool:
+    # episodes a recorder is still writing are left for a later build
+    return bool(find_chunks(episode_path)) and not os.path.exists(os.path.join(episode_path, episode_open_marker))
+
+
+def find_sources(source_paths: List[str]) -> List[str]:
+    # recorder episode directories and json history files
+    sources = []
+    for source_path in source_paths:
+        if source_path.endswith('.json') or is_recorded_episode(source_path):
+            sources.append(source_path)
+        elif os.path.isdir(source_path) and not find_chunks(source_path):
+            for entry in sorted(os.listdir(source_path)):
+                entry_path = os.path.join(source_path, entry)
+                if entry.endswith('.json') or is_recorded_episode(entry_path):
+                    sources.append(entry_path)
+    return sources
+
+
+def describe_columns(columns: Dict[str, Tuple[np.dtype, tuple]]) -> Dict[str, dict]:
+    return {name: {"dtype": np.dtype(dtype).str, "shape": list(shape)} for name, (dtype, shape) in columns.items()}
+
+
+def build_dataset(source_paths: List[str], dataset_path: str, observation_space: spaces.Dict,
+                  categorical_encoding: str = 'one_hot') -> dict:
+    # converts recorded episodes once into the memory mapped format, sources converted before are skipped
+    # categorical_encoding is the encoding the episodes were recorded with, see SF6AgentEnv
+    # episodes are streamed chunk by chunk so memory does not grow with the dataset
+    # meta.json only counts complete episodes, rows past meta['length'] left by a failed build are truncated
+    os.makedirs(dataset_path, exist_ok=True)
+    columns = create_dataset_columns(observation_space)
+
+    meta_path = os.path.join(dataset_path, dataset_meta_file)
+    episodes_path = os.path.join(dataset_path, dataset_episodes_file)
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['columns'] != describe_columns(columns):
+            raise ValueError(f"Dataset {dataset_path} was built for a different observation space or by an older "
+                             f"version, build it into a new directory.")
+        if meta.get('categorical_encoding', 'one_hot') != categorical_encoding:
+            raise ValueError(f"Dataset {dataset_path} was built with categorical_encoding="
+                             f"{meta.get('categorical_encoding', 'one_hot')}, got {categorical_encoding}.")
+        episodes = [tuple(episode) for episode in np.load(episodes_path).tolist()]
+    else:
+        meta = {
+            "columns": describe_columns(columns),
+            "categorical_encoding": categorical_encoding,
+            "length": 0,
+            "sources": [],
+        }
+        episodes = []
+
+    first_row = meta['length']
+    converted = set(meta['sources'])
+    added = 0
+    files = {}
+    for name, (dtype, shape) in columns.items():
+        files[name] = open(os.path.join(dataset_path, column_file_name(name)), 'ab')
+        files[name].truncate(meta['length'] * np.dtype(dtype).itemsize * int(np.prod(shape)))
+    try:
+        for source in find_sources(source_paths):
+            source_key = os.path.abspath(source)
+            if source_key in converted:
+                continue
+
+            if source.endswith('.json'):
+                chunks = read_json_episode(source, observation_space)
+            else:
+                chunks = read_recorded_episode(source)
+
+            start = meta['length']
+            length = 0
+            for chunk in chunks:
+                chunk_length = len(chunk['action'])
+                for name, (dtype, shape) in columns.items():
+                    if chunk[name].shape[1:] != shape or chunk[name].dtype != dtype:
+                        raise ValueError(f"Episode {source} was recorded with a different observation space, {name} "
+                                         f"is {chunk[name].dtype}{chunk[name].shape[1:]} instead of "
+                                         f"{np.dtype(dtype)}{shape}.")
+                    files[name].write(np.ascontiguousarray(chunk[name]).tobytes())
+                length += chunk_length
+
+            # the episode only counts once every chunk of it was written
+            meta['length'] += length
+            if length > 0:
+                episodes.append((start, length))
+                added += 1
+            meta['sources'].append(source_key)
+            converted.add(source_key)
+    finally:
+        # the episodes converted before a failing source are kept
+        for name, (dtype, shape) in columns.items():
+            files[name].truncate(meta['length'] * np.dtype(dtype).itemsize * int(np.prod(shape)))
+            files[name].close()
+        relabel_added_rows(dataset_path, meta, np.asarray(episodes, dtype=np.int64).reshape(-1, 2), first_row)
+        np.save(episodes_path, np.asarray(episodes, dtype=np.int64).reshape(-1, 2))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    return {"episodes_added": added, "episodes": len(episodes), "length": meta['length']}
+
+
+def relabel_added_rows(dataset_path: str, meta: dict, episodes: np.ndarray, first_row: int):
+    # columns relabeled by reward_engine.relabel_dataset get the rewards of the rows added by a build
+    from reward_engine import RewardEngine, relabel_rewards
+
+    added_episodes = episodes[episodes[:, 0] >= first_row] - [first_row, 0]
+    if not meta.get('reward_weights') or len(added_episodes) == 0:
+        return
+    frame_values_column = meta['columns']['frame_values']
+    frame_values = np.memmap(os.path.join(dataset_path, column_file_name('frame_values')),
+                             dtype=frame_values_column['dtype'], mode='r',
+                             shape=(meta['length'],) + tuple(frame_values_column['shape']))
+    for column, weights in meta['reward_weights'].items():
+        column_path = os.path.join(dataset_path, column_file_name(column))
+        with open(column_path, 'ab') as f:
+            f.truncate(meta['length'] * np.dtype(np.float32).itemsize)
+        rewards = np.memmap(column_path, dtype=np.float32, mode='r+', shape=(meta['length'],))
+        relabel_rewards(frame_values[first_row:], added_episodes, RewardEngine(weights), out=rewards[first_row:])
+        rewards.flush()
+
+
+class EpisodeDataset:
+    # memory mapped view of a dataset built by build_dataset, nothing is loaded into memory up front
+    def __init__(self, dataset_path: str):
+        self.dataset_path = dataset_path
+        with open(os.path.join(dataset_path, dataset_meta_file), 'r') as f:
+            self.meta = json.load(f)
+
+        self.length = self.meta['length']
+        self.episodes = np.load(os.path.join(dataset_path, dataset_episodes_file))
+        self.columns = {}
+        for name, column in {**self.meta['columns'], **self.meta.get('derived_columns', {})}.items():
+            shape = (self.length,) + tuple(column['shape'])
+            if self.length == 0:
+                self.columns[name] = np.zeros(shape, dtype=column['dtype'])
+            else:
+                self.columns[name] = np.memmap(os.path.join(dataset_path, column_file_name(name)),
+                                               dtype=column['dtype'], mode='r', shape=shape)
+        self.observation_keys = [name[len("obs/"):] for name in self.columns if name.startswith("obs/")]
+
+        # transitions of an episode are its rows except the last one
+        self.episode_transitions = np.maximum(self.episodes[:, 1] - 1, 0) if len(self.episodes) else np.zeros(0, np.int64)
+        self.transition_offsets = np.cumsum(self.episode_transitions) - self.episode_transitions
+        self.transition_count = int(self.episode_transitions.sum())
+
+    def __len__(self) -> int:
+        return self.length
+
+    def get_observation(self, row) -> Dict[str, np.ndarray]:
+        return {key: self.columns[f"obs/{key}"][row] for key in self.observation_keys}
+
+    def locate(self, transition_index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # transition index -> (episode, offset in episode)
+        episode = np.searchsorted(self.transition_offsets, transition_index, side='right') - 1
+        return episode, transition_index - self.transition_offsets[episode]
+
+    def get_transitions(self, transition_index: np.ndarray) -> Dict[str, np.ndarray]:
+        transition_index = np.asarray(transition_index, dtype=np.int64)
+        episode, offset = self.locate(transition_index)
+        rows = self.episodes[episode, 0] + offset
+        # rows are sorted before indexing so the memory map is read front to back
+        order = np.argsort(rows)
+        sorted_rows = rows[order]
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+
+        def gather(name, gather_rows):
+            return np.asarray(self.columns[name][gather_rows])[inverse]
+
+        return {
+            "observations": {key: gather(f"obs/{key}", sorted_rows) for key in self.observation_keys},
+            "actions": gather('action', sorted_rows + 1),
+            "rewards": gather('reward', sorted_rows + 1),
+            "next_observations": {key: gather(f"obs/{key}", sorted_rows + 1) for key in self.observation_keys},
+            "dones": (offset + 1 == self.episode_transitions[episode]),
+            "episodes": episode,
+            "offsets": offset,
+        }
+
+    def sample(self, batch_size: int, rng: np.random.Generator = None) -> Dict[str, np.ndarray]:
+        if self.transition_count == 0:
+            raise ValueError(f"Dataset {self.dataset_path} has no transitions.")
+        rng = np.random.default_rng() if rng is None else rng
+        return self.get_transitions(rng.integers(0, self.transition_count, size=batch_size))
+
+
+if __name__ == "__main__":
+    import action_spaces
+    from sf6_agent_env import agent_features, create_observation_space
+
+    action_mappings = {
+        'distinct': action_spaces.create_distinct_action_mapping,
+        'modern_luke': action_spaces.create_modern_luke_action_mapping,
+    }
+
+    parser = argparse.ArgumentParser(description="Convert recorded episodes into a memory mapped dataset.")
+    parser.add_argument('dataset_path')
+    parser.add_argument('sources', nargs='+', help="history directories, episode directories or json history files")
+    parser.add_argument('--characters', nargs=2, default=['luke', 'luke'])
+    parser.add_argument('--action-mapping', choices=sorted(action_mappings.keys()), default='distinct')
+    parser.add_argument('--no-prev-action', action='store_true')
+    parser.add_argument('--categorical-encoding', choices=['one_hot', 'index'], default='one_hot',
+                        help="encoding the episodes were recorded with")
+    args = parser.parse_args()
+
+    space = create_observation_space(
+        characters=args.characters,
+        features=agent_features,
+        action_space_size=len(action_mappings[args.action_mapping]()),
+        keep_prev_action=not args.no_prev_action,
+        categorical_encoding=args.categorical_encoding,
+    )
+    print(build_dataset(args.sources, args.dataset_path, space, categorical_encoding=args.categorical_encoding))
@@ -0,0 +1,154 @@
+import os
+import queue
+import threading
+from datetime import datetime
+from typing import Dict
+
+import numpy as np
+from gymnasium import spaces
+
+from episode_codec import packed_chunk_extension, write_packed_chunk
+from reward_engine import reward_frame_features
+
+# present in an episode directory while its recorder is still writing it, build_dataset skips these episodes
+episode_open_marker = "recording"
+
+
+class EpisodeRecorder:
+    # records observations, actions, rewards, frame numbers and the raw reward features as columnar chunks
+    # full chunks are written by a background thread so recording never waits on disk,
+    # memory is bounded by the pool of max_pending_chunks + 1 chunk buffers
+    # episodes are written to <path>/<episode id>/chunk_<n>.npz with one array per column, with codec='packed'
+    # to chunk_<n>.sf6c with one hot columns as indices and binary columns as bitfields (see episode_codec)
+    def __init__(self, path: str, observation_space: spaces.Dict, chunk_size: int = 1024,
+                 max_pending_chunks: int = 8, compress: bool = True, codec: str = 'npz'):
+        self.path = path
+        self.observation_space = observation_space
+        self.chunk_size = chunk_size
+        self.compress = compress
+        if codec not in ('npz', 'packed'):
+            raise ValueError(f"Unknown history codec {codec}.")
+        self.codec = codec
+        self.chunk_extension = packed_chunk_extension if codec == 'packed' else ".npz"
+        os.makedirs(self.path, exist_ok=True)
+
+        self.free_chunks = queue.Queue()
+        for _ in range(max_pending_chunks + 1):
+            self.free_chunks.put(self.create_chunk())
+        self.pending_chunks = queue.Queue()
+
+        self.chunk = self.free_chunks.get()
+        self.chunk_length = 0
+        self.chunk_index = 0
+        self.episode_count = 0
+        self.episode_id = None
+        self.write_error = None
+
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def create_chunk(self) -> Dict[str, np.ndarray]:
+        chunk = {
+            f"obs/{key}": np.zeros((self.chunk_size,) + space.shape, dtype=space.dtype)
+            for key, space in self.observation_space.spaces.items()
+        }
+        chunk['action'] = np.zeros(self.chunk_size, dtype=np.int32)
+        chunk['reward'] = np.zeros(self.chunk_size, dtype=np.float32)
+        chunk['frame'] = np.zeros(self.chunk_size, dtype=np.int64)
+        # (player, feature) values of reward_frame_features, rewards can be relabeled from them later
+        chunk['frame_values'] = np.zeros((self.chunk_size, 2, len(reward_frame_features)), dtype=np.float32)
+        return chunk
+
+    def start_episode(self):
+        self.end_episode()
+        self.episode_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{self.episode_count:06d}"
+        self.episode_count += 1
+        self.chunk_index = 0
+        # written by the writer thread before the first chunk of the episode
+        self.pending_chunks.put((os.path.join(self.path, self.episode_id, episode_open_marker), None, 0))
+
+    def record(self, observation: Dict[str, np.ndarray], action: int, reward: float, frame,
+               frame_values: np.ndarray = None):
+        # action is -1 for the first observation of an episode, missing frame values are recorded as nan
+        if self.write_error is not None:
+            raise self.write_error
+        if self.episode_id is None:
+            self.start_episode()
+
+        i = self.chunk_length
+        for key, value in observation.items():
+            self.chunk[f"obs/{key}"][i] = value
+        self.chunk['action'][i] = action
+        self.chunk['reward'][i] = reward
+        self.chunk['frame'][i] = frame
+        self.chunk['frame_values'][i] = np.nan if frame_values is None else frame_values
+        self.chunk_length += 1
+
+        if self.chunk_length == self.chunk_size:
+            self.submit_chunk()
+
+    def submit_chunk(self):
+        if self.chunk_length == 0:
+            return
+        chunk_path = os.path.join(self.path, self.episode_id, f"chunk_{self.chunk_index:05d}{self.chunk_extension}")
+        self.pending_chunks.put((chunk_path, self.chunk, self.chunk_length))
+        self.chunk_index += 1
+        self.chunk = self.free_chunks.get()  # only waits when every chunk buffer is queued for writing
+        self.chunk_length = 0
+
+    def end_episode(self):
+        if self.episode_id is not None:
+            self.submit_chunk()
+            # removed by the writer thread after the last chunk of the episode
+            self.pending_chunks.put((os.path.join(self.path, self.episode_id, episode_open_marker), None, -1))
+            self.episode_id = None
+
+    def write_chunks(self):
+        while True:
+            item = self.pending_chunks.get()
+            if item is None:
+                self.pending_chunks.task_done()
+                return
+            chunk_path, chunk, length = item
+            if chunk is None:
+                # episode marker, length 0 creates and -1 removes it
+                try:
+                    if length == 0:
+                        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                        open(chunk_path, 'w').close()
+                    elif os.path.exists(chunk_path):
+                        os.remove(chunk_path)
+                except Exception as e:
+                    self.write_error = e
+                finally:
+                    self.pending_chunks.task_done()
+                continue
+            try:
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                columns = {key: value[:length] for key, value in chunk.items()}
+                if self.codec == 'packed':
+                    write_packed_chunk(chunk_path, columns, compress_level=6 if self.compress else 0)
+                else:
+                    save = np.savez_compressed if self.compress else np.savez
+                    save(chunk_path, **columns)
+            except Exception as e:
+                self.write_error = e
+            finally:
+                self.free_chunks.put(chunk)
+                self.pending_chunks.task_done()
+
+    def flush(self):
+        if self.episode_id is not None:
+            self.submit_chunk()
+        self.pending_chunks.join()
+        if self.write_error is not None:
+            raise self.write_error
+
+    def close(self):
+        if not self.writer.is_alive():
+            return
+        self.end_episode()
+        self.pending_chunks.put(None)
+        self.writer.join()
+        if self.write_error is not None:
+            raise self.write_error
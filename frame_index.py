@@ -0,0 +1,295 @@
+import argparse
+import glob
+import json
+import os
+from typing import Callable, Dict, List, Union
+
+import numpy as np
+
+import state_spaces
+from binary_frame_format import create_player_dtype, load_binary_capture, read_csv_capture, rows_to_frames
+
+# an index directory holds one raw column file per player feature of game_env.format (<player>_<feature>.bin)
+# and the frame numbers, rows of every episode are appended back to back, episodes.npy holds (start row, length)
+# inverted/<column>.*.npy map every value of a categorical column to its sorted rows
+index_meta_file = "meta.json"
+index_episodes_file = "episodes.npy"
+inverted_features = ['mActionId', 'act_st', 'stance']
+max_hp = 10000
+
+
+def find_captures(source_paths: List[str]) -> List[str]:
+    # binary captures written by FrameCaptureWriter or binary_frame_format and csv captures
+    sources = []
+    for source_path in source_paths:
+        if os.path.isdir(source_path):
+            sources.extend(sorted(glob.glob(os.path.join(source_path, "*.bin")) +
+                                  glob.glob(os.path.join(source_path, "*.csv"))))
+        else:
+            sources.append(source_path)
+    return sources
+
+
+def load_capture(source: str, game_env_format: List[str]) -> np.ndarray:
+    if source.endswith('.csv'):
+        return rows_to_frames(list(read_csv_capture(source, game_env_format)), game_env_format)
+    return load_binary_capture(source, game_env_format)
+
+
+def split_rounds(frames: np.ndarray) -> List[np.ndarray]:
+    # a round starts where the frame number goes back or the hp of a player is refilled to max
+    hp = frames['players']['current_HP']
+    refilled = ((hp[1:] == max_hp) & (hp[:-1] < max_hp)).any(axis=1)
+    restarted = np.diff(frames['header']['frame']) < 0
+    starts = np.flatnonzero(refilled | restarted) + 1
+    return [round_frames for round_frames in np.split(frames, starts) if len(round_frames)]
+
+
+def merge_postings(values: np.ndarray, offsets: np.ndarray, rows: np.ndarray, column: np.ndarray, first_row: int):
+    # adds the rows of the appended column values to the sorted postings in one linear merge,
+    # appended rows are after every indexed row so each value keeps its rows sorted
+    new_order = np.argsort(column, kind='stable')
+    new_keys = column[new_order]
+    new_rows = new_order.astype(np.int64) + first_row
+    old_keys = np.repeat(values, np.diff(offsets))
+
+    positions = np.searchsorted(old_keys, new_keys, side='right') + np.arange(len(new_keys))
+    keys = np.empty(len(old_keys) + len(new_keys), dtype=np.int64)
+    merged_rows = np.empty(len(keys), dtype=np.int64)
+    is_new = np.zeros(len(keys), dtype=bool)
+    is_new[positions] = True
+    keys[positions] = new_keys
+    keys[~is_new] = old_keys
+    merged_rows[positions] = new_rows
+    merged_rows[~is_new] = rows
+
+    values, starts = np.unique(keys, return_index=True)
+    return values, np.append(starts, len(keys)).astype(np.int64), merged_rows
+
+
+def drop_postings(values: np.ndarray, offsets: np.ndarray, rows: np.ndarray, length: int):
+    # postings of the first length rows, rows past them were merged by a build that failed before its meta.json
+    keep = rows < length
+    if keep.all():
+        return values, offsets, rows
+    keys = np.repeat(values, np.diff(offsets))[keep]
+    values, starts = np.unique(keys, return_index=True)
+    return values, np.append(starts, len(keys)).astype(np.int64), rows[keep]
+
+
+def build_frame_index(source_paths: List[str], index_path: str, game_env_format: List[str],
+                      characters=('luke', 'luke'), split: bool = False) -> dict:
+    # appends the captures not indexed before and merges their rows into the inverted indexes
+    # with split every capture is split into rounds, otherwise every capture is one episode
+    os.makedirs(os.path.join(index_path, "inverted"), exist_ok=True)
+    player_dtype = create_player_dtype(game_env_format)
+    columns = {"frame": np.dtype('<i8').str}
+    for player_id in [0, 1]:
+        for feature in game_env_format:
+            columns[f"{player_id}_{feature}"] = player_dtype[feature].str
+    inverted_columns = [f"{player_id}_{feature}" for player_id in [0, 1] for feature in inverted_features
+                        if feature in game_env_format]
+
+    meta_path = os.path.join(index_path, index_meta_file)
+    episodes_path = os.path.join(index_path, index_episodes_file)
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['game_env_format'] != list(game_env_format):
+            raise ValueError(f"Index {index_path} was built for a different game_env.format.")
+        episodes = [tuple(episode) for episode in np.load(episodes_path).tolist()]
+    else:
+        meta = {"game_env_format": list(game_env_format), "characters": list(characters), "columns": columns,
+                "length": 0, "sources": []}
+        episodes = []
+
+    # meta.json only counts complete captures, rows past meta['length'] left by a failed build are truncated
+    first_row = meta['length']
+    converted = set(meta['sources'])
+    added = 0
+    files = {}
+    for name, dtype in columns.items():
+        files[name] = open(os.path.join(index_path, f"{name}.bin"), 'ab')
+        files[name].truncate(first_row * np.dtype(dtype).itemsize)
+    try:
+        for source in find_captures(source_paths):
+            source_key = os.path.abspath(source)
+            if source_key in converted:
+                continue
+            frames = load_capture(source, game_env_format)
+            length = meta['length']
+            capture_episodes = []
+            for episode_frames in (split_rounds(frames) if split else [frames]):
+                if len(episode_frames) == 0:
+                    continue
+                files["frame"].write(np.ascontiguousarray(episode_frames['header']['frame'], dtype='<i8').tobytes())
+                for player_id in [0, 1]:
+                    players = episode_frames['players'][:, player_id]
+                    for feature in game_env_format:
+                        files[f"{player_id}_{feature}"].write(np.ascontiguousarray(players[feature]).tobytes())
+                capture_episodes.append((length, len(episode_frames)))
+                length += len(episode_frames)
+
+            # the capture only counts once every episode of it was written
+            episodes.extend(capture_episodes)
+            added += len(capture_episodes)
+            meta['length'] = length
+            meta['sources'].append(source_key)
+            converted.add(source_key)
+    finally:
+        # the captures indexed before a failing source are kept
+        for name, dtype in columns.items():
+            files[name].truncate(meta['length'] * np.dtype(dtype).itemsize)
+            files[name].close()
+        write_index(index_path, meta, episodes, columns, inverted_columns, first_row)
+
+    return {"episodes_added": added, "episodes": len(episodes), "length": meta['length']}
+
+
+def write_index(index_path: str, meta: dict, episodes: list, columns: dict, inverted_columns: List[str],
+                first_row: int):
+    # merges the rows from first_row into the inverted indexes, then commits the episodes and meta.json
+    if meta['length'] > first_row:
+        for name in inverted_columns:
+            column = np.fromfile(os.path.join(index_path, f"{name}.bin"), dtype=columns[name],
+                                 offset=first_row * np.dtype(columns[name]).itemsize).astype(np.int64)
+            inverted_path = os.path.join(index_path, "inverted", name)
+            if first_row > 0:
+                values, offsets, rows = (np.load(f"{inverted_path}.{part}.npy") for part in ['values', 'offsets', 'rows'])
+                values, offsets, rows = drop_postings(values, offsets, rows, first_row)
+            else:
+                values, offsets, rows = np.zeros(0, np.int64), np.zeros(1, np.int64), np.zeros(0, np.int64)
+            values, offsets, rows = merge_postings(values, offsets, rows, column, first_row)
+            for part, array in [('values', values), ('offsets', offsets), ('rows', rows)]:
+                np.save(f"{inverted_path}.{part}.npy", array)
+
+    meta['inverted_columns'] = inverted_columns
+    np.save(os.path.join(index_path, index_episodes_file), np.asarray(episodes, dtype=np.int64).reshape(-1, 2))
+    with open(os.path.join(index_path, index_meta_file), 'w') as f:
+        json.dump(meta, f)
+
+
+class LazyColumns:
+    # columns gathered at the candidate rows of a query on first access
+    def __init__(self, index: 'FrameIndex', rows: np.ndarray):
+        self.index = index
+        self.rows = rows
+        self.cache = {}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.cache:
+            column = self.index.columns[name]
+            self.cache[name] = column[:] if self.rows is None else column[self.rows]
+        return self.cache[name]
+
+
+class FrameIndex:
+    # memory mapped view of an index built by build_frame_index
+    # find() returns the sorted rows matching a query and ranges() turns rows into (episode, first frame, last frame)
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        with open(os.path.join(index_path, index_meta_file), 'r') as f:
+            self.meta = json.load(f)
+        self.length = self.meta['length']
+        self.episodes = np.load(os.path.join(index_path, index_episodes_file))
+        self.columns = {}
+        for name, dtype in self.meta['columns'].items():
+            if self.length == 0:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(os.path.join(index_path, f"{name}.bin"), dtype=dtype, mode='r',
+                                               shape=(self.length,))
+        self.inverted = {}
+
+        self.episode_starts = self.episodes[:, 0] if len(self.episodes) else np.zeros(0, np.int64)
+        # last row of every episode, e.g. find(rows=index.episode_last_rows, ...) for how rounds end
+        self.episode_last_rows = self.episode_starts + self.episodes[:, 1] - 1 if len(self.episodes) \
+            else np.zeros(0, np.int64)
+
+        # act_st and mActionId names of the indexed characters -> values
+        with open(os.path.join(state_spaces.default_data_path, "act_st.json")) as f:
+            self.act_st_values = {name: int(value) for value, name in json.load(f).items()}
+        self.action_values = []
+        for character in self.meta['characters']:
+            with open(os.path.join(state_spaces.default_data_path, f"{character}.json")) as f:
+                self.action_values.append({name: int(value) for value, name in json.load(f).items()})
+
+    def get_postings(self, name: str):
+        if name not in self.inverted:
+            inverted_path = os.path.join(self.index_path, "inverted", name)
+            self.inverted[name] = tuple(np.load(f"{inverted_path}.{part}.npy", mmap_mode='r')
+                                        for part in ['values', 'offsets', 'rows'])
+        return self.inverted[name]
+
+    def value_id(self, name: str, value: Union[int, str]) -> int:
+        # act_st and mActionId values can be given by name
+        if not isinstance(value, str):
+            return int(value)
+        player_id, feature = name.split('_', 1)
+        if feature == 'act_st':
+            return self.act_st_values[value]
+        if feature == 'mActionId':
+            return self.action_values[int(player_id)][value]
+        return int(value)
+
+    def rows_equal(self, name: str, values) -> np.ndarray:
+        # sorted rows where the categorical column has one of the values
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        if name not in self.meta['inverted_columns']:
+            column = self.columns[name]
+            return np.flatnonzero(np.isin(column, [self.value_id(name, value) for value in values]))
+        indexed_values, offsets, rows = self.get_postings(name)
+        parts = []
+        for value in values:
+            position = np.searchsorted(indexed_values, self.value_id(name, value))
+            if position < len(indexed_values) and indexed_values[position] == self.value_id(name, value):
+                parts.append(rows[offsets[position]:offsets[position + 1]])
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(parts[0]) if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+    def find(self, equals: Dict[str, object] = None, where: Callable[[LazyColumns], np.ndarray] = None,
+             rows: np.ndarray = None) -> np.ndarray:
+        # rows matching every equals condition (column -> value or list of values) from the inverted indexes,
+        # then where(columns) evaluated on those rows only, rows restricts the candidates
+        candidates = None if rows is None else np.sort(np.asarray(rows, dtype=np.int64))
+        for name, values in (equals or {}).items():
+            matched = self.rows_equal(name, values)
+            candidates = matched if candidates is None else np.intersect1d(candidates, matched, assume_unique=True)
+        if where is not None:
+            selected = np.asarray(where(LazyColumns(self, candidates)), dtype=bool)
+            candidates = np.flatnonzero(selected) if candidates is None else candidates[selected]
+        if candidates is None:
+            candidates = np.arange(self.length, dtype=np.int64)
+        return candidates
+
+    def ranges(self, rows: np.ndarray) -> np.ndarray:
+        # consecutive rows of one episode as (episode, first frame, last frame) with the frame numbers of the capture
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros((0, 3), dtype=np.int64)
+        episodes = np.searchsorted(self.episode_starts, rows, side='right') - 1
+        breaks = np.flatnonzero((np.diff(rows) != 1) | (np.diff(episodes) != 0)) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(rows)]]) - 1
+        frames = self.columns['frame']
+        return np.stack([episodes[starts], frames[rows[starts]], frames[rows[ends]]], axis=1)
+
+    def query(self, equals: Dict[str, object] = None, where: Callable[[LazyColumns], np.ndarray] = None,
+              rows: np.ndarray = None) -> np.ndarray:
+        return self.ranges(self.find(equals=equals, where=where, rows=rows))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index raw frame captures for situational queries.")
+    parser.add_argument('index_path')
+    parser.add_argument('sources', nargs='+', help="capture directories, .bin or .csv captures")
+    parser.add_argument('--format', default="env/game_env.format", help="game_env.format the captures were written with")
+    parser.add_argument('--characters', nargs=2, default=['luke', 'luke'])
+    parser.add_argument('--split-rounds', action='store_true', help="split every capture into rounds")
+    args = parser.parse_args()
+
+    with open(args.format, 'r') as format_file:
+        capture_format = format_file.readline().strip().split(",")
+    print(build_frame_index(args.sources, args.index_path, capture_format, characters=args.characters,
+                            split=args.split_rounds))
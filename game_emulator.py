@@ -0,0 +1,482 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Dict, List
+
+import numpy as np
+
+import state_spaces
+from game_env_transport import SharedMemoryGameEnvWriter
+
+# files copied into a new emulator env directory
+emulator_env_files = ["game_env.format", "action_key_mapping.json", "action_key_mapping_p2.json"]
+
+# action key index -> button, see action_spaces
+UP, LEFT, DOWN, RIGHT = 0, 1, 2, 3
+buttons = {
+    4: 'LP',
+    5: 'MP',
+    6: 'HP',
+    7: 'LK',
+    8: 'MK',
+    9: 'HK',
+}
+# startup, active, total frames, damage, range, hitstun, blockstun, hitstop
+frame_data = {
+    'LP': (4, 3, 14, 300, 0.9, 12, 8, 8),
+    'MP': (6, 3, 22, 600, 1.1, 16, 12, 10),
+    'HP': (8, 4, 30, 800, 1.2, 20, 16, 12),
+    'LK': (5, 3, 16, 300, 1.0, 12, 8, 8),
+    'MK': (8, 3, 26, 700, 1.3, 16, 12, 10),
+    'HK': (11, 4, 34, 900, 1.4, 20, 16, 12),
+}
+act_st_values = {
+    'STAND': 4,
+    'SIT': 1,
+    'WALK': 8,
+    'JUMP': 14,
+    'DEF': 27,
+    'ATCK': 29,
+    'DAMAGE': 32,
+}
+stage_bounds = (-7.65, 7.65)
+walk_speed = 0.035
+jump_frames = 40
+jump_height = 1.6
+max_hp = 10000
+max_drive = 60000
+max_super = 30000
+
+
+def prepare_env_path(env_path: str, source_env_path: str = None):
+    # creates an env directory with the files SF6GameState expects
+    if source_env_path is None:
+        source_env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "env")
+    os.makedirs(env_path, exist_ok=True)
+    for file_name in emulator_env_files:
+        target = os.path.join(env_path, file_name)
+        if not os.path.exists(target):
+            shutil.copyfile(os.path.join(source_env_path, file_name), target)
+    for file_name in ["game_env_buffer.buf", "actions_buffer.buf"]:
+        target = os.path.join(env_path, file_name)
+        if not os.path.exists(target):
+            open(target, 'w').close()
+
+
+def load_action_ids(character: str, data_path: str = None) -> Dict[str, int]:
+    # action name -> mActionId
+    data_path = state_spaces.default_data_path if data_path is None else data_path
+    with open(os.path.join(data_path, f"{character}.json")) as f:
+        return {name: int(key) for key, name in json.load(f).items()}
+
+
+class EmulatedPlayer:
+    def __init__(self, game_env_format: List[str], pos_x: float, facing: int):
+        self.values = {name: 0 for name in game_env_format}
+        self.start_x = pos_x
+        self.start_facing = facing
+        self.reset()
+
+    def reset(self):
+        self.values.update({
+            'current_HP': max_hp,
+            'HP_cap': max_hp,
+            'drive': max_drive,
+            'super': 0,
+            'posX': self.start_x,
+            'posY': 0.0,
+            'spdX': 0.0,
+            'spdY': 0.0,
+            'dir': self.start_facing,
+            'act_st': act_st_values['STAND'],
+            'stance': 0,
+            'hitstun': 0,
+            'blockstun': 0,
+            'hitstop': 0,
+            'mActionFrame': 0,
+            'mEndFrame': 0,
+        })
+        self.attack = None  # (button, action frame)
+        self.jump_frame = None
+        self.attack_landed = False
+
+
+class GameEmulator:
+    # headless stand in for scripts/game_state_to_buffer.lua
+    # writes a frame in the game_env.format layout, waits for the action line of that frame and applies it
+    def __init__(self, env_path: str, fps: float = 60.0, character: str = 'luke', data_path: str = None,
+                 transport: str = 'file', torn_write_rate: float = 0.0, drop_frame_rate: float = 0.0,
+                 seed: int = None, action_timeout: float = None, reset_delay: int = 0, reset_ack: bool = True,
+                 frame_latency: float = 0.0):
+        prepare_env_path(env_path)
+        self.env_path = env_path
+        self.frame_time = 1.0 / fps if fps else 0.0  # 0 runs unthrottled
+        self.transport = transport
+        self.torn_write_rate = torn_write_rate
+        self.drop_frame_rate = drop_frame_rate
+        self.action_timeout = action_timeout
+        self.reset_delay = reset_delay  # frames between the reset key press and the new round
+        self.reset_ack = reset_ack  # False behaves like a lua script without the reset handshake
+        self.frame_latency = frame_latency  # seconds the game takes to produce a frame after the action arrived
+        self.rng = np.random.default_rng(seed)
+
+        with open(os.path.join(env_path, "game_env.format"), 'r') as f:
+            self.game_env_format = f.readline().strip().split(",")
+        with open(os.path.join(env_path, "action_key_mapping.json"), 'r') as f:
+            self.action_key_count = len(json.load(f))
+        self.reset_key = self.action_key_count - 1  # the last mapped key resets the round
+        self.reset_request_column = 1 + self.action_key_count  # trailing column of the action line
+        # two player lines carry the keys of player 1 after the reset column, see sf6_self_play
+        self.opponent_key_column = self.reset_request_column + 1
+        # like the lua script the keys of player 1 are only played with a player 2 key mapping
+        self.accepts_opponent_keys = os.path.exists(os.path.join(env_path, "action_key_mapping_p2.json"))
+
+        action_ids = load_action_ids(character, data_path)
+        default_action_id = next(iter(action_ids.values()))
+        self.action_ids = {name: action_ids.get(name, default_action_id) for name in [
+            'BAS_STD_Loop', 'BAS_CRH_Loop', 'BAS_FORWARD_Loop', 'BAS_BACKWARD_Loop', 'BAS_JUMP_N_AIR',
+            '5010_GRD_STD_Loop', 'DMG_HM',
+        ] + [f"ATK_{stance}{button}" for stance in '528' for button in frame_data]}
+
+        self.players = [
+            EmulatedPlayer(self.game_env_format, pos_x=-1.5, facing=1),
+            EmulatedPlayer(self.game_env_format, pos_x=1.5, facing=0),
+        ]
+        self.game_state_frame = 0
+        self.action_keys = [0] * self.action_key_count
+        self.controls = [self.action_keys, self.action_keys]  # keys held by each player this frame
+        self.opponent_keys = None  # keys of player 1 sent with the last action line, None lets the emulator play
+        self.last_reset_key = 0
+        self.reset_countdown = None
+        self.reset_request_id = 0  # last reset request handled
+        self.reset_ack_id = 0  # last reset request whose round is live
+        self.reset_press_frames = 0
+        self.reset_pending = False
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.torn_writes = 0
+        self.resets = 0
+
+        self.game_env_buffer_path = os.path.join(env_path, "game_env_buffer.buf")
+        self.actions_buffer_path = os.path.join(env_path, "actions_buffer.buf")
+        self.game_env_buffer = open(self.game_env_buffer_path, 'r+')
+        self.actions_buffer = open(self.actions_buffer_path, 'r')
+        self.ring_writer = None
+        if transport == 'shm':
+            self.ring_writer = SharedMemoryGameEnvWriter(os.path.join(env_path, "game_env_ring.buf"))
+
+    def reset_round(self):
+        for player in self.players:
+            player.reset()
+        self.resets += 1
+
+    def frame_row(self) -> List[str]:
+        row = [str(self.game_state_frame)]
+        for player in self.players:
+            row.extend(str(player.values[name]) for name in self.game_env_format)
+        if self.reset_ack:
+            row.append(str(self.reset_ack_id))
+        return row
+
+    def write_game_env(self):
+        line = ','.join(self.frame_row())
+        torn = self.rng.random() < self.torn_write_rate
+        if torn:
+            self.torn_writes += 1
+
+        if self.ring_writer is not None:
+            self.ring_writer.write(line.encode(), torn=torn)
+        else:
+            self.game_env_buffer.seek(0)
+            if torn:
+                # half the line lands before the reader may look at the file
+                split = len(line) // 2
+                self.game_env_buffer.write(line[:split])
+                self.game_env_buffer.flush()
+                time.sleep(0.0005)
+                self.game_env_buffer.write(line[split:] + "\n")
+            else:
+                self.game_env_buffer.write(line + "\n")
+            self.game_env_buffer.flush()
+        self.frames_written += 1
+
+    def wait_for_actions(self, stop_event=None) -> bool:
+        # same as waitForActionsBuffer, the action line starts with the frame number it answers
+        frame_number = str(self.game_state_frame)
+        wait_start = time.perf_counter()
+        while True:
+            self.actions_buffer.seek(0)
+            actions_table = [value for value in self.actions_buffer.readline().strip().split(",") if value]
+            if actions_table and actions_table[0] == frame_number:
+                keys = [int(value) for value in actions_table[1:1 + self.action_key_count]]
+                self.action_keys = keys + [0] * (self.action_key_count - len(keys))
+                if self.reset_ack:
+                    request_id = int(actions_table[self.reset_request_column]) \
+                        if len(actions_table) > self.reset_request_column else 0
+                    self.handle_reset_request(request_id)
+                self.opponent_keys = None
+                if self.accepts_opponent_keys and len(actions_table) > self.opponent_key_column:
+                    keys = [int(value) for value in actions_table[self.opponent_key_column:
+                                                                  self.opponent_key_column + self.action_key_count]]
+                    # player 1 can not press the reset key
+                    self.opponent_keys = (keys + [0] * (self.action_key_count - len(keys)))[:self.reset_key] + [0]
+                return True
+            if stop_event is not None and stop_event.is_set():
+                return False
+            if self.action_timeout is not None and time.perf_counter() - wait_start > self.action_timeout:
+                return False
+            time.sleep(0)
+
+    def handle_reset_request(self, request_id: int):
+        # same as the lua script, a new request id presses the reset key for two frames
+        if request_id != 0 and request_id != self.reset_request_id:
+            self.reset_request_id = request_id
+            self.reset_press_frames = 2
+            self.reset_pending = True
+        if self.reset_press_frames > 0:
+            self.action_keys[self.reset_key] = 1
+            self.reset_press_frames -= 1
+
+    def update_reset_ack(self):
+        # the request is acknowledged once the key was released and the round is live
+        if self.reset_pending and self.reset_press_frames == 0 and self.reset_countdown is None and \
+                all(player.values['current_HP'] >= max_hp for player in self.players):
+            self.reset_ack_id = self.reset_request_id
+            self.reset_pending = False
+
+    def player_controls(self, player_idx: int) -> List[int]:
+        if player_idx == 0:
+            return self.action_keys
+        if self.opponent_keys is not None:
+            return self.opponent_keys
+        # player 1 walks towards player 0, blocks or attacks at random
+        keys = [0] * self.action_key_count
+        player = self.players[1]
+        distance = abs(player.values['posX'] - self.players[0].values['posX'])
+        choice = self.rng.random()
+        towards = LEFT if self.players[0].values['posX'] < player.values['posX'] else RIGHT
+        away = RIGHT if towards == LEFT else LEFT
+        if distance > 1.2 and choice < 0.6:
+            keys[towards] = 1
+        elif choice < 0.3:
+            keys[away] = 1
+        elif choice < 0.36:
+            keys[int(self.rng.choice(list(buttons.keys())))] = 1
+        return keys
+
+    def update_player(self, player_idx: int):
+        keys = self.controls[player_idx]
+        player = self.players[player_idx]
+        opponent = self.players[1 - player_idx]
+        values = player.values
+
+        for name in ['hitstun', 'blockstun', 'drive_cooldown']:
+            values[name] = max(values[name] - 1, 0)
+        values['drive'] = min(values['drive'] + 20, max_drive)
+        values['dir'] = 1 if values['posX'] < opponent.values['posX'] else 0
+
+        if values['hitstun'] > 0 or values['blockstun'] > 0:
+            values['act_st'] = act_st_values['DAMAGE'] if values['hitstun'] > 0 else act_st_values['DEF']
+            values['spdX'] = 0.0
+            return
+
+        if player.jump_frame is not None:
+            player.jump_frame += 1
+            t = player.jump_frame / jump_frames
+            values['posY'] = max(4 * jump_height * t * (1 - t), 0.0)
+            if player.jump_frame >= jump_frames:
+                player.jump_frame = None
+                values['posY'] = 0.0
+        elif keys[UP]:
+            player.jump_frame = 0
+            values['act_st'] = act_st_values['JUMP']
+            values['mActionId'] = self.action_ids['BAS_JUMP_N_AIR']
+
+        if player.attack is not None:
+            button, action_frame = player.attack
+            startup, active, total, damage, reach, hitstun, blockstun, hitstop = frame_data[button]
+            action_frame += 1
+            player.attack = (button, action_frame)
+            values['mActionFrame'] = action_frame
+            if startup <= action_frame < startup + active and not player.attack_landed:
+                if abs(values['posX'] - opponent.values['posX']) <= reach:
+                    self.land_hit(player, opponent, damage, hitstun, blockstun, hitstop)
+            if action_frame >= total:
+                player.attack = None
+            return
+
+        pressed = [key for key in buttons if keys[key]]
+        if pressed:
+            button = buttons[pressed[0]]
+            stance = '8' if player.jump_frame is not None else '2' if keys[DOWN] else '5'
+            player.attack = (button, 0)
+            player.attack_landed = False
+            values['mActionId'] = self.action_ids[f"ATK_{stance}{button}"]
+            values['mActionFrame'] = 0
+            values['mEndFrame'] = frame_data[button][2]
+            values['act_st'] = act_st_values['ATCK']
+            values['spdX'] = 0.0
+            return
+
+        if player.jump_frame is not None:
+            return
+
+        values['mActionFrame'] = values['mActionFrame'] + 1
+        if keys[DOWN]:
+            values['act_st'] = act_st_values['SIT']
+            values['mActionId'] = self.action_ids['BAS_CRH_Loop']
+            values['spdX'] = 0.0
+        elif keys[LEFT] != keys[RIGHT]:
+            values['spdX'] = walk_speed if keys[RIGHT] else -walk_speed
+            forward = (values['spdX'] > 0) == (values['dir'] == 1)
+            values['act_st'] = act_st_values['WALK']
+            values['mActionId'] = self.action_ids['BAS_FORWARD_Loop' if forward else 'BAS_BACKWARD_Loop']
+        else:
+            values['spdX'] = 0.0
+            values['act_st'] = act_st_values['STAND']
+            values['mActionId'] = self.action_ids['BAS_STD_Loop']
+
+        values['posX'] = float(np.clip(values['posX'] + values['spdX'], *stage_bounds))
+
+    def land_hit(self, attacker: EmulatedPlayer, defender: EmulatedPlayer, damage, hitstun, blockstun, hitstop):
+        attacker.attack_landed = True
+        defender_values = defender.values
+        defender_keys = self.controls[self.players.index(defender)]
+        back = LEFT if defender_values['dir'] == 1 else RIGHT
+        blocking = defender.attack is None and defender_keys[back] == 1
+
+        if blocking:
+            defender_values['blockstun'] = blockstun
+            defender_values['mActionId'] = self.action_ids['5010_GRD_STD_Loop']
+            defender_values['current_HP'] = max(defender_values['current_HP'] - damage // 10, 0)
+        else:
+            defender_values['hitstun'] = hitstun
+            defender_values['mActionId'] = self.action_ids['DMG_HM']
+            defender_values['current_HP'] = max(defender_values['current_HP'] - damage, 0)
+            defender.attack = None
+            attacker.values['super'] = min(attacker.values['super'] + damage, max_super)
+        defender_values['HP_cap'] = defender_values['current_HP']
+        attacker.values['hitstop'] = hitstop
+        defender_values['hitstop'] = hitstop
+
+    def update(self):
+        reset_key = self.action_keys[self.reset_key]
+        if reset_key == 1 and self.last_reset_key == 0:
+            self.reset_countdown = self.reset_delay
+        self.last_reset_key = reset_key
+        if self.reset_countdown is not None:
+            if self.reset_countdown == 0:
+                self.reset_round()
+                self.reset_countdown = None
+            else:
+                self.reset_countdown -= 1
+        self.update_reset_ack()
+
+        if any(player.values['hitstop'] > 0 for player in self.players):
+            # both characters are frozen during hitstop
+            for player in self.players:
+                player.values['hitstop'] = max(player.values['hitstop'] - 1, 0)
+            return
+
+        if any(player.values['current_HP'] <= 0 for player in self.players):
+            return  # round is over until a reset is requested
+
+        self.controls = [self.player_controls(0), self.player_controls(1)]
+        for player_idx in [0, 1]:
+            self.update_player(player_idx)
+
+    def run(self, max_frames: int = None, stop_event=None):
+        next_frame = time.perf_counter()
+        while max_frames is None or self.frames_written < max_frames:
+            if stop_event is not None and stop_event.is_set():
+                break
+            self.update()
+            if self.rng.random() < self.drop_frame_rate:
+                # the game advanced a frame without writing it
+                self.frames_dropped += 1
+                self.game_state_frame += 1
+            self.write_game_env()
+            if not self.wait_for_actions(stop_event):
+                break
+            self.game_state_frame += 1
+            if self.frame_latency > 0:
+                time.sleep(self.frame_latency)
+
+            if self.frame_time > 0:
+                next_frame += self.frame_time
+                remaining = next_frame - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+                else:
+                    next_frame = time.perf_counter()
+
+    def stats(self) -> dict:
+        return {
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "torn_writes": self.torn_writes,
+            "resets": self.resets,
+        }
+
+    def close(self):
+        self.game_env_buffer.close()
+        self.actions_buffer.close()
+        if self.ring_writer is not None:
+            self.ring_writer.close()
+
+
+def run_emulator(env_path: str, stop_event=None, max_frames: int = None, **kwargs):
+    emulator = GameEmulator(env_path, **kwargs)
+    try:
+        emulator.run(max_frames=max_frames, stop_event=stop_event)
+    finally:
+        emulator.close()
+
+
+def start_emulator_process(env_path: str, **kwargs):
+    # returns the process and the event that stops it
+    prepare_env_path(env_path)
+    stop_event = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_emulator, args=(env_path, stop_event), kwargs=kwargs, daemon=True)
+    process.start()
+    return process, stop_event
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless game side emulator for the SF6 buffer protocol.")
+    parser.add_argument('--env-path', required=True)
+    parser.add_argument('--fps', type=float, default=60.0, help="0 runs unthrottled")
+    parser.add_argument('--character', default='luke')
+    parser.add_argument('--transport', choices=['file', 'shm'], default='file')
+    parser.add_argument('--torn-write-rate', type=float, default=0.0)
+    parser.add_argument('--drop-frame-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--reset-delay', type=int, default=0, help="frames between the reset key and the new round")
+    parser.add_argument('--no-reset-ack', action='store_true', help="behave like a script without the reset handshake")
+    parser.add_argument('--frame-latency', type=float, default=0.0,
+                        help="seconds between an action and the next frame")
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    game = GameEmulator(
+        env_path=args.env_path,
+        fps=args.fps,
+        character=args.character,
+        transport=args.transport,
+        torn_write_rate=args.torn_write_rate,
+        drop_frame_rate=args.drop_frame_rate,
+        seed=args.seed,
+        reset_delay=args.reset_delay,
+        reset_ack=not args.no_reset_ack,
+        frame_latency=args.frame_latency,
+    )
+    try:
+        game.run(max_frames=args.max_frames)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(game.stats()))
+        game.close()
@@ -0,0 +1,164 @@
+import mmap
+import os
+import struct
+import time
+from typing import List, Optional
+
+# ring buffer layout
+# header: magic, version, slot_count, slot_size, head (number of the last published frame)
+# slot: seq (odd while being written, 2 * publish number once stable), payload length, pad, publish time, payload
+RING_MAGIC = b'SF6R'
+RING_VERSION = 1
+RING_HEADER = struct.Struct('<4sIIIQ')
+RING_HEADER_SIZE = 64
+RING_HEAD_OFFSET = 16
+RING_SLOT_HEADER = struct.Struct('<QIId')
+RING_SEQ = struct.Struct('<Q')
+
+DEFAULT_SLOT_COUNT = 8
+DEFAULT_SLOT_SIZE = 1024
+
+
+def ring_size(slot_count: int, slot_size: int) -> int:
+    return RING_HEADER_SIZE + slot_count * (RING_SLOT_HEADER.size + slot_size)
+
+
+class FileGameEnvTransport:
+    # polls the game env buffer file written by scripts/game_state_to_buffer.lua
+    # file timestamps are coarse so two frames can share a mtime, the file is re-read while its mtime is
+    # within recheck_window seconds of now
+    def __init__(self, path: str, recheck_window: float = 0.02):
+        self.path = path
+        self.buffer = open(path, 'r')
+        self.recheck_window = recheck_window
+        self.last_timestamp = 0
+        self.frame_time = None  # mtime is too coarse to tell when a frame was written
+        self.torn_reads = 0
+
+    def poll(self) -> Optional[List[str]]:
+        current_timestamp = os.path.getmtime(self.path)
+        if current_timestamp == self.last_timestamp and time.time() - current_timestamp > self.recheck_window:
+            return None
+        self.last_timestamp = current_timestamp
+        self.buffer.seek(0)
+        return self.buffer.readline().strip().split(",")
+
+    def rewind(self):
+        # the next poll returns the latest frame even if it was returned before
+        self.last_timestamp = 0
+
+    def close(self):
+        self.buffer.close()
+
+
+class SharedMemoryGameEnvTransport:
+    # reads frames from a mmap backed ring buffer, each slot is guarded by a seqlock style sequence counter
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'r+b')
+        header_buffer = self.file.read(RING_HEADER.size)
+        if len(header_buffer) < RING_HEADER.size:
+            raise ValueError(f"{path} is not a game env ring buffer.")
+
+        magic, version, self.slot_count, self.slot_size, _ = RING_HEADER.unpack(header_buffer)
+        if magic != RING_MAGIC:
+            raise ValueError(f"{path} is not a game env ring buffer.")
+        if version != RING_VERSION:
+            raise ValueError(f"Unsupported ring buffer version expected={RING_VERSION} actual={version}")
+
+        self.buffer = mmap.mmap(self.file.fileno(), ring_size(self.slot_count, self.slot_size))
+        self.slot_stride = RING_SLOT_HEADER.size + self.slot_size
+        self.last_head = 0
+        self.frame_time = None  # wall clock time the last returned frame was published
+        self.torn_reads = 0
+
+    def read_head(self) -> int:
+        return RING_SEQ.unpack_from(self.buffer, RING_HEAD_OFFSET)[0]
+
+    def poll(self) -> Optional[List[str]]:
+        head = RING_SEQ.unpack_from(self.buffer, RING_HEAD_OFFSET)[0]
+        if head == self.last_head:
+            return None
+
+        slot_offset = RING_HEADER_SIZE + (head % self.slot_count) * self.slot_stride
+        seq, length, _, frame_time = RING_SLOT_HEADER.unpack_from(self.buffer, slot_offset)
+        if seq != head * 2:
+            # slot is being written or was already reused by a newer frame
+            self.torn_reads += 1
+            return None
+
+        payload_offset = slot_offset + RING_SLOT_HEADER.size
+        payload = self.buffer[payload_offset:payload_offset + length]
+        if RING_SEQ.unpack_from(self.buffer, slot_offset)[0] != seq:
+            # writer touched the slot while it was copied
+            self.torn_reads += 1
+            return None
+
+        self.last_head = head
+        self.frame_time = frame_time
+        return payload.decode().split(",")
+
+    def rewind(self):
+        # the next poll returns the latest frame even if it was returned before
+        self.last_head = 0
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+class SharedMemoryGameEnvWriter:
+    # pure python stand in for the game side of the ring buffer
+    def __init__(self, path: str, slot_count: int = DEFAULT_SLOT_COUNT, slot_size: int = DEFAULT_SLOT_SIZE):
+        if slot_count < 2:
+            raise ValueError("Ring buffer needs at least 2 slots.")
+        self.path = path
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.slot_stride = RING_SLOT_HEADER.size + slot_size
+
+        with open(path, 'wb') as f:
+            f.write(b'\x00' * ring_size(slot_count, slot_size))
+        self.file = open(path, 'r+b')
+        self.buffer = mmap.mmap(self.file.fileno(), ring_size(slot_count, slot_size))
+        RING_HEADER.pack_into(self.buffer, 0, RING_MAGIC, RING_VERSION, slot_count, slot_size, 0)
+        self.head = 0
+
+    def write(self, payload: bytes, torn: bool = False):
+        if len(payload) > self.slot_size:
+            raise ValueError(f"Frame of {len(payload)} bytes does not fit slot_size={self.slot_size}.")
+
+        head = self.head + 1
+        slot_offset = RING_HEADER_SIZE + (head % self.slot_count) * self.slot_stride
+        payload_offset = slot_offset + RING_SLOT_HEADER.size
+
+        RING_SEQ.pack_into(self.buffer, slot_offset, head * 2 - 1)  # mark slot as being written
+        if torn:
+            # publish the head before the slot is complete to exercise the reader's torn read handling
+            RING_SEQ.pack_into(self.buffer, RING_HEAD_OFFSET, head)
+        self.buffer[payload_offset:payload_offset + len(payload)] = payload
+        RING_SLOT_HEADER.pack_into(self.buffer, slot_offset, head * 2 - 1, len(payload), 0, time.time())
+        RING_SEQ.pack_into(self.buffer, slot_offset, head * 2)  # slot is stable
+        RING_SEQ.pack_into(self.buffer, RING_HEAD_OFFSET, head)
+        self.head = head
+
+    def write_row(self, row: list, torn: bool = False):
+        self.write(','.join(map(str, row)).encode(), torn=torn)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+def create_game_env_transport(transport: str, game_env_buffer_path: str, game_env_ring_path: str):
+    if transport == 'file':
+        return FileGameEnvTransport(game_env_buffer_path)
+    elif transport == 'shm':
+        # scripts/game_state_to_buffer.lua only writes the file transport, the ring buffer is written by
+        # SharedMemoryGameEnvWriter (game_emulator.py) and has no writer on the game side yet
+        if not os.path.exists(game_env_ring_path):
+            raise FileNotFoundError(f"No game env ring buffer at {game_env_ring_path}, transport='shm' only works "
+                                    f"against game_emulator.py, the game side lua script writes transport='file'.")
+        return SharedMemoryGameEnvTransport(game_env_ring_path)
+    else:
+        raise ValueError(f"Unknown game env transport {transport}.")
@@ -5,19 +5,41 @@ from typing import Dict, List
 import numpy as np
 import warnings
 import os
+import time
+from collections import deque
 
-env_path = "C:/SteamLibrary/steamapps/common/Street Fighter 6/reframework/data/env/"
+from game_env_transport import create_game_env_transport
+from observation_encoder import ObservationEncoder
+from wait_strategies import create_wait_strategy
 
-action_event_buffer_path = f"{env_path}actions_buffer.buf"
-game_env_buffer_path = f"{env_path}game_env_buffer.buf"
-game_env_format_path = f"{env_path}game_env.format"
-action_key_mapping_path = f"{env_path}action_key_mapping.json"
+# default env directory, every SF6GameState can be given its own
+default_env_path = os.environ.get("SF6_ENV_PATH", "C:/SteamLibrary/steamapps/common/Street Fighter 6/reframework/data/env/")
 
 
-def create_state_space(feature_mappings: dict, feature: str) -> gym.spaces:
+def create_env_paths(env_path: str) -> Dict[str, str]:
+    return {
+        "action_event_buffer_path": os.path.join(env_path, "actions_buffer.buf"),
+        "game_env_buffer_path": os.path.join(env_path, "game_env_buffer.buf"),
+        "game_env_ring_path": os.path.join(env_path, "game_env_ring.buf"),
+        "game_env_format_path": os.path.join(env_path, "game_env.format"),
+        "action_key_mapping_path": os.path.join(env_path, "action_key_mapping.json"),
+        # keys of player 2, the game side only accepts inputs for player 1 of self play when it exists
+        "opponent_action_key_mapping_path": os.path.join(env_path, "action_key_mapping_p2.json"),
+    }
+
+
+# encodings of the dict (categorical) features: a one hot vector or the index of the value in the mapping
+categorical_encodings = ['one_hot', 'index']
+
+
+def create_state_space(feature_mappings: dict, feature: str, categorical_encoding: str = 'one_hot') -> gym.spaces:
     if feature in feature_mappings:
         feature_map, dtype = feature_mappings[feature]
         if type(feature_map) == dict:
+            if categorical_encoding == 'index':
+                # index len(feature_map) marks values missing from the mapping (the all zero one hot vector)
+                # a box and not Discrete as sb3 one hot encodes Discrete spaces before the feature extractor
+                return gym.spaces.Box(low=0, high=len(feature_map), shape=(1,), dtype=dtype)
             # hot one encoding so use box space
             return gym.spaces.Box(low=0, high=1, shape=(len(feature_map),), dtype=dtype)
         elif type(feature_map) == list:
@@ -30,21 +52,62 @@ def create_state_space(feature_mappings: dict, feature: str) -> gym.spaces:
 
 
 class SF6GameState:
-    def __init__(self, game_env_player_features, feature_mapping):
+    def __init__(self, game_env_player_features, feature_mapping, transport='file', wait_strategy='spin',
+                 env_path=None, game_env_format_path=None, action_key_mapping_path=None, reset_timeout=2.0,
+                 reset_retries=3, categorical_encoding='one_hot', incremental_decoding=False):
+        # buffers are read from env_path, the format and key mapping can be overridden
+        self.env_path = default_env_path if env_path is None else env_path
+        self.env_paths = create_env_paths(self.env_path)
+        if game_env_format_path is not None:
+            self.env_paths['game_env_format_path'] = game_env_format_path
+        if action_key_mapping_path is not None:
+            self.env_paths['action_key_mapping_path'] = action_key_mapping_path
+
         self.last_game_env_frame = None  # last env frame read
         self.current_game_env_frame = None  # the current frame being read 
         self.current_game_state = None  # the current game state
-
-        self.game_env_buffer = open(game_env_buffer_path, 'r')
-        self.action_event_buffer = open(action_event_buffer_path, 'r+')
-
-        with open(game_env_format_path, 'r') as f:
+        self.invalid_frames = 0  # frames dropped for having the wrong number of values
+
+        # 'file' polls game_env_buffer.buf, 'shm' reads the game_env_ring.buf ring buffer
+        self.game_env_transport = create_game_env_transport(
+            transport=transport,
+            game_env_buffer_path=self.env_paths['game_env_buffer_path'],
+            game_env_ring_path=self.env_paths['game_env_ring_path'],
+        )
+        # 'spin', 'spin_yield', 'backoff', 'inotify' or a WaitStrategy instance
+        self.wait_strategy = create_wait_strategy(wait_strategy, watch_path=self.game_env_transport.path)
+        self.action_event_buffer = open(self.env_paths['action_event_buffer_path'], 'r+')
+
+        with open(self.env_paths['game_env_format_path'], 'r') as f:
             self.game_env_format = f.readline().strip().split(",")
 
-        with open(action_key_mapping_path, 'r') as f:
+        with open(self.env_paths['action_key_mapping_path'], 'r') as f:
             self.action_event_mapping = json.load(f)
 
+        # frame number and both players, the game side may append the id of the last acknowledged reset request
+        self.game_env_length = (len(self.game_env_format) * 2) + 1
+
+        # the reset request id is sent in the trailing column of the action line, ids start from the clock so
+        # a restarted trainer does not reuse the id the game side handled last
+        self.reset_timeout = reset_timeout
+        self.reset_retries = reset_retries
+        self.reset_request_id = int(time.time() * 1000) % 1000000000
+        self.reset_line = ",0" * len(self.action_event_mapping) + ","
+        self.reset_latencies = deque(maxlen=1000)
+        self.reset_frames = deque(maxlen=1000)
+        self.reset_count = 0
+        # state of the reset in progress, see start_reset
+        self.reset_start = None
+        self.reset_attempt = 0
+        self.reset_attempt_start = None
+        self.reset_frame_count = 0
+        self.reset_retry_count = 0
+        self.reset_timeout_count = 0
+
         self.feature_mapping = feature_mapping
+        if categorical_encoding not in categorical_encodings:
+            raise ValueError(f"Unknown categorical encoding {categorical_encoding}, expected one of {categorical_encodings}.")
+        self.categorical_encoding = categorical_encoding
 
         self.game_env_player_features = game_env_player_features
         for player_id in [0, 1]:
@@ -52,25 +115,50 @@ class SF6GameState:
                 if name not in self.game_env_format:
                     raise KeyError(f"No feature named {name}.")
 
+        # hitstop, hitstun and blockstun columns of each player read by can_act every frame of skip_inactive
+        self.act_columns = [
+            [1 + player_idx * len(self.game_env_format) + self.game_env_format.index(feature)
+             for feature in ('hitstop', 'hitstun', 'blockstun')]
+            for player_idx in [0, 1]
+        ]
+
+        # column indices, one hot lookups and clip bounds are compiled once
+        # with incremental_decoding only the features that changed since the last frame are encoded again
+        self.observation_encoder = ObservationEncoder(
+            game_env_format=self.game_env_format,
+            game_env_player_features=self.game_env_player_features,
+            feature_mapping=self.feature_mapping,
+            categorical_encoding=self.categorical_encoding,
+            incremental=incremental_decoding,
+        )
+
         self.wait_for_game_env_update()  # read the game state
 
-    def wait_for_game_env_update(self):
-        last_timestamp = 0
+    def wait_for_game_env_update(self, timeout: float = None) -> bool:
+        self.game_env_transport.rewind()
+        game_state = self.wait_strategy.wait(
+            self.poll_game_env_update, frame_time=lambda: self.game_env_transport.frame_time, timeout=timeout)
+        if game_state is None:
+            return False
+        self.current_game_state = game_state
+        return True
 
-        while True:
-            current_timestamp = os.path.getmtime(game_env_buffer_path)
-            if current_timestamp != last_timestamp:
-                self.game_env_buffer.seek(0)
-                current_content = self.game_env_buffer.readline().strip().split(",")
-                self.current_game_env_frame = current_content[0]
-                if self.current_game_env_frame != self.last_game_env_frame:
-                    expected_length = (len(self.game_env_format) * 2) + 1
-                    if len(current_content) == expected_length:
-                        self.current_game_state = current_content
-                        return  # Exit after processing the new game state
-                    else:
-                        warnings.warn(
-                            f"Invalid game state length expected={expected_length} actual={len(current_content)}")
+    def poll_game_env_update(self):
+        current_content = self.game_env_transport.poll()
+        if current_content is None:
+            return None
+
+        self.current_game_env_frame = current_content[0]
+        if self.current_game_env_frame == self.last_game_env_frame:
+            return None
+
+        if len(current_content) != self.game_env_length and len(current_content) != self.game_env_length + 1:
+            self.invalid_frames += 1
+            warnings.warn(
+                f"Invalid game state length expected={self.game_env_length} actual={len(current_content)}")
+            return None
+
+        return current_content
 
     def get_player_features(self, player_idx: int) -> List[str]:
         # calculate slice indices for this player's features
@@ -112,38 +200,106 @@ class SF6GameState:
 
         return player_hitstop
 
-    def get_current_game_state(self) -> Dict[str, np.array]:
-        player_features = {}
-
-        for player_id in [0, 1]:
-            # if the player's features should be captured
-            if player_id in self.game_env_player_features:
-                player_vals = self.get_player_features(player_id)
-
-                # iterate through the list of features to be captured for this player
-                for feature_name in self.game_env_player_features[player_id]:
-                    # find index of this feature
-                    feature_index = self.game_env_format.index(feature_name)
-
-                    # get the feature value
-                    feature_value = player_vals[feature_index]
-
-                    # encode the feature
-                    encoded_feature = self.encode_feature(
-                        p_idx=player_id,
-                        feature=feature_name,
-                        value=feature_value)
+    def can_act(self, player_idx: int = 0) -> bool:
+        # inputs do nothing while frozen in hitstop or locked in hitstun or blockstun,
+        # a frame missing the values counts as able to act like in get_hitstop and in_stun
+        try:
+            hitstop, hitstun, blockstun = (int(self.current_game_state[column])
+                                           for column in self.act_columns[player_idx])
+        except (IndexError, ValueError):
+            return True
+        return hitstop == 0 and hitstun <= 0 and blockstun <= 0
 
-                    player_features[f"{player_id}_{feature_name}"] = encoded_feature
+    def get_current_game_state(self) -> Dict[str, np.array]:
+        # the returned arrays are views of the encoder buffer and are overwritten by the next call
+        return self.observation_encoder.encode(self.current_game_state)
 
-        return player_features
+    def get_current_game_state_flat(self, out: np.ndarray):
+        # flat float32 encoding, see ObservationEncoder.flat_layout
+        self.observation_encoder.encode_flat(self.current_game_state, out)
 
     def send_actions(self, actions: list):
         action_status = [str(self.current_game_env_frame)] + list(actions) + [0]
 
         self.write_action_status(action_status)
 
+    def get_reset_ack(self):
+        # id of the last reset request the game side finished, None if it does not send acknowledgements
+        if len(self.current_game_state) <= self.game_env_length:
+            return None
+        return int(self.current_game_state[self.game_env_length])
+
     def send_reset(self):
+        # sends one reset request and answers frames with it until a frame acknowledges the request id,
+        # the game side presses the reset key itself and acknowledges once the round is live
+        if not self.start_reset():
+            self.send_legacy_reset()
+            return
+        while not self.poll_reset(timeout=self.reset_timeout):
+            pass
+
+    def start_reset(self) -> bool:
+        # non blocking send_reset, poll_reset() answers the frames until the round is live so the resets of several
+        # games can run together, False when the game side has no reset handshake and send_reset is needed
+        if self.get_reset_ack() is None:
+            return False
+        self.reset_start = time.perf_counter()
+        self.reset_attempt = 0
+        self.reset_frame_count = 0
+        self.send_reset_request()
+        return True
+
+    def send_reset_request(self):
+        self.reset_request_id += 1
+        self.reset_attempt_start = time.perf_counter()
+        self.write_action_line(f"{self.current_game_env_frame}{self.reset_line}{self.reset_request_id}")
+
+    def poll_reset(self, timeout: float = 0.0) -> bool:
+        # waits at most timeout seconds for a frame, True once a frame acknowledges the reset request
+        # an attempt that is not acknowledged within reset_timeout is resent with a new id up to reset_retries times
+        remaining = self.reset_timeout - (time.perf_counter() - self.reset_attempt_start)
+        if remaining <= 0:
+            if self.reset_attempt >= self.reset_retries:
+                self.reset_timeout_count += 1
+                raise TimeoutError(f"Reset request {self.reset_request_id} was not acknowledged after "
+                                   f"{self.reset_retries + 1} attempts of {self.reset_timeout}s.")
+            self.reset_attempt += 1
+            self.reset_retry_count += 1
+            self.send_reset_request()
+            return False
+        if not self.wait_for_game_env_update(timeout=min(timeout, remaining)):
+            return False
+        self.reset_frame_count += 1
+        if self.get_reset_ack() == self.reset_request_id:
+            self.reset_latencies.append(time.perf_counter() - self.reset_start)
+            self.reset_frames.append(self.reset_frame_count)
+            self.reset_count += 1
+            return True
+        self.write_action_line(f"{self.current_game_env_frame}{self.reset_line}{self.reset_request_id}")
+        return False
+
+    def get_reset_stats(self) -> dict:
+        stats = {
+            "resets": self.reset_count,
+            "retries": self.reset_retry_count,
+            "timeouts": self.reset_timeout_count,
+        }
+        if len(self.reset_latencies) > 0:
+            latencies = np.asarray(self.reset_latencies, dtype=np.float64) * 1e3
+            stats.update({
+                "reset_latency_p50_ms": float(np.percentile(latencies, 50)),
+                "reset_latency_p99_ms": float(np.percentile(latencies, 99)),
+                "reset_latency_max_ms": float(latencies.max()),
+                "reset_frames_mean": float(np.mean(self.reset_frames)),
+            })
+        return stats
+
+    def get_decode_stats(self, clear: bool = False) -> dict:
+        # reused features per frame of incremental_decoding
+        return self.observation_encoder.decode_stats(clear=clear)
+
+    def send_legacy_reset(self):
+        # game side scripts without the reset handshake, toggles the reset key until hp reads as reset
         state_features = self.current_game_state[1:]
         p_0_health = int(state_features[self.game_env_format.index('current_HP')])
         p_1_health = int(state_features[self.game_env_format.index('current_HP')+len(self.game_env_format)])
@@ -175,10 +331,16 @@ class SF6GameState:
             p_0_health = int(state_features[self.game_env_format.index('current_HP')])
             p_1_health = int(state_features[self.game_env_format.index('current_HP') + len(self.game_env_format)])
 
+    def send_action_line(self, action_line: str):
+        # action_line is a pre-encoded ",<keys>,0" tail from action_spaces.ActionTable
+        self.write_action_line(f"{self.current_game_env_frame}{action_line}")
+
     def write_action_status(self, action_status: list):
-        action_status = ','.join(map(str, action_status))
+        self.write_action_line(','.join(map(str, action_status)))
+
+    def write_action_line(self, action_line: str):
         self.action_event_buffer.seek(0)  # start of file
-        self.action_event_buffer.write(action_status)
+        self.action_event_buffer.write(action_line)
         self.action_event_buffer.truncate()  # remove old data
         self.action_event_buffer.flush()  # flush
         self.last_game_env_frame = self.current_game_env_frame
@@ -186,7 +348,11 @@ class SF6GameState:
     def encode_feature(self, p_idx: int, feature: str, value: str) -> np.array:
         if feature in self.feature_mapping[p_idx]:
             feature_map, dtype = self.feature_mapping[p_idx][feature]
-            if type(feature_map) == dict:
+            if type(feature_map) == dict and self.categorical_encoding == 'index':
+                if value not in feature_map:
+                    warnings.warn(f"Invalid mapping value:{value} for feature:{feature}.")
+                return np.array([feature_map.get(value, len(feature_map))], dtype=dtype)
+            elif type(feature_map) == dict:
                 # create a numpy array to one hot encode feature
                 arr = np.zeros(len(feature_map), dtype=dtype)
 
@@ -0,0 +1,236 @@
+import argparse
+import json
+from typing import Dict, Union
+
+import numpy as np
+
+# a policy exported by export_policy is one npz file: the json meta under 'meta' and every array by name
+# NumpyPolicy only needs numpy, torch and stable baselines3 are only imported to export a checkpoint
+# box observations (flat mode) are handled as a dict with the single key box_key
+box_key = "obs"
+activations = {
+    'Tanh': np.tanh,
+    'ReLU': lambda x: np.maximum(x, 0),
+    'Identity': lambda x: x,
+}
+
+
+class NumpyPolicy:
+    # deterministic actions of an exported PPO policy for raw SF6AgentEnv observations
+    # frames are stacked and normalized as VecFrameStack and VecNormalize did in training, call reset(env_idx)
+    # at the start of every episode of that env
+    def __init__(self, path: str, env_num: int = 1):
+        with np.load(path) as data:
+            self.meta = json.loads(str(data['meta']))
+            self.arrays = {name: data[name] for name in data.files if name != 'meta'}
+
+        self.frame_stack = self.meta['frame_stack']
+        self.is_dict = self.meta['is_dict']
+        self.frame_sizes = self.meta['frame_sizes']
+        self.clip_obs = self.meta['clip_obs']
+        self.epsilon = self.meta['epsilon']
+
+        # the last frames are kept frame major in one buffer so a step only shifts it once, stacked_index
+        # gathers it into the key major layout of VecFrameStack (every key holds its frames oldest first)
+        self.frame_offsets = {}
+        offset = 0
+        for key, size in self.frame_sizes.items():
+            self.frame_offsets[key] = offset
+            offset += size
+        self.frame_size = offset
+        self.stacked_offsets = {}
+        stacked_index = []
+        for key, size in self.frame_sizes.items():
+            self.stacked_offsets[key] = len(stacked_index)
+            for frame in range(self.frame_stack):
+                start = frame * self.frame_size + self.frame_offsets[key]
+                stacked_index.extend(range(start, start + size))
+        self.stacked_index = np.asarray(stacked_index, dtype=np.int64)
+
+        # normalization of every normalized key in the stacked layout, other keys pass through unchanged
+        stacked_size = len(self.stacked_index)
+        self.normalize_mean = np.zeros(stacked_size, dtype=np.float32)
+        self.normalize_scale = np.ones(stacked_size, dtype=np.float32)
+        self.normalize_low = np.full(stacked_size, -np.inf, dtype=np.float32)
+        self.normalize_high = np.full(stacked_size, np.inf, dtype=np.float32)
+        for key in self.meta['normalized_keys']:
+            start = self.stacked_offsets[key]
+            end = start + self.frame_sizes[key] * self.frame_stack
+            self.normalize_mean[start:end] = self.arrays[f"obs_rms/{key}/mean"].reshape(-1)
+            self.normalize_scale[start:end] = 1 / np.sqrt(self.arrays[f"obs_rms/{key}/var"].reshape(-1) + self.epsilon)
+            self.normalize_low[start:end] = -self.clip_obs
+            self.normalize_high[start:end] = self.clip_obs
+        self.normalize = len(self.meta['normalized_keys']) > 0
+
+        # (start, end, embedding table or None) slices of the stacked observation in features extractor order
+        self.segments = []
+        for key, size in self.frame_sizes.items():
+            start = self.stacked_offsets[key]
+            end = start + size * self.frame_stack
+            table = self.arrays[f"embedding/{key}"] if key in self.meta['embedding_keys'] else None
+            if table is None and self.segments and self.segments[-1][2] is None:
+                self.segments[-1] = (self.segments[-1][0], end, None)
+            else:
+                self.segments.append((start, end, table))
+
+        self.layers = [(self.arrays[f"policy_net/{i}/weight"].T.copy(), self.arrays[f"policy_net/{i}/bias"],
+                        activations[activation]) for i, activation in enumerate(self.meta['activations'])]
+        self.action_weight = self.arrays['action_net/weight'].T.copy()
+        self.action_bias = self.arrays['action_net/bias']
+
+        self.frames = None
+        self.reset_all(env_num)
+
+    def reset_all(self, env_num: int = None):
+        env_num = len(self.frames) if env_num is None else env_num
+        self.frames = np.zeros((env_num, self.frame_stack, self.frame_size), dtype=np.float32)
+
+    def reset(self, env_idx: int = 0):
+        self.frames[env_idx] = 0
+
+    def push(self, observations: Dict[str, np.ndarray]) -> np.ndarray:
+        # newest frame last like VecFrameStack, returns the stacked observations of every env
+        if self.frame_stack > 1:
+            self.frames[:, :-1] = self.frames[:, 1:]
+        frame = self.frames[:, -1]
+        env_num = len(frame)
+        for key, offset in self.frame_offsets.items():
+            size = self.frame_sizes[key]
+            frame[:, offset:offset + size] = observations[key].reshape(env_num, size)
+        return self.frames.reshape(env_num, -1)[:, self.stacked_index]
+
+    def stacked_observations(self) -> Dict[str, np.ndarray]:
+        # the stacked observations of the last push as VecFrameStack returns them
+        stacked = self.frames.reshape(len(self.frames), -1)[:, self.stacked_index]
+        return {key: stacked[:, start:start + self.frame_sizes[key] * self.frame_stack]
+                for key, start in self.stacked_offsets.items()}
+
+    def features(self, stacked: np.ndarray) -> np.ndarray:
+        x = stacked
+        if self.normalize:
+            x = np.clip((x - self.normalize_mean) * self.normalize_scale, self.normalize_low, self.normalize_high)
+        if len(self.segments) == 1 and self.segments[0][2] is None:
+            return x
+        encoded = []
+        for start, end, table in self.segments:
+            if table is None:
+                encoded.append(x[:, start:end])
+            else:
+                # indices are never normalized
+                encoded.append(table[stacked[:, start:end].astype(np.int64)].reshape(len(x), -1))
+        return np.concatenate(encoded, axis=1)
+
+    def logits(self, observations: Union[Dict[str, np.ndarray], np.ndarray]) -> np.ndarray:
+        # observations of every env with a leading env axis, pushed onto the frame stacks
+        if not self.is_dict:
+            observations = {box_key: observations}
+        x = self.features(self.push(observations))
+        for weight, bias, activation in self.layers:
+            x = activation(x @ weight + bias)
+        return x @ self.action_weight + self.action_bias
+
+    def predict_batch(self, observations: Union[Dict[str, np.ndarray], np.ndarray]) -> np.ndarray:
+        return np.argmax(self.logits(observations), axis=1)
+
+    def predict(self, observation: Union[Dict[str, np.ndarray], np.ndarray]) -> int:
+        # single env policies, the observation of one env without the env axis
+        if not self.is_dict:
+            observation = observation[None]
+        else:
+            observation = {key: value[None] for key, value in observation.items()}
+        return int(self.predict_batch(observation)[0])
+
+
+def export_policy(model_path: str, output_path: str, vec_normalize_path: str = None, frame_stack: int = 1) -> dict:
+    # frame_stack is the n_stack of the VecFrameStack used in training, 1 for flat observations
+    import pickle
+
+    import torch as th
+    from gymnasium import spaces
+    from stable_baselines3 import PPO
+
+    from sf6_feature_extractors import EmbeddingFeatureExtractor
+
+    model = PPO.load(model_path, device='cpu')
+    policy = model.policy
+    if not isinstance(model.action_space, spaces.Discrete):
+        raise TypeError(f"Only discrete action spaces can be exported, got {model.action_space}.")
+    if not policy.share_features_extractor:
+        raise ValueError("Only policies sharing the features extractor can be exported.")
+
+    arrays = {}
+    observation_space = model.observation_space
+    is_dict = isinstance(observation_space, spaces.Dict)
+    if is_dict:
+        # in the order of the features extractor
+        stacked_sizes = {key: int(np.prod(subspace.shape)) for key, subspace in observation_space.spaces.items()}
+    else:
+        stacked_sizes = {box_key: int(np.prod(observation_space.shape))}
+    for key, size in stacked_sizes.items():
+        if size % frame_stack != 0:
+            raise ValueError(f"Observation {key} of size {size} was not stacked {frame_stack} times.")
+    frame_sizes = {key: size // frame_stack for key, size in stacked_sizes.items()}
+
+    embedding_keys = []
+    if isinstance(policy.features_extractor, EmbeddingFeatureExtractor):
+        for key, embedding in policy.features_extractor.embeddings.items():
+            arrays[f"embedding/{key}"] = embedding.weight.detach().numpy().astype(np.float32)
+            embedding_keys.append(key)
+
+    normalized_keys = []
+    clip_obs = np.inf
+    epsilon = 1e-8
+    if vec_normalize_path is not None:
+        with open(vec_normalize_path, 'rb') as f:
+            vec_normalize = pickle.load(f)
+        if vec_normalize.norm_obs:
+            clip_obs = float(vec_normalize.clip_obs)
+            epsilon = float(vec_normalize.epsilon)
+            if not is_dict:
+                normalized_keys = [box_key]
+                obs_rms = {box_key: vec_normalize.obs_rms}
+            else:
+                normalized_keys = list(vec_normalize.norm_obs_keys)
+                obs_rms = vec_normalize.obs_rms
+            for key in normalized_keys:
+                arrays[f"obs_rms/{key}/mean"] = np.asarray(obs_rms[key].mean, dtype=np.float64)
+                arrays[f"obs_rms/{key}/var"] = np.asarray(obs_rms[key].var, dtype=np.float64)
+
+    activation_names = []
+    layers = list(policy.mlp_extractor.policy_net)
+    linear_layers = [layer for layer in layers if isinstance(layer, th.nn.Linear)]
+    for i, linear in enumerate(linear_layers):
+        arrays[f"policy_net/{i}/weight"] = linear.weight.detach().numpy().astype(np.float32)
+        arrays[f"policy_net/{i}/bias"] = linear.bias.detach().numpy().astype(np.float32)
+        position = layers.index(linear)
+        activation = layers[position + 1] if position + 1 < len(layers) else th.nn.Identity()
+        if type(activation).__name__ not in activations:
+            raise TypeError(f"Unsupported activation {type(activation).__name__}.")
+        activation_names.append(type(activation).__name__)
+    arrays['action_net/weight'] = policy.action_net.weight.detach().numpy().astype(np.float32)
+    arrays['action_net/bias'] = policy.action_net.bias.detach().numpy().astype(np.float32)
+
+    meta = {
+        "frame_stack": frame_stack,
+        "is_dict": is_dict,
+        "frame_sizes": frame_sizes,
+        "embedding_keys": embedding_keys,
+        "normalized_keys": normalized_keys,
+        "clip_obs": clip_obs,
+        "epsilon": epsilon,
+        "activations": activation_names,
+    }
+    np.savez(output_path, meta=np.asarray(json.dumps(meta)), **arrays)
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a PPO checkpoint to a numpy policy.")
+    parser.add_argument('model_path')
+    parser.add_argument('output_path')
+    parser.add_argument('--vec-normalize', default=None, help="VecNormalize statistics saved with the checkpoint")
+    parser.add_argument('--frame-stack', type=int, default=1, help="n_stack of VecFrameStack, 1 for flat observations")
+    args = parser.parse_args()
+
+    print(export_policy(args.model_path, args.output_path, vec_normalize_path=args.vec_normalize,
+                        frame_stack=args.frame_stack))
@@ -0,0 +1,388 @@
+import operator
+import warnings
+from typing import Dict, List
+
+import numpy as np
+
+
+def parse_row(row: List[str], out: np.ndarray) -> np.ndarray:
+    # float values of a split frame row, values that do not parse are nan and encoded like encode() encodes them
+    try:
+        out[:] = row
+    except ValueError:
+        for i, value in enumerate(row):
+            try:
+                out[i] = float(value)
+            except ValueError:
+                warnings.warn(f"Invalid value:{value} in column:{i}.")
+                out[i] = np.nan
+    return out
+
+
+class ObservationEncoder:
+    # compiled once from the game env format and the feature mappings of state_spaces
+    # encode() writes every feature into one preallocated buffer and returns views of it,
+    # the views are overwritten by the next encode() so copy them to keep an observation
+    # with categorical_encoding='index' dict features are encoded as the index of the value instead of one hot
+    # with incremental=True the raw values of the last frame are kept and only the features whose raw value
+    # changed are encoded again, the others keep their encoding in the buffer, see decode_stats()
+    def __init__(self, game_env_format: List[str], game_env_player_features: Dict[int, List[str]],
+                 feature_mapping: Dict[int, dict], categorical_encoding: str = 'one_hot', incremental: bool = False):
+        self.game_env_format = game_env_format
+        self.categorical_encoding = categorical_encoding
+        self.incremental = incremental
+        self.keys = []
+        self.one_hot_features = []  # (key, column, value -> slot lookup, view)
+        self.index_features = []  # (key, column, value -> index lookup, missing value index, view)
+        self.continuous_features = []  # (key, column, converter, low, high, view)
+        self.feature_columns = {}
+        self.feature_dtypes = {}
+        self.feature_sizes = {}
+
+        layout = []
+        offset = 0
+        for player_id in [0, 1]:
+            if player_id not in game_env_player_features:
+                continue
+            for feature_name in game_env_player_features[player_id]:
+                if feature_name not in feature_mapping[player_id]:
+                    raise KeyError(f"{feature_name} not found in feature mapping.")
+                feature_map, dtype = feature_mapping[player_id][feature_name]
+                dtype = np.dtype(dtype)
+                if type(feature_map) == dict:
+                    size = 1 if categorical_encoding == 'index' else len(feature_map)
+                elif type(feature_map) == list:
+                    size = 1
+                else:
+                    raise TypeError(f"No encoding {feature_name} for this type {type(feature_map)}.")
+
+                key = f"{player_id}_{feature_name}"
+                offset = -(-offset // dtype.itemsize) * dtype.itemsize  # align to the feature dtype
+                layout.append((key, player_id, feature_name, feature_map, dtype, size, offset))
+                offset += size * dtype.itemsize
+
+        self.buffer = np.zeros(offset, dtype=np.uint8)
+        self.views = {}
+
+        for key, player_id, feature_name, feature_map, dtype, size, offset in layout:
+            view = self.buffer[offset:offset + size * dtype.itemsize].view(dtype)
+            column = 1 + player_id * len(game_env_format) + game_env_format.index(feature_name)
+            self.keys.append(key)
+            self.views[key] = view
+            self.feature_columns[key] = column
+            self.feature_dtypes[key] = dtype
+            self.feature_sizes[key] = size
+
+            if type(feature_map) == dict and categorical_encoding == 'index':
+                self.index_features.append((key, column, dict(feature_map), len(feature_map), view))
+            elif type(feature_map) == dict:
+                self.one_hot_features.append((key, column, dict(feature_map), view))
+            else:
+                converter = float if np.issubdtype(dtype, np.floating) else int
+                low = converter(feature_map[0])
+                high = converter(feature_map[1])
+                self.continuous_features.append((key, column, converter, low, high, view))
+
+        # slot of each one hot feature that is currently set, only that slot needs clearing on the next frame
+        self.one_hot_slots = [None] * len(self.one_hot_features)
+
+        # flat float32 layout used by encode_flat, continuous features first so they form one slice
+        # only built for one hot encoding, index features are not part of it
+        # flat_layout maps every key to its (offset, size) in the flat vector
+        self.flat_layout = {}
+        offset = 0
+        self.flat_continuous_features = []  # (key, column, converter, low, high, offset)
+        for key, column, converter, low, high, _ in self.continuous_features:
+            self.flat_layout[key] = (offset, 1)
+            self.flat_continuous_features.append((key, column, converter, low, high, offset))
+            offset += 1
+        self.flat_continuous_size = offset
+        self.flat_one_hot_features = []  # (key, column, value -> flat index lookup)
+        for key, column, lookup, _ in self.one_hot_features:
+            self.flat_layout[key] = (offset, len(lookup))
+            self.flat_one_hot_features.append((key, column, {value: offset + slot for value, slot in lookup.items()}))
+            offset += len(lookup)
+        self.flat_size = offset
+        self.flat_low = np.zeros(self.flat_size, dtype=np.float32)
+        self.flat_high = np.ones(self.flat_size, dtype=np.float32)
+        for _, _, _, low, high, offset in self.flat_continuous_features:
+            self.flat_low[offset] = low
+            self.flat_high[offset] = high
+
+        self.batch_lookups = {}  # dense int lookup tables used by encode_batch, built on first use
+
+        # incremental decoding: raw values of every feature in one_hot, index, continuous order read with one
+        # itemgetter call, the last values of encode() and encode_flat() are kept apart as they fill other buffers
+        self.feature_count = len(self.one_hot_features) + len(self.index_features) + len(self.continuous_features)
+        columns = [feature[1] for feature in self.one_hot_features + self.index_features + self.continuous_features]
+        self.get_values = operator.itemgetter(*columns) if len(columns) > 1 else lambda row: (row[columns[0]],)
+        self.last_values = None
+        self.last_flat_values = None
+        self.flat_cache = np.zeros(self.flat_size, dtype=np.float32)
+        self.flat_one_hot_indices = [None] * len(self.flat_one_hot_features)
+        # reused_counts[n] is the number of frames where n features were reused
+        self.reused_counts = np.zeros(self.feature_count + 1, dtype=np.int64)
+
+    def reset_incremental(self):
+        # the next frame is encoded completely
+        self.last_values = None
+        self.last_flat_values = None
+
+    def decode_stats(self, clear: bool = False) -> dict:
+        # share of features per frame that were reused instead of encoded again
+        frames = int(self.reused_counts.sum())
+        stats = {"frames": frames, "features": self.feature_count}
+        if frames > 0:
+            hit_rates = np.arange(self.feature_count + 1) / max(self.feature_count, 1)
+            cumulative = np.cumsum(self.reused_counts) / frames
+            stats.update({
+                "hit_rate_mean": float((self.reused_counts * hit_rates).sum() / frames),
+                "hit_rate_p10": float(hit_rates[np.searchsorted(cumulative, 0.1)]),
+                "hit_rate_p50": float(hit_rates[np.searchsorted(cumulative, 0.5)]),
+                "unchanged_frames": float(self.reused_counts[-1] / frames),
+            })
+        if clear:
+            self.reused_counts[:] = 0
+        return stats
+
+    def encode(self, game_state: List[str]) -> Dict[str, np.ndarray]:
+        if self.incremental:
+            return self.encode_changed(game_state)
+        for i, (key, column, lookup, view) in enumerate(self.one_hot_features):
+            last_slot = self.one_hot_slots[i]
+            if last_slot is not None:
+                view[last_slot] = 0
+
+            value = game_state[column]
+            slot = lookup.get(value)
+            if slot is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+            else:
+                view[slot] = 1
+            self.one_hot_slots[i] = slot
+
+        for key, column, lookup, missing, view in self.index_features:
+            value = game_state[column]
+            index = lookup.get(value)
+            if index is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+                index = missing
+            view[0] = index
+
+        for key, column, converter, low, high, view in self.continuous_features:
+            value = game_state[column]
+            try:
+                value = converter(value)
+            except ValueError:
+                print(f"feature={key.split('_', 1)[1]} value={value}")
+                value = 0
+            view[0] = low if value < low else high if value > high else value
+
+        return self.views
+
+    def encode_changed(self, game_state: List[str]) -> Dict[str, np.ndarray]:
+        # encode() of the features whose raw value changed since the last frame
+        values = self.get_values(game_state)
+        last_values = self.last_values
+        self.last_values = values
+        if last_values is None:
+            last_values = (None,) * self.feature_count
+        elif values == last_values:
+            self.reused_counts[-1] += 1
+            return self.views
+        reused = 0
+
+        for i, (key, column, lookup, view) in enumerate(self.one_hot_features):
+            value = values[i]
+            if value == last_values[i]:
+                reused += 1
+                continue
+            last_slot = self.one_hot_slots[i]
+            if last_slot is not None:
+                view[last_slot] = 0
+            slot = lookup.get(value)
+            if slot is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+            else:
+                view[slot] = 1
+            self.one_hot_slots[i] = slot
+
+        i = len(self.one_hot_features)
+        for key, column, lookup, missing, view in self.index_features:
+            value = values[i]
+            i += 1
+            if value == last_values[i - 1]:
+                reused += 1
+                continue
+            index = lookup.get(value)
+            if index is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+                index = missing
+            view[0] = index
+
+        for key, column, converter, low, high, view in self.continuous_features:
+            value = values[i]
+            i += 1
+            if value == last_values[i - 1]:
+                reused += 1
+                continue
+            try:
+                value = converter(value)
+            except ValueError:
+                print(f"feature={key.split('_', 1)[1]} value={value}")
+                value = 0
+            view[0] = low if value < low else high if value > high else value
+
+        self.reused_counts[reused] += 1
+        return self.views
+
+    def encode_flat_changed(self, game_state: List[str], out: np.ndarray):
+        # encode_flat() of the changed features into flat_cache, copied to out as out holds an older frame
+        values = self.get_values(game_state)
+        last_values = self.last_flat_values
+        self.last_flat_values = values
+        if last_values is None:
+            last_values = (None,) * self.feature_count
+        elif values == last_values:
+            self.reused_counts[-1] += 1
+            out[:self.flat_size] = self.flat_cache
+            return
+        cache = self.flat_cache
+        reused = 0
+
+        # flat features are the continuous features then the one hot features
+        i = len(self.one_hot_features) + len(self.index_features)
+        for key, column, converter, low, high, offset in self.flat_continuous_features:
+            value = values[i]
+            i += 1
+            if value == last_values[i - 1]:
+                reused += 1
+                continue
+            try:
+                value = converter(value)
+            except ValueError:
+                print(f"feature={key.split('_', 1)[1]} value={value}")
+                value = 0
+            cache[offset] = low if value < low else high if value > high else value
+
+        for i, (key, column, lookup) in enumerate(self.flat_one_hot_features):
+            value = values[i]
+            if value == last_values[i]:
+                reused += 1
+                continue
+            last_index = self.flat_one_hot_indices[i]
+            if last_index is not None:
+                cache[last_index] = 0
+            index = lookup.get(value)
+            if index is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+            else:
+                cache[index] = 1
+            self.flat_one_hot_indices[i] = index
+
+        self.reused_counts[reused] += 1
+        out[:self.flat_size] = cache
+
+    def encode_flat(self, game_state: List[str], out: np.ndarray):
+        # writes the frame into out[:flat_size] as float32, out is not cleared between frames by the caller
+        if self.index_features:
+            raise ValueError("encode_flat needs categorical_encoding='one_hot'.")
+        if self.incremental:
+            self.encode_flat_changed(game_state, out)
+            return
+        for key, column, converter, low, high, offset in self.flat_continuous_features:
+            value = game_state[column]
+            try:
+                value = converter(value)
+            except ValueError:
+                print(f"feature={key.split('_', 1)[1]} value={value}")
+                value = 0
+            out[offset] = low if value < low else high if value > high else value
+
+        out[self.flat_continuous_size:self.flat_size] = 0
+        for key, column, lookup in self.flat_one_hot_features:
+            value = game_state[column]
+            index = lookup.get(value)
+            if index is None:
+                warnings.warn(f"Invalid mapping value:{value} for feature:{key.split('_', 1)[1]}.")
+            else:
+                out[index] = 1
+
+    def get_batch_lookup(self, key: str, lookup: dict):
+        if key not in self.batch_lookups:
+            raw_values = np.array([int(value) for value in lookup.keys()], dtype=np.int64)
+            slots = np.array(list(lookup.values()), dtype=np.int64)
+            table = np.full(raw_values.max() - raw_values.min() + 1, -1, dtype=np.int64)
+            table[raw_values - raw_values.min()] = slots
+            self.batch_lookups[key] = (int(raw_values.min()), table)
+        return self.batch_lookups[key]
+
+    def encode_batch(self, game_states) -> Dict[str, np.ndarray]:
+        # encodes N raw frames at once, game_states is a (N, columns) array or a list of split rows
+        # values that do not parse (nan in a float array) are unmapped for dict features and 0 for the others
+        game_states = np.asarray(game_states)
+        if game_states.dtype.kind in 'US':
+            # only parse the columns that are encoded
+            columns = sorted(self.feature_columns.values())
+            parsed = np.zeros(game_states.shape, dtype=np.float64)
+            try:
+                parsed[:, columns] = game_states[:, columns].astype(np.float64)
+            except ValueError:
+                for row, game_state in zip(parsed, game_states):
+                    row[columns] = parse_row(game_state[columns], np.zeros(len(columns), dtype=np.float64))
+            game_states = parsed
+        frame_count = game_states.shape[0]
+        rows = np.arange(frame_count)
+        encoded = {}
+
+        for key, column, lookup, _ in self.one_hot_features:
+            arr = np.zeros((frame_count, self.feature_sizes[key]), dtype=self.feature_dtypes[key])
+            min_value, table = self.get_batch_lookup(key, lookup)
+            index = np.nan_to_num(game_states[:, column], nan=min_value - 1).astype(np.int64) - min_value
+            in_table = (index >= 0) & (index < len(table))
+            slots = np.full(frame_count, -1, dtype=np.int64)
+            slots[in_table] = table[index[in_table]]
+            valid = slots >= 0
+            arr[rows[valid], slots[valid]] = 1
+            encoded[key] = arr
+
+        for key, column, lookup, missing, _ in self.index_features:
+            min_value, table = self.get_batch_lookup(key, lookup)
+            index = np.nan_to_num(game_states[:, column], nan=min_value - 1).astype(np.int64) - min_value
+            in_table = (index >= 0) & (index < len(table))
+            indices = np.full(frame_count, missing, dtype=np.int64)
+            indices[in_table] = table[index[in_table]]
+            indices[indices < 0] = missing
+            encoded[key] = indices.astype(self.feature_dtypes[key]).reshape(frame_count, 1)
+
+        for key, column, _, low, high, _ in self.continuous_features:
+            values = np.nan_to_num(game_states[:, column], nan=0.0).astype(self.feature_dtypes[key])
+            encoded[key] = np.clip(values, low, high).reshape(frame_count, 1)
+
+        return encoded
+
+
+class FrameStackBuffer:
+    # ring of the last frame_stack flat frames, every frame is written twice (slot and slot + frame_stack)
+    # so the stacked frames oldest first are always one contiguous slice and push() returns a view of it
+    # the next frame is written into the slot of the oldest frame, so the view is only valid until then
+    def __init__(self, frame_size: int, frame_stack: int, dtype=np.float32):
+        self.frame_size = frame_size
+        self.frame_stack = frame_stack
+        self.buffer = np.zeros((2 * frame_stack, frame_size), dtype=dtype)
+        self.position = 0
+
+    @property
+    def frame(self) -> np.ndarray:
+        # slot the next frame is encoded into
+        return self.buffer[self.position]
+
+    def push(self) -> np.ndarray:
+        position = self.position
+        self.buffer[position + self.frame_stack] = self.buffer[position]
+        self.position = (position + 1) % self.frame_stack
+        return self.buffer[position + 1:position + 1 + self.frame_stack].reshape(-1)
+
+    def clear(self):
+        self.buffer[:] = 0
+        self.position = 0
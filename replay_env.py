@@ -0,0 +1,94 @@
+import gymnasium as gym
+import numpy as np
+from gymnasium import spaces
+from typing import Dict, Any, Tuple
+
+from episode_dataset import EpisodeDataset
+from sf6_agent_env import agent_features, create_observation_space
+
+
+class ReplayEnv(gym.Env):
+    # replays episodes of an EpisodeDataset with the spaces of SF6AgentEnv, no game needed
+    # the action passed to step is ignored, the recorded action is returned in info
+    # categorical_encoding has to be the encoding the dataset was recorded and built with
+    def __init__(self, dataset_path, characters, action_space_mapping=None, keep_prev_action=True, shuffle=False,
+                 categorical_encoding='one_hot'):
+        super().__init__()
+        if action_space_mapping is None:
+            raise Exception("No action space mapping defined.")
+
+        self.action_space_size = len(action_space_mapping)
+        self.action_space = spaces.Discrete(self.action_space_size)
+        self.observation_space = create_observation_space(
+            characters=characters,
+            features=agent_features,
+            action_space_size=self.action_space_size,
+            keep_prev_action=keep_prev_action,
+            categorical_encoding=categorical_encoding,
+        )
+
+        self.dataset = EpisodeDataset(dataset_path)
+        missing = set(self.observation_space.spaces) - set(self.dataset.observation_keys)
+        if missing:
+            raise KeyError(f"Dataset {dataset_path} has no columns for {sorted(missing)}.")
+        dataset_encoding = self.dataset.meta.get('categorical_encoding', 'one_hot')
+        if dataset_encoding != categorical_encoding:
+            raise ValueError(f"Dataset {dataset_path} was built with categorical_encoding={dataset_encoding}, "
+                             f"got {categorical_encoding}.")
+        for key, space in self.observation_space.spaces.items():
+            column = self.dataset.meta['columns'][f"obs/{key}"]
+            if np.dtype(column['dtype']) != space.dtype or tuple(column['shape']) != space.shape:
+                raise ValueError(f"Dataset {dataset_path} column {key} is {np.dtype(column['dtype'])}"
+                                 f"{tuple(column['shape'])}, the observation space expects {space.dtype}{space.shape}.")
+        # an episode needs a first observation and at least one transition, 1 row episodes are never replayed
+        self.playable_episodes = np.flatnonzero(self.dataset.episodes[:, 1] >= 2)
+        if len(self.playable_episodes) == 0:
+            raise ValueError(f"Dataset {dataset_path} has no episodes with at least 2 rows.")
+
+        self.shuffle = shuffle
+        self.episode = -1
+        self.episode_start = 0
+        self.episode_length = 0
+        self.offset = 0
+        self.total_steps = 0
+
+    def _get_obs(self) -> Dict[str, np.array]:
+        row = self.episode_start + self.offset
+        return {
+            key: self.dataset.columns[f"obs/{key}"][row]
+            for key in self.observation_space.spaces
+        }
+
+    def _get_info(self) -> Dict[str, Any]:
+        row = self.episode_start + self.offset
+        return {
+            "total_steps": self.total_steps,
+            "episode": self.episode,
+            "frame": int(self.dataset.columns['frame'][row]),
+            "recorded_action": int(self.dataset.columns['action'][row]),
+        }
+
+    def step(self, action: int) -> Tuple[Dict[str, np.array], float, bool, bool, Dict[str, Any]]:
+        self.offset += 1
+        self.total_steps += 1
+        reward = float(self.dataset.columns['reward'][self.episode_start + self.offset])
+        terminated = self.offset >= self.episode_length - 1
+        return self._get_obs(), reward, terminated, False, self._get_info()
+
+    def reset(self, seed=None, options=None):
+        super().reset(seed=seed)
+        playable = self.playable_episodes
+        if options is not None and 'episode' in options:
+            self.episode = options['episode']
+            if self.dataset.episodes[self.episode, 1] < 2:
+                raise ValueError(f"Episode {self.episode} has less than 2 rows and can not be replayed.")
+        elif self.shuffle:
+            self.episode = int(playable[self.np_random.integers(len(playable))])
+        else:
+            # next playable episode after the current one
+            self.episode = int(playable[np.searchsorted(playable, self.episode, side='right') % len(playable)])
+
+        self.episode_start, self.episode_length = (int(v) for v in self.dataset.episodes[self.episode])
+        self.offset = 0
+        self.total_steps = 0
+        return self._get_obs(), self._get_info()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+from typing import Callable, Dict, List
+
+import numpy as np
+
+# raw frame values read for the reward, frame_values arrays are (..., player, feature) in this order
+reward_frame_features = ['current_HP', 'drive', 'super', 'posX', 'hitstun', 'blockstun']
+HP, DRIVE, SUPER, POS_X, HITSTUN, BLOCKSTUN = range(len(reward_frame_features))
+stage_half_width = 7.65
+
+
+# every term maps (previous, current) frame values to the reward of that transition for player 0,
+# terms only use numpy operators so the same definition scores one (2, F) frame or (N, 2, F) batches
+def hp_delta(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    # hp change of player 0 minus hp change of player 1, the reward SF6AgentEnv always used
+    change = current[..., HP] - previous[..., HP]
+    return change[..., 0] - change[..., 1]
+
+
+def drive_delta(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    change = current[..., DRIVE] - previous[..., DRIVE]
+    return change[..., 0] - change[..., 1]
+
+
+def super_delta(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    change = current[..., SUPER] - previous[..., SUPER]
+    return change[..., 0] - change[..., 1]
+
+
+def corner(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    # 1 when player 1 is in a corner and player 0 in the middle of the stage, -1 the other way around
+    distance = np.abs(current[..., POS_X])
+    return (distance[..., 1] - distance[..., 0]) / stage_half_width
+
+
+def stun(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    # hitstun and blockstun frames of player 1 minus those of player 0
+    frames = current[..., HITSTUN] + current[..., BLOCKSTUN]
+    return frames[..., 1] - frames[..., 0]
+
+
+reward_terms: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'hp_delta': hp_delta,
+    'drive_delta': drive_delta,
+    'super_delta': super_delta,
+    'corner': corner,
+    'stun': stun,
+}
+default_reward_weights = {'hp_delta': 1.0}
+
+
+def parse_reward_weights(values: List[str]) -> Dict[str, float]:
+    # ["hp_delta=1", "corner=0.1"] -> weights
+    weights = {}
+    for value in values:
+        name, weight = value.split("=", 1)
+        weights[name] = float(weight)
+    return weights
+
+
+class RewardEngine:
+    # weighted sum of reward terms, step() scores the frames of a running env and compute() whole batches
+    def __init__(self, weights: Dict[str, float] = None, game_env_format: List[str] = None):
+        self.weights = dict(default_reward_weights if weights is None else weights)
+        for name in self.weights:
+            if name not in reward_terms:
+                raise KeyError(f"Unknown reward term {name}, expected one of {sorted(reward_terms)}.")
+        self.terms = [(reward_terms[name], weight) for name, weight in self.weights.items() if weight != 0]
+
+        # columns of the reward features in a raw csv frame, only needed by step()
+        self.frame_columns = None
+        if game_env_format is not None:
+            self.frame_columns = [
+                [1 + player_id * len(game_env_format) + game_env_format.index(feature)
+                 for feature in reward_frame_features]
+                for player_id in [0, 1]
+            ]
+        self.previous = np.zeros((2, len(reward_frame_features)), dtype=np.float64)
+        self.current = np.zeros((2, len(reward_frame_features)), dtype=np.float64)
+
+    def read_frame(self, game_state: List[str], out: np.ndarray) -> np.ndarray:
+        for player_id, columns in enumerate(self.frame_columns):
+            row = out[player_id]
+            for i, column in enumerate(columns):
+                row[i] = float(game_state[column])
+        return out
+
+    def compute(self, previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+        reward = np.zeros(previous.shape[:-2], dtype=np.float64)
+        for term, weight in self.terms:
+            reward = reward + weight * term(previous, current)
+        return reward
+
+    def reset(self, game_state: List[str]):
+        self.read_frame(game_state, self.previous)
+
+    def step(self, game_state: List[str]) -> float:
+        # reward of the transition from the last frame passed to reset() or step() to this one
+        self.read_frame(game_state, self.current)
+        reward = float(self.compute(self.previous, self.current))
+        self.previous, self.current = self.current, self.previous
+        return reward
+
+    @property
+    def frame_values(self) -> np.ndarray:
+        # raw reward features of the last frame, recorded with the history for relabeling
+        return self.previous
+
+
+def relabel_rewards(frame_values: np.ndarray, episodes: np.ndarray, engine: RewardEngine, out: np.ndarray = None,
+                    chunk_size: int = 1 << 20) -> np.ndarray:
+    # rewards of every row of a dataset, row i is the transition from row i - 1 and the first row of an episode is 0
+    # matches the rewards of the env for frame_skip=1, with frame skip state terms were summed over skipped frames
+    length = len(frame_values)
+    if out is None:
+        out = np.zeros(length, dtype=np.float32)
+    for start in range(1, length, chunk_size):
+        end = min(start + chunk_size, length)
+        previous = np.asarray(frame_values[start - 1:end - 1], dtype=np.float64)
+        current = np.asarray(frame_values[start:end], dtype=np.float64)
+        out[start:end] = engine.compute(previous, current)
+    if len(episodes):
+        out[episodes[:, 0]] = 0
+    return out
+
+
+def relabel_dataset(dataset_path: str, engine: RewardEngine, column: str = 'reward') -> dict:
+    # writes the relabeled rewards of an EpisodeDataset into column, a new column is added to the derived columns
+    # of the dataset, later builds of the dataset relabel the rows they add with the same weights
+    from episode_dataset import EpisodeDataset, column_file_name, dataset_meta_file
+
+    dataset = EpisodeDataset(dataset_path)
+    if 'frame_values' not in dataset.columns:
+        raise KeyError(f"Dataset {dataset_path} has no frame_values column, rebuild it from the recorded episodes.")
+    # episodes converted from json histories or older recordings have no hitstun and blockstun values
+    if engine.weights.get('stun', 0) != 0 and np.isnan(dataset.columns['frame_values'][:, :, HITSTUN:]).any():
+        raise ValueError(f"Dataset {dataset_path} has episodes without hitstun and blockstun, the stun term can not "
+                         f"be used.")
+
+    column_path = os.path.join(dataset_path, column_file_name(column))
+    if dataset.length == 0:
+        rewards = np.zeros(0, dtype=np.float32)
+    else:
+        exists = os.path.exists(column_path) and os.path.getsize(column_path) == dataset.length * 4
+        rewards = np.memmap(column_path, dtype=np.float32, mode='r+' if exists else 'w+', shape=(dataset.length,))
+        relabel_rewards(dataset.columns['frame_values'], dataset.episodes, engine, out=rewards)
+        rewards.flush()
+
+    meta = dict(dataset.meta)
+    if column not in meta['columns']:
+        # build_dataset checks the recorded columns against the observation space, derived columns are kept apart
+        meta.setdefault('derived_columns', {})[column] = {"dtype": np.dtype(np.float32).str, "shape": []}
+    meta.setdefault('reward_weights', {})[column] = engine.weights
+    with open(os.path.join(dataset_path, dataset_meta_file), 'w') as f:
+        json.dump(meta, f)
+
+    return {"column": column, "rows": dataset.length, "weights": engine.weights}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relabel the rewards of an episode dataset.")
+    parser.add_argument('dataset_path')
+    parser.add_argument('--weights', nargs='+', default=["hp_delta=1"],
+                        help=f"term=weight pairs, terms: {', '.join(sorted(reward_terms))}")
+    parser.add_argument('--column', default='reward', help="column the rewards are written to")
+    args = parser.parse_args()
+
+    print(relabel_dataset(args.dataset_path, RewardEngine(parse_reward_weights(args.weights)), column=args.column))
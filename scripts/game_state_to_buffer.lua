@@ -11,11 +11,26 @@ local gameStateFormat = {}
 
 local actionKeyMappingPath = "env/action_key_mapping.json"
 local action_key_mapping = json.load_file(actionKeyMappingPath)
+-- optional keyboard keys bound to player 2, two player action lines carry its keys after the reset column
+local opponentActionKeyMappingPath = "env/action_key_mapping_p2.json"
+local opponent_action_key_mapping = json.load_file(opponentActionKeyMappingPath)
 local action_key_status = {}
 local last_action_key_status = {}
 local flagTriggerValue = 11
 local updateFrameCount 
 
+-- reset handshake, the trailing column of the action line carries a reset request id
+-- a new id presses the reset key for resetPressFrames frames, once the round is live the id is
+-- acknowledged in the trailing column of every frame row
+local resetKey = action_key_mapping["13"]
+local resetRequestColumn = 15
+local resetPressFrames = 2
+local resetFullHP = 10000
+local resetRequestId = 0
+local resetAckId = 0
+local resetPressLeft = 0
+local resetPending = false
+
 
 local function generate_enum(typename)
     local t = sdk.find_type_definition(typename)
@@ -126,6 +141,23 @@ local function waitForActionsBuffer()
                     --log.debug("no mapping for "..action_key)
                 end
             end
+            local requestId = tonumber(actions_table[resetRequestColumn]) or 0
+            if requestId ~= 0 and requestId ~= resetRequestId then
+                resetRequestId = requestId
+                resetPressLeft = resetPressFrames
+                resetPending = true
+            end
+            if resetPressLeft > 0 then
+                action_key_status[resetKey] = 1
+                resetPressLeft = resetPressLeft - 1
+            end
+            if opponent_action_key_mapping then
+                for action_mapping, action_key in pairs(opponent_action_key_mapping) do
+                    action_table_key = resetRequestColumn + tonumber(action_mapping)
+                    last_action_key_status[action_key] = action_key_status[action_key]
+                    action_key_status[action_key] = tonumber(actions_table[action_table_key]) or 0
+                end
+            end
             -- log.debug("last_action_key_status ="..json.dump_string(last_action_key_status))
             -- log.debug("action_key_status ="..json.dump_string(action_key_status))
             return -- leave while true
@@ -154,6 +186,11 @@ local function writeGameEnvToBuffer()
             end
         end
     end
+    if resetPending and resetPressLeft == 0 and p1.current_HP >= resetFullHP and p2.current_HP >= resetFullHP then
+        resetAckId = resetRequestId
+        resetPending = false
+    end
+    frameRow = frameRow .. "," .. resetAckId
     --log.debug("\n"..frameRow.."\n")
     gameStateBufferFile:write(frameRow .. "\n")
     gameStateBufferFile:flush()
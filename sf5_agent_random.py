@@ -2,6 +2,7 @@ from stable_baselines3.common.env_checker import check_env
 from torch.utils.tensorboard import SummaryWriter
 from sf6_agent_env import SF6AgentEnv
 import action_spaces
+from env_telemetry import publish_telemetry, summarize_telemetry
 from datetime import datetime
 import numpy as np
 
@@ -9,7 +10,8 @@ characters = ['luke', 'luke']
 
 env = SF6AgentEnv(
     characters=characters,
-    action_space_mapping=action_spaces.create_distinct_action_mapping()
+    action_space_mapping=action_spaces.create_distinct_action_mapping(),
+    telemetry=True
 )
 
 check_env(env)
@@ -34,6 +36,7 @@ for step_num in range(1, step_total):
         print(f"logged {eps_count}/{step_num}")
         stats_writer.add_scalar('eval/mean_reward', np.mean(ep_rewards[:ep_window]), step_num)
         stats_writer.add_scalar('eval/mean_ep_length', step_num / eps_count, step_num)
+        publish_telemetry(summarize_telemetry([env.get_telemetry()]), stats_writer, step_num)
     if terminated:
         print(f"TERM {eps_count}/{step_num}")
         eps_count = eps_count + 1
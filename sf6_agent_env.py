@@ -1,20 +1,84 @@
+import asyncio
 import gymnasium as gym
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from gymnasium import spaces
 from datetime import datetime
 import json
 import os
 
+from action_masks import ActionMaskTable
+from action_spaces import ActionTable
+from binary_frame_format import FrameCaptureWriter
+from env_telemetry import EnvTelemetry
+from episode_recorder import EpisodeRecorder
 from game_state import SF6GameState
+from observation_encoder import FrameStackBuffer
+from reward_engine import RewardEngine
 import game_state
 import state_spaces
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple
+
+
+agent_features = [
+    'mActionId',
+    'act_st',
+    'current_HP',
+    'posX',
+    'posY',
+    'mActionFrame',
+    'dir',
+    'super',
+    'drive',
+]
+
+
+def create_observation_space(characters, features, action_space_size: int, keep_prev_action: bool,
+                             categorical_encoding: str = 'one_hot') -> spaces.Dict:
+    obs_space = {}  # create dict to store observation spaces
+    feature_mappings = [state_spaces.create_feature_mapping_for_character(character) for character in characters]
+
+    for feature in features:  # for each feature we want to capture
+        # for each player
+        for player_index in [0, 1]:
+            # create an action space
+            obs_space[f"{player_index}_{feature}"] = game_state.create_state_space(
+                feature_mappings=feature_mappings[player_index],
+                feature=feature,
+                categorical_encoding=categorical_encoding,
+            )
+
+    if keep_prev_action:
+        #  add an action space for the previous action
+        obs_space['prev_action'] = gym.spaces.Box(0, 1, (action_space_size,), dtype=np.int8)
+
+    return spaces.Dict(obs_space)
+
+
+def create_categorical_keys(characters, features) -> List[str]:
+    # observation keys of the dict (categorical) features, index encoded with categorical_encoding='index'
+    feature_mappings = [state_spaces.create_feature_mapping_for_character(character) for character in characters]
+    return [f"{player_index}_{feature}" for feature in features for player_index in [0, 1]
+            if type(feature_mappings[player_index][feature][0]) == dict]
 
 
 class SF6AgentEnv(gym.Env):
-    def __init__(self, characters, action_space_mapping=None, keep_prev_action=True, store_history=False):
+    def __init__(self, characters, action_space_mapping=None, keep_prev_action=True, store_history=False,
+                 transport='file', wait_strategy='spin', history_path='history', env_path=None,
+                 game_env_format_path=None, action_key_mapping_path=None, frame_skip=1, skip_inactive=False,
+                 max_inactive_frames=120, reset_timeout=2.0, reset_retries=3, telemetry=False,
+                 observation_mode='dict', frame_stack=1, normalize_observation=False, reward_weights=None,
+                 categorical_encoding='one_hot', history_codec='npz', capture_path=None, incremental_decoding=False):
         super().__init__()
         self.keep_prev_action = keep_prev_action
+
+        # every action is held for frame_skip frames, with skip_inactive it is also held through the frames
+        # where player 0 is in hitstop, hitstun or blockstun (at most max_inactive_frames) before the next action
+        if frame_skip < 1:
+            raise ValueError(f"frame_skip must be at least 1 got {frame_skip}.")
+        self.frame_skip = frame_skip
+        self.skip_inactive = skip_inactive
+        self.max_inactive_frames = max_inactive_frames
         self.action_space_mapping = action_space_mapping
 
         if self.action_space_mapping is None:
@@ -25,40 +89,36 @@ class SF6AgentEnv(gym.Env):
         # 4 directions 6 buttons
         self.action_space = spaces.Discrete(self.action_space_size)
 
-        self.features = [
-            'mActionId',
-            'act_st',
-            'current_HP',
-            'posX',
-            'posY',
-            'mActionFrame',
-            'dir',
-            'super',
-            'drive',
-        ]
-        obs_space = {}  # create dict to store observation spaces
-
-        for feature in self.features:  # for each feature we want to capture
-            # for each player
-            for player_index in [0, 1]:
-                # create an action space
-                obs_space[f"{player_index}_{feature}"] = game_state.create_state_space(
-                    feature_mappings=state_spaces.create_feature_mapping_for_character(characters[player_index]),
-                    feature=feature,
-                )
-
-        if self.keep_prev_action:
-            #  add an action space for the previous action
-            obs_space['prev_action'] = gym.spaces.Box(0, 1, (self.action_space_size,), dtype=np.int8)
+        self.features = list(agent_features)
 
         # create the observation space
-        self.observation_space = spaces.Dict(obs_space)
-        
+        self.observation_space = create_observation_space(
+            characters=characters,
+            features=self.features,
+            action_space_size=self.action_space_size,
+            keep_prev_action=self.keep_prev_action,
+            categorical_encoding=categorical_encoding,
+        )
+        # keys holding an index per frame with categorical_encoding='index', see EmbeddingFeatureExtractor
+        self.categorical_encoding = categorical_encoding
+        self.categorical_keys = create_categorical_keys(characters, self.features)
+        # the dict space is also the layout of the recorded history in flat mode
+        self.dict_observation_space = self.observation_space
+
+        # 'dict' returns the arrays of the dict space, 'flat' one float32 vector of frame_stack frames
+        if observation_mode not in ('dict', 'flat'):
+            raise ValueError(f"Unknown observation mode {observation_mode}.")
+        if observation_mode == 'dict' and (frame_stack != 1 or normalize_observation):
+            raise ValueError("frame_stack and normalize_observation need observation_mode='flat'.")
+        if observation_mode == 'flat' and categorical_encoding != 'one_hot':
+            raise ValueError("observation_mode='flat' needs categorical_encoding='one_hot'.")
+        self.observation_mode = observation_mode
+        self.current_features = None
+
         self.total_steps = 0
-        self.action_history = []
-        self.observation_history = []
         self.store_history = store_history
         self.last_action = None
+        self.last_action_array = None  # one hot row of the last action, used for prev_action
         self.is_success = False
         self.terminate = False
 
@@ -70,42 +130,143 @@ class SF6AgentEnv(gym.Env):
                 0: state_spaces.create_feature_mapping_for_character(characters[0]),
                 1: state_spaces.create_feature_mapping_for_character(characters[1])
             },
-            game_env_player_features={0: self.features, 1: self.features}
+            game_env_player_features={0: self.features, 1: self.features},
+            transport=transport,
+            wait_strategy=wait_strategy,
+            env_path=env_path,
+            game_env_format_path=game_env_format_path,
+            action_key_mapping_path=action_key_mapping_path,
+            reset_timeout=reset_timeout,
+            reset_retries=reset_retries,
+            categorical_encoding=categorical_encoding,
+            incremental_decoding=incremental_decoding,
         )
+
+        # key rows, one hot rows and action lines of every action
+        self.action_table = ActionTable(self.action_space_mapping, len(self.game_env_state.action_event_mapping))
+
+        # valid actions per act_st, drive and stun state, built on the first action_masks() call
+        self.action_mask_table = None
+
+        self.frame_stack_buffer = None
+        if self.observation_mode == 'flat':
+            self.create_flat_observation(frame_stack, normalize_observation)
         
-        # used to calculate reward 
-        self.last_0_current_HP = 10000
+        # used to detect the end of the round
         self.current_0_current_HP = 10000
-        self.last_1_current_HP = 10000
         self.current_1_current_HP = 10000
 
+        # reward terms read from the raw frame, the default weights give the hp difference reward
+        self.reward_engine = RewardEngine(reward_weights, game_env_format=self.game_env_state.game_env_format)
+
+        self.recorder = None
         if self.store_history:
-            os.makedirs('history', exist_ok=True)
+            self.recorder = EpisodeRecorder(path=history_path, observation_space=self.dict_observation_space,
+                                            codec=history_codec)
+
+        # every raw frame read, also the skipped ones, as binary frame records in <capture_path>/<episode id>.bin
+        self.frame_capture = None
+        self.capture_count = 0
+        if capture_path is not None:
+            self.frame_capture = FrameCaptureWriter(capture_path, self.game_env_state.game_env_format)
+
+        # step_async runs the step on this thread so the frame wait and encoding overlap the caller
+        self.step_executor = None
+        self.pending_step = None
+
+        # frame gaps and step phase latencies, the methods are only wrapped when enabled
+        self.telemetry = None
+        if telemetry:
+            self.telemetry = EnvTelemetry()
+            self.telemetry.attach(self)
+
+    def create_flat_observation(self, frame_stack: int, normalize_observation: bool):
+        # flat frame layout: continuous features, one hot features, prev_action
+        # flat_layout maps every key of the dict space to its (offset, size) in a frame
+        encoder = self.game_env_state.observation_encoder
+        self.flat_layout = dict(encoder.flat_layout)
+        low = encoder.flat_low
+        high = encoder.flat_high
+        if self.keep_prev_action:
+            self.flat_layout['prev_action'] = (encoder.flat_size, self.action_space_size)
+            low = np.concatenate([low, np.zeros(self.action_space_size, dtype=np.float32)])
+            high = np.concatenate([high, np.ones(self.action_space_size, dtype=np.float32)])
+        self.prev_action_offset = encoder.flat_size
+        self.hp_offsets = (self.flat_layout['0_current_HP'][0], self.flat_layout['1_current_HP'][0])
+
+        # continuous features are scaled from their bounds to [-1, 1], one hot features are left as they are
+        self.continuous_size = encoder.flat_continuous_size
+        self.normalize_observation = normalize_observation
+        if normalize_observation:
+            continuous_low = low[:self.continuous_size].copy()
+            continuous_high = high[:self.continuous_size].copy()
+            self.normalize_shift = (continuous_low + continuous_high) / 2
+            self.normalize_scale = 2 / np.maximum(continuous_high - continuous_low, 1e-6)
+            low[:self.continuous_size] = -1
+            high[:self.continuous_size] = 1
+
+        self.frame_stack_buffer = FrameStackBuffer(len(low), frame_stack)
+        # stacked frames start as zeros like VecFrameStack
+        self.observation_space = spaces.Box(
+            low=np.tile(np.minimum(low, 0), frame_stack),
+            high=np.tile(np.maximum(high, 0), frame_stack),
+            dtype=np.float32,
+        )
 
-    def _get_obs(self) -> Dict[str, np.array]:
+    def _read_frame(self):
+        # encodes the current frame and updates the hp used by the reward
+        if self.frame_capture is not None:
+            self.frame_capture.write(self.game_env_state.current_game_state)
+        if self.frame_stack_buffer is None:
+            self.current_features = self.game_env_state.get_current_game_state()
+            self.current_0_current_HP = self.current_features['0_current_HP'][0]
+            self.current_1_current_HP = self.current_features['1_current_HP'][0]
+            return
+
+        frame = self.frame_stack_buffer.frame
+        self.game_env_state.get_current_game_state_flat(frame)
+        self.current_0_current_HP = float(frame[self.hp_offsets[0]])
+        self.current_1_current_HP = float(frame[self.hp_offsets[1]])
+        if self.normalize_observation:
+            continuous = frame[:self.continuous_size]
+            continuous -= self.normalize_shift
+            continuous *= self.normalize_scale
+
+    def _get_prev_action(self) -> np.ndarray:
+        if self.last_action_array is None:  # if there are no actions
+            return self.action_table.no_action  # empty action
+        return self.last_action_array
+
+    def _get_dict_obs(self, current_features) -> Dict[str, np.array]:
         observation = {}
         # append last actions
         if self.keep_prev_action:
-            if len(self.action_history) == 0:  # if there are no actions
-                observation['prev_action'] = np.zeros(self.action_space_size, dtype=np.int8)  # create empty action
-            else:
-                observation['prev_action'] = self.action_history[-1]  # append last action
-
-        current_features = self.game_env_state.get_current_game_state()
+            observation['prev_action'] = self._get_prev_action()
         observation.update(current_features)
-        
-        # used to calculate reward 
-        self.current_0_current_HP = observation['0_current_HP'][0]
-        self.current_1_current_HP = observation['1_current_HP'][0]
-
-        if self.store_history:
-            self.observation_history.append(observation)
-        
         return observation
 
-    def _get_info(self) -> Dict[str, Any]:
+    def _get_history_obs(self, observation) -> Dict[str, np.array]:
+        # history is recorded in the layout of the dict space in every observation mode
+        if self.frame_stack_buffer is None:
+            return observation
+        return self._get_dict_obs(self.game_env_state.get_current_game_state())
+
+    def _get_obs(self):
+        # observation of the last frame read by _read_frame, copied out of the encoder and frame stack buffers
+        # as vec envs keep the terminal observation of an episode after calling reset()
+        if self.frame_stack_buffer is None:
+            return {key: value.copy() for key, value in self._get_dict_obs(self.current_features).items()}
+
+        if self.keep_prev_action:
+            self.frame_stack_buffer.frame[self.prev_action_offset:] = self._get_prev_action()
+        # push() returns a view of the stacked frames that the next step overwrites
+        return self.frame_stack_buffer.push().copy()
+
+    def _get_info(self, frames: int = 1) -> Dict[str, Any]:
         info = {
             "total_steps": self.total_steps,
+            "frames": frames,  # game frames advanced by this step
+            "skipped_frames": frames - 1,  # frames the policy was not asked for an action
         }
         return info
 
@@ -116,73 +277,124 @@ class SF6AgentEnv(gym.Env):
         return self.terminate
 
     def _calc_reward(self) -> float:
-        reward = 0
-
-        # used to calculate reward
-        p_0_hp_change = self.current_0_current_HP - self.last_0_current_HP
-        # if p_0_hp_change != 0:
-        #     print(f"p_0_hp_change={p_0_hp_change}")
-        p_1_hp_change = self.current_1_current_HP - self.last_1_current_HP
-        # if p_1_hp_change != 0:
-        #     print(f"p_1_hp_change={p_1_hp_change}")
-        reward = reward + p_0_hp_change - p_1_hp_change
-        if reward != 0:
-            pass
-            # print(f"reward={reward}")
-            # print("--------------")
-        self.last_0_current_HP = self.current_0_current_HP
-        self.last_1_current_HP = self.current_1_current_HP
-
-        reward = float(reward)
-
-        return reward
+        # reward of the transition from the previous frame to the current one
+        return self.reward_engine.step(self.game_env_state.current_game_state)
 
     def step(self, action: int) -> Tuple[Dict[str, np.array], float, bool, bool, Dict[str, Any]]:
-        action_mapping = self.action_space_mapping[action]
-
-        # convert inputs into action array
-        action_array = [1 if i in action_mapping else 0 for i in range(len(self.game_env_state.action_event_mapping))]
-
-        self.game_env_state.send_actions(action_array)
+        action = int(action)
+        action_line = self.action_table.action_lines[action]
+        self.game_env_state.send_action_line(action_line)
         self.game_env_state.wait_for_game_env_update()
 
-        observation = self._get_obs()
+        self._read_frame()
         reward = self._calc_reward()
         terminated = self._get_terminated()
 
-        # convert action to sparse array
-        sparse_action_array = [1 if i == action else 0 for i in range(self.action_space_size)]
-        self.action_history.append(np.array(sparse_action_array, dtype=np.int8))
+        frames = 1
+        inactive_frames = 0
+        while not terminated:
+            if frames < self.frame_skip:
+                pass
+            elif (self.skip_inactive and inactive_frames < self.max_inactive_frames
+                  and not self.game_env_state.can_act(0)):
+                inactive_frames += 1
+            else:
+                break
+            self.game_env_state.send_action_line(action_line)
+            self.game_env_state.wait_for_game_env_update()
+            self._read_frame()
+            reward += self._calc_reward()
+            terminated = self._get_terminated()
+            frames += 1
+
+        observation = self._get_obs()
+        if self.store_history:
+            self.recorder.record(self._get_history_obs(observation), action, reward,
+                                 int(self.game_env_state.current_game_env_frame), self.reward_engine.frame_values)
+
+        self.last_action_array = self.action_table.one_hot[action]
         self.last_action = action
         self.total_steps += 1
 
-        return observation, reward, terminated, False, self._get_info()
+        return observation, reward, terminated, False, self._get_info(frames)
 
     def reset(self, seed=None, options=None):
-        self.game_env_state.send_reset()  # set reset to env
-        self.game_env_state.wait_for_game_env_update()  # wait for game to update
+        self.game_env_state.send_reset()  # set reset to env, returns on the first frame of the new round
         
-        # used to calculate reward 
-        self.last_0_current_HP = 10000
         self.current_0_current_HP = 10000
-        self.last_1_current_HP = 10000
         self.current_1_current_HP = 10000
+        self.reward_engine.reset(self.game_env_state.current_game_state)
         self.terminate = False
-
-        if self.store_history and len(self.observation_history) > 0:
-            with open(f"observations/{datetime.now().strftime('%Y%m%d_%H%M%S')}.json", 'w') as f:
-                json.dump({
-                    "observations": self.observation_history,
-                    "actions": self.action_history
-                }, f, cls=NumpyEncoder)
-            self.observation_history.clear()
+        if self.frame_capture is not None:
+            self.frame_capture.start_episode(
+                f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{self.capture_count:06d}")
+            self.capture_count += 1
 
         self.total_steps = 0
-        self.action_history = []
+        self.last_action_array = None
+        if self.frame_stack_buffer is not None:
+            self.frame_stack_buffer.clear()
+        self._read_frame()
         obs = self._get_obs()
 
+        if self.store_history:
+            # chunks of the previous episode are written in the background
+            self.recorder.start_episode()
+            self.recorder.record(self._get_history_obs(obs), -1, 0.0, int(self.game_env_state.current_game_env_frame),
+                                 self.reward_engine.frame_values)
+
         return obs, self._get_info()
 
+    def action_masks(self) -> np.ndarray:
+        # actions that change the game in the current frame, for MaskablePPO
+        if self.action_mask_table is None:
+            self.action_mask_table = ActionMaskTable(self.action_space_mapping,
+                                                     game_env_format=self.game_env_state.game_env_format)
+        return self.action_mask_table.mask(self.game_env_state.current_game_state)
+
+    def get_step_executor(self) -> ThreadPoolExecutor:
+        if self.step_executor is None:
+            self.step_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sf6_step")
+        return self.step_executor
+
+    def step_async(self, action: int):
+        # sends the action and waits for and encodes the next frame in the background,
+        # use a blocking wait strategy ('inotify' or 'backoff') so the waiting thread does not hold the GIL
+        if self.pending_step is not None:
+            raise RuntimeError("step_async called before step_wait of the previous step.")
+        self.pending_step = self.get_step_executor().submit(self.step, action)
+
+    def step_wait(self) -> Tuple[Dict[str, np.array], float, bool, bool, Dict[str, Any]]:
+        if self.pending_step is None:
+            raise RuntimeError("step_wait called without step_async.")
+        pending_step, self.pending_step = self.pending_step, None
+        return pending_step.result()
+
+    async def astep(self, action: int):
+        return await asyncio.get_running_loop().run_in_executor(self.get_step_executor(), self.step, action)
+
+    async def areset(self, seed=None, options=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.get_step_executor(), lambda: self.reset(seed=seed, options=options))
+
+    def get_telemetry(self, clear=True):
+        if self.telemetry is None:
+            return None
+        return self.telemetry.snapshot(clear=clear)
+
+    def get_decode_stats(self, clear=False):
+        return self.game_env_state.get_decode_stats(clear=clear)
+
+    def close(self):
+        if self.step_executor is not None:
+            self.step_executor.shutdown(wait=True)
+            self.step_executor = None
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.frame_capture is not None:
+            self.frame_capture.close()
+        super().close()
+
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
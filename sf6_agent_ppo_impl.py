@@ -1,13 +1,18 @@
-from sf6_agent_env import SF6AgentEnv
+from sf6_agent_env import SF6AgentEnv, agent_features, create_categorical_keys
 from datetime import datetime
 import gymnasium as gym
 from stable_baselines3 import PPO
 from stable_baselines3.common.vec_env.vec_frame_stack import VecFrameStack
-from stable_baselines3.common.vec_env import DummyVecEnv, VecNormalize
-from stable_baselines3.common.monitor import Monitor
-from stable_baselines3.common.callbacks import EvalCallback, CheckpointCallback, CallbackList
+from stable_baselines3.common.vec_env import VecMonitor, VecNormalize
+from stable_baselines3.common.callbacks import CallbackList
 import os
 import action_spaces
+from game_state import default_env_path
+from sf6_callbacks import AsyncEvalCallback, SelfPlaySnapshotCallback, TelemetryCallback
+from sf6_eval_service import EvaluationService
+from sf6_feature_extractors import EmbeddingFeatureExtractor
+from sf6_self_play import SelfPlayVecEnv
+from sf6_vec_env import create_instance_env_paths, make_sf6_vec_env
 
 
 paths = {
@@ -19,7 +24,9 @@ for d in paths.values():
     os.makedirs(d, exist_ok=True)
 
 
-def train_eval_model(frame_stack, env_num=1):
+def train_eval_model(frame_stack, env_num=1, env_paths=None, observation_mode='dict', vec_env='subproc',
+                     categorical_encoding='one_hot', device='auto', self_play=None, eval_env_num=1,
+                     eval_env_paths=None):
     run_name = f"luke_luke_LR5e-4_distinct"
     run_name = f"{run_name}_{datetime.now().strftime('%Y%m%d_%H%M')}"
 
@@ -28,46 +35,98 @@ def train_eval_model(frame_stack, env_num=1):
     os.makedirs(paths['models_path'], exist_ok=True)
     os.makedirs(paths['logs_path'], exist_ok=True)
 
-    def make_env():
-        e = gym.make('SF6AgentEnv', **{
-            "characters": ['luke', 'luke'],
-            "action_space_mapping": action_spaces.create_distinct_action_mapping(),
-            "keep_prev_action": True,
-            "store_history": True
-        })
-        return Monitor(e)
-    env = DummyVecEnv([lambda: make_env()])
-    env = VecFrameStack(env, n_stack=frame_stack)
-    env = VecNormalize(env)
-
-    checkpoint_callback = CheckpointCallback(
-        save_freq=20000,
+    # one buffer directory per game instance, a single env uses game_state.default_env_path
+    if env_paths is None:
+        env_paths = [None] if env_num == 1 else create_instance_env_paths(default_env_path, env_num)
+    if len(env_paths) != env_num:
+        raise ValueError(f"Expected {env_num} env paths got {len(env_paths)}.")
+    # evaluations run against their own game instances, eval_0 .. under the default env path
+    if eval_env_paths is None:
+        eval_env_paths = [os.path.join(default_env_path, f"eval_{i}") for i in range(eval_env_num)]
+
+    env_kwargs = {
+        "characters": ['luke', 'luke'],
+        "action_space_mapping": action_spaces.create_distinct_action_mapping(),
+        "keep_prev_action": True,
+        "store_history": True,
+        "telemetry": True,
+        "categorical_encoding": categorical_encoding,
+    }
+    policy_kwargs = dict(net_arch=dict(pi=[32, 32], vf=[32, 32]))
+    if self_play is not None and observation_mode == 'flat':
+        raise ValueError("self_play needs observation_mode='dict'.")
+    if observation_mode == 'flat':
+        # frames are stacked and the continuous features scaled inside the env, only rewards are normalized here
+        env_kwargs.update({"observation_mode": 'flat', "frame_stack": frame_stack, "normalize_observation": True})
+        env = make_sf6_vec_env(env_paths=env_paths, env_kwargs=env_kwargs, vec_env=vec_env)
+        env = VecNormalize(env, norm_obs=False)
+        policy = "MlpPolicy"
+    else:
+        if self_play is not None:
+            # 'mirror' learns from both players of every game, 'snapshot' plays against exported snapshots
+            env = VecMonitor(SelfPlayVecEnv(env_paths=env_paths, characters=env_kwargs['characters'],
+                                            action_space_mapping=env_kwargs['action_space_mapping'],
+                                            mode=self_play, keep_prev_action=env_kwargs['keep_prev_action'],
+                                            categorical_encoding=categorical_encoding))
+        else:
+            env = make_sf6_vec_env(env_paths=env_paths, env_kwargs=env_kwargs, vec_env=vec_env)
+        env = VecFrameStack(env, n_stack=frame_stack)
+        if categorical_encoding == 'index':
+            # indices are embedded by the policy and must not be normalized
+            categorical_keys = create_categorical_keys(env_kwargs['characters'], agent_features)
+            env = VecNormalize(env, norm_obs_keys=[key for key in env.observation_space.spaces
+                                                   if key not in categorical_keys])
+            policy_kwargs.update(features_extractor_class=EmbeddingFeatureExtractor,
+                                 features_extractor_kwargs=dict(categorical_keys=categorical_keys))
+        else:
+            env = VecNormalize(env)
+        policy = "MultiInputPolicy"
+
+    # checkpoints are evaluated in worker processes with their frozen normalization while training continues
+    eval_service = EvaluationService(
+        env_paths=eval_env_paths,
+        env_kwargs=env_kwargs,
+        frame_stack=frame_stack if observation_mode == 'dict' else None,
+        n_eval_episodes=5,
+        deterministic=True,
+        best_model_save_path=paths['models_path'],
+        log_path=paths['logs_path'],
+    )
+    eval_callback = AsyncEvalCallback(
+        eval_service,
+        save_freq=max(20000 // env_num, 1),
         save_path=paths['logs_path'],
         name_prefix="ppo_",
     )
 
-    eval_callback = EvalCallback(env, best_model_save_path=paths['models_path'],
-                                 log_path=paths['logs_path'], eval_freq=max(20000 // env_num, 1),
-                                 n_eval_episodes=5, deterministic=True,
-                                 render=False)
+    # frame gaps and step latencies of the envs, written with the rollout stats
+    telemetry_callback = TelemetryCallback(log_freq=4096)
 
-    callback = CallbackList([checkpoint_callback, eval_callback])
-
-    policy_kwargs = dict(net_arch=dict(pi=[32, 32], vf=[32, 32]))
+    callbacks = [eval_callback, telemetry_callback]
+    if self_play == 'snapshot':
+        # a new opponent every snapshot, games play the game side until the first one
+        callbacks.append(SelfPlaySnapshotCallback(save_freq=max(20000 // env_num, 1),
+                                                  save_path=os.path.join(paths['logs_path'], "snapshots"),
+                                                  frame_stack=frame_stack))
+    callback = CallbackList(callbacks)
 
-    model = PPO("MultiInputPolicy", env,
+    model = PPO(policy, env,
                 verbose=False,
                 tensorboard_log=paths['runs_path'],
-                device='cuda',
+                device=device,
                 learning_rate=5e-4,
                 n_steps=4096,
                 policy_kwargs=policy_kwargs)
 
-    model.learn(
-        total_timesteps=2000000,
-        tb_log_name=f"{run_name}",
-        reset_num_timesteps=False,
-        callback=callback)
+    try:
+        model.learn(
+            total_timesteps=2000000,
+            tb_log_name=f"{run_name}",
+            reset_num_timesteps=False,
+            callback=callback)
+    finally:
+        # the callback already waited for the last evaluations, workers still running then are terminated
+        eval_service.close(wait=False)
 
 
 if __name__ == "__main__":
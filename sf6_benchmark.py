@@ -0,0 +1,1216 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+
+import action_spaces
+import binary_frame_format
+import state_spaces
+from game_emulator import start_emulator_process
+from game_env_transport import FileGameEnvTransport, SharedMemoryGameEnvTransport, SharedMemoryGameEnvWriter
+from game_state import SF6GameState
+from observation_encoder import ObservationEncoder
+from reward_engine import RewardEngine, relabel_rewards, reward_frame_features, reward_terms
+from wait_strategies import create_wait_strategy, wait_strategies
+
+sample_game_env_buffer_path = "env/game_env_buffer.buf"
+sample_game_env_format_path = "env/game_env.format"
+benchmark_features = [
+    'mActionId',
+    'act_st',
+    'current_HP',
+    'posX',
+    'posY',
+    'mActionFrame',
+    'dir',
+    'super',
+    'drive',
+]
+
+
+def summarize_latencies(samples: List[float]) -> Dict[str, float]:
+    samples = np.asarray(samples, dtype=np.float64) * 1e6  # seconds to microseconds
+    if len(samples) == 0:
+        return {"count": 0}
+    return {
+        "count": int(len(samples)),
+        "mean_us": float(samples.mean()),
+        "p50_us": float(np.percentile(samples, 50)),
+        "p99_us": float(np.percentile(samples, 99)),
+        "max_us": float(samples.max()),
+    }
+
+
+def load_sample_row() -> List[str]:
+    with open(sample_game_env_buffer_path, 'r') as f:
+        return f.readline().strip().split(",")
+
+
+class StageTimer:
+    # wraps methods of an object to time every call under a stage name
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.enabled = True
+
+    def wrap(self, obj, method_name: str, stage: str):
+        method = getattr(obj, method_name)
+
+        def timed(*args, **kwargs):
+            if not self.enabled:
+                return method(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - start)
+
+        setattr(obj, method_name, timed)
+
+    def summary(self, total_stage: str) -> dict:
+        total_time = sum(self.samples[total_stage])
+        results = {}
+        for stage, samples in self.samples.items():
+            results[stage] = summarize_latencies(samples)
+            results[stage]['share'] = sum(samples) / total_time if total_time > 0 else 0.0
+        return results
+
+
+def load_game_env_format() -> List[str]:
+    with open(sample_game_env_format_path, 'r') as f:
+        return f.readline().strip().split(",")
+
+
+def load_feature_mapping(characters=('luke', 'luke')) -> dict:
+    return {
+        0: state_spaces.create_feature_mapping_for_character(characters[0]),
+        1: state_spaces.create_feature_mapping_for_character(characters[1]),
+    }
+
+
+def bench_transport(args) -> dict:
+    row = load_sample_row()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # file transport, written the same way as writeGameEnvToBuffer
+        file_path = os.path.join(tmp_dir, "game_env_buffer.buf")
+        open(file_path, 'w').close()
+        writer = open(file_path, 'r+')
+        reader = FileGameEnvTransport(file_path)
+        latencies = []
+        for frame in range(args.frames):
+            row[0] = str(frame)
+            start = time.perf_counter()
+            writer.seek(0)
+            writer.write(','.join(row) + "\n")
+            writer.flush()
+            while True:
+                content = reader.poll()
+                if content is not None and content[0] == row[0]:
+                    break
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        reader.close()
+        results['file'] = summarize_latencies(latencies)
+
+        # shared memory ring buffer
+        ring_path = os.path.join(tmp_dir, "game_env_ring.buf")
+        ring_writer = SharedMemoryGameEnvWriter(ring_path)
+        ring_reader = SharedMemoryGameEnvTransport(ring_path)
+        latencies = []
+        for frame in range(args.frames):
+            row[0] = str(frame)
+            start = time.perf_counter()
+            ring_writer.write_row(row)
+            while True:
+                content = ring_reader.poll()
+                if content is not None:
+                    break
+            latencies.append(time.perf_counter() - start)
+        results['shm'] = summarize_latencies(latencies)
+        results['shm']['torn_reads'] = ring_reader.torn_reads
+        ring_reader.close()
+        ring_writer.close()
+
+    return results
+
+
+def write_frames_at_fps(file_path: str, row: List[str], frames: int, fps: float):
+    # stand in for writeGameEnvToBuffer running in its own process
+    with open(file_path, 'r+') as f:
+        frame_time = 1.0 / fps
+        next_frame = time.perf_counter()
+        for frame in range(1, frames + 1):
+            next_frame += frame_time
+            remaining = next_frame - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            row[0] = str(frame)
+            row[1] = repr(time.time())  # write time, read back by the benchmark to measure wake latency
+            f.seek(0)
+            f.write(','.join(row) + "\n")
+            f.flush()
+
+
+def bench_wait(args) -> dict:
+    row = load_sample_row()
+    results = {}
+
+    for strategy_name in wait_strategies:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "game_env_buffer.buf")
+            with open(file_path, 'w') as f:
+                f.write(','.join(['0'] + row[1:]) + "\n")
+
+            transport = FileGameEnvTransport(file_path)
+            strategy = create_wait_strategy(strategy_name, watch_path=file_path)
+            last_frame = {'frame': 0, 'time': None}
+
+            def poll():
+                # torn rows are skipped like poll_game_env_update does
+                content = transport.poll()
+                if content is None or len(content) != len(row):
+                    return None
+                try:
+                    frame, frame_time = int(content[0]), float(content[1])
+                except ValueError:
+                    return None
+                if frame == last_frame['frame']:
+                    return None
+                last_frame['time'] = frame_time
+                return frame
+
+            fps = 60.0 if args.fps is None else args.fps
+            writer = multiprocessing.Process(target=write_frames_at_fps, args=(file_path, list(row), args.frames, fps))
+            writer.start()
+            received = 0
+            while received < args.frames:
+                frame = strategy.wait(poll, frame_time=lambda: last_frame['time'])
+                received += frame - last_frame['frame']
+                last_frame['frame'] = frame
+            writer.join()
+
+            results[strategy_name] = strategy.stats()
+            strategy.close()
+            transport.close()
+
+    return results
+
+
+def bench_encode(args) -> dict:
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    feature_mapping = load_feature_mapping()
+    player_features = {0: benchmark_features, 1: benchmark_features}
+
+    # per feature encode_feature path, SF6GameState is not constructed as it needs the game buffers
+    legacy_state = SF6GameState.__new__(SF6GameState)
+    legacy_state.game_env_format = game_env_format
+    legacy_state.feature_mapping = feature_mapping
+    legacy_state.categorical_encoding = 'one_hot'
+    legacy_state.game_env_player_features = player_features
+    legacy_state.current_game_state = row
+
+    def legacy_encode():
+        player_features_encoded = {}
+        for player_id in [0, 1]:
+            player_vals = legacy_state.get_player_features(player_id)
+            for feature_name in player_features[player_id]:
+                player_features_encoded[f"{player_id}_{feature_name}"] = legacy_state.encode_feature(
+                    p_idx=player_id, feature=feature_name, value=player_vals[game_env_format.index(feature_name)])
+        return player_features_encoded
+
+    encoder = ObservationEncoder(game_env_format, player_features, feature_mapping)
+    results = {}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # the sample frame has unmapped dir values
+        for name, encode in [('encode_feature', legacy_encode), ('encoder', lambda: encoder.encode(row))]:
+            latencies = []
+            for _ in range(args.frames):
+                start = time.perf_counter()
+                encode()
+                latencies.append(time.perf_counter() - start)
+            results[name] = summarize_latencies(latencies)
+
+        rows = [row] * args.frames
+        for name, batch in [('encode_batch_strings', rows), ('encode_batch', np.array(rows, dtype=np.float64))]:
+            start = time.perf_counter()
+            encoder.encode_batch(batch)
+            elapsed = time.perf_counter() - start
+            results[name] = {"count": args.frames, "mean_us": elapsed / args.frames * 1e6}
+
+    return results
+
+
+def record_emulated_trace(args, frames: int) -> List[List[str]]:
+    # raw rows read by an env stepped with random actions held for 8 steps against the stand in game side
+    from sf6_agent_env import SF6AgentEnv
+
+    rows = []
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as env_path, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        process, stop_event = start_emulator_process(env_path, fps=0.0, seed=0, transport=args.transport)
+        try:
+            action_mapping = action_spaces.create_distinct_action_mapping()
+            env = SF6AgentEnv(characters=['luke', 'luke'], action_space_mapping=action_mapping,
+                              transport=args.transport, env_path=env_path)
+            env.reset()
+            action = 0
+            while len(rows) < frames:
+                if len(rows) % 8 == 0:
+                    action = int(rng.integers(len(action_mapping)))
+                _, _, terminated, truncated, _ = env.step(action)
+                rows.append(list(env.game_env_state.current_game_state))
+                if terminated or truncated:
+                    env.reset()
+            env.close()
+        finally:
+            stop_event.set()
+            process.join(timeout=5)
+    return rows
+
+
+def bench_decode(args) -> dict:
+    from binary_frame_format import read_csv_capture
+
+    # full against incremental encoding of a recorded csv capture or an emulated trace of args.frames rows
+    game_env_format = load_game_env_format()
+    feature_mapping = load_feature_mapping()
+    player_features = {0: benchmark_features, 1: benchmark_features}
+    if args.capture is not None:
+        rows = list(read_csv_capture(args.capture, game_env_format))[:args.frames]
+    else:
+        rows = record_emulated_trace(args, args.frames)
+    results = {"trace": "capture" if args.capture is not None else "emulated", "frames": len(rows)}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # captures can have unmapped dir values
+        for incremental in [False, True]:
+            mode = "incremental" if incremental else "full"
+            encoder = ObservationEncoder(game_env_format, player_features, feature_mapping, incremental=incremental)
+            out = np.zeros(encoder.flat_size, dtype=np.float32)
+            for name, encode in [('encode', encoder.encode), ('encode_flat', lambda row: encoder.encode_flat(row, out))]:
+                encoder.reset_incremental()
+                encoder.decode_stats(clear=True)
+                latencies = []
+                for row in rows:
+                    start = time.perf_counter()
+                    encode(row)
+                    latencies.append(time.perf_counter() - start)
+                results[f"{mode}_{name}"] = summarize_latencies(latencies)
+                if incremental:
+                    results[f"{mode}_{name}"]["decode_stats"] = encoder.decode_stats()
+
+    for name in ['encode', 'encode_flat']:
+        results[f"incremental_{name}"]["speedup"] = (results[f"full_{name}"]["mean_us"] /
+                                                     results[f"incremental_{name}"]["mean_us"])
+    return results
+
+
+def bench_categorical(args) -> dict:
+    import torch as th
+    from stable_baselines3.common.torch_layers import CombinedExtractor
+    from gymnasium import spaces
+    from sf6_agent_env import agent_features, create_categorical_keys, create_observation_space
+    from sf6_feature_extractors import EmbeddingFeatureExtractor
+
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    feature_mapping = load_feature_mapping()
+    player_features = {0: benchmark_features, 1: benchmark_features}
+    action_space_size = len(action_spaces.create_distinct_action_mapping())
+    categorical_keys = create_categorical_keys(['luke', 'luke'], agent_features)
+    frame_stack = 3
+    batch_size = 256
+    results = {}
+
+    for encoding in ['one_hot', 'index']:
+        space = create_observation_space(['luke', 'luke'], agent_features, action_space_size, True,
+                                         categorical_encoding=encoding)
+        encoder = ObservationEncoder(game_env_format, player_features, feature_mapping, categorical_encoding=encoding)
+        result = {
+            # one observation as returned by the env and recorded to history
+            "bytes_per_transition": int(sum(subspace.dtype.itemsize * int(np.prod(subspace.shape))
+                                            for subspace in space.spaces.values())),
+            # float32 rollout buffer row of the frame stacked observation
+            "rollout_bytes_per_transition": int(sum(4 * int(np.prod(subspace.shape)) * frame_stack
+                                                    for subspace in space.spaces.values())),
+        }
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # the sample frame has unmapped dir values
+            start = time.perf_counter()
+            for _ in range(args.frames):
+                encoder.encode(row)
+            result["encode_frames_per_sec"] = args.frames / (time.perf_counter() - start)
+            batch = np.array([row] * args.frames, dtype=np.float64)
+            start = time.perf_counter()
+            encoder.encode_batch(batch)
+            result["encode_batch_frames_per_sec"] = args.frames / (time.perf_counter() - start)
+
+        # features of a minibatch of frame stacked observations, stacked keys as VecFrameStack builds them
+        stacked_space = spaces.Dict({
+            key: spaces.Box(low=np.repeat(subspace.low, frame_stack), high=np.repeat(subspace.high, frame_stack),
+                            dtype=subspace.dtype)
+            for key, subspace in space.spaces.items()
+        })
+        if encoding == 'index':
+            extractor = EmbeddingFeatureExtractor(stacked_space, categorical_keys=categorical_keys)
+        else:
+            extractor = CombinedExtractor(stacked_space)
+        observations = {key: th.as_tensor(np.stack([subspace.sample() for _ in range(batch_size)]), dtype=th.float32)
+                        for key, subspace in stacked_space.spaces.items()}
+        repeats = 200
+        with th.no_grad():
+            extractor(observations)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                extractor(observations)
+        result["extractor_samples_per_sec"] = repeats * batch_size / (time.perf_counter() - start)
+        result["features_dim"] = extractor.features_dim
+        results[encoding] = result
+
+    results["bytes_ratio"] = results['one_hot']['bytes_per_transition'] / results['index']['bytes_per_transition']
+    return results
+
+
+def bench_frame_format(args) -> dict:
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    line = ','.join(row)
+    record = binary_frame_format.encode_frames([row], game_env_format)
+    results = {}
+
+    def parse_csv():
+        values = line.split(",")
+        return [float(value) for value in values]
+
+    def parse_binary():
+        return binary_frame_format.decode_frames(record, game_env_format, check=False)[0]
+
+    for name, parse in [('csv_split', parse_csv), ('binary', parse_binary)]:
+        latencies = []
+        for _ in range(args.frames):
+            start = time.perf_counter()
+            parse()
+            latencies.append(time.perf_counter() - start)
+        results[name] = summarize_latencies(latencies)
+
+    lines = [line] * args.frames
+    start = time.perf_counter()
+    np.array([l.split(",") for l in lines], dtype=np.float64)
+    results['csv_split_batch'] = {"count": args.frames, "mean_us": (time.perf_counter() - start) / args.frames * 1e6}
+
+    records = record * args.frames
+    start = time.perf_counter()
+    binary_frame_format.decode_frames(records, game_env_format)
+    results['binary_batch'] = {"count": args.frames, "mean_us": (time.perf_counter() - start) / args.frames * 1e6}
+
+    results['csv_bytes_per_frame'] = len(line) + 1
+    results['binary_bytes_per_frame'] = binary_frame_format.create_frame_dtype(game_env_format).itemsize
+    return results
+
+
+def bench_step(args) -> dict:
+    from sf6_agent_env import SF6AgentEnv
+
+    fps = 0.0 if args.fps is None else args.fps  # unthrottled unless a frame rate is given
+    results = {}
+
+    with tempfile.TemporaryDirectory() as env_path, warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        process, stop_event = start_emulator_process(env_path, fps=fps, seed=0, transport=args.transport)
+        history_path = os.path.join(env_path, "history")
+        try:
+            env = SF6AgentEnv(
+                characters=['luke', 'luke'],
+                action_space_mapping=action_spaces.create_distinct_action_mapping(),
+                keep_prev_action=True,
+                store_history=args.store_history,
+                transport=args.transport,
+                history_path=history_path,
+                env_path=env_path,
+            )
+
+            timer = StageTimer()
+            timer.wrap(env.game_env_state, 'send_action_line', 'send_action_line')
+            timer.wrap(env.game_env_state, 'write_action_line', 'write_action_line')
+            timer.wrap(env.game_env_state, 'wait_for_game_env_update', 'wait_for_game_env_update')
+            timer.wrap(env.game_env_state, 'get_current_game_state', 'get_current_game_state')
+            timer.wrap(env, '_calc_reward', '_calc_reward')
+            if env.recorder is not None:
+                timer.wrap(env.recorder, 'record', 'history')
+            timer.wrap(env, 'step', 'step')
+
+            rng = np.random.default_rng(0)
+            actions = rng.integers(0, env.action_space_size, size=args.frames)
+
+            timer.enabled = False
+            env.reset()
+            timer.enabled = True
+            start = time.perf_counter()
+            for action in actions:
+                _, _, terminated, _, _ = env.step(int(action))
+                if terminated:
+                    timer.enabled = False  # resets are not part of the step breakdown
+                    env.reset()
+                    timer.enabled = True
+            elapsed = time.perf_counter() - start
+            results['env'] = {
+                "steps_per_sec": args.frames / elapsed,
+                "stages": timer.summary('step'),
+                "reset": env.game_env_state.get_reset_stats(),
+            }
+
+            try:
+                from stable_baselines3.common.vec_env import DummyVecEnv, VecNormalize
+                from stable_baselines3.common.vec_env.vec_frame_stack import VecFrameStack
+            except ImportError:
+                results['vec_env'] = {"skipped": "stable_baselines3 is not installed"}
+            else:
+                # same wrappers as train_eval_model
+                vec_env = VecNormalize(VecFrameStack(DummyVecEnv([lambda: env]), n_stack=3))
+                timer.wrap(env, 'reset', 'reset')
+                vec_env.reset()
+                timer.samples.clear()
+                wrapper_samples = []
+                start = time.perf_counter()
+                for action in actions:
+                    step_start = time.perf_counter()
+                    _, _, dones, _ = vec_env.step(np.array([action]))
+                    vec_step_time = time.perf_counter() - step_start
+                    timer.samples['vec_env_step'].append(vec_step_time)
+                    # wrapper cost is the vec env step minus the env step it wraps, steps that reset the env are
+                    # left out so the round reset handshake does not show up as wrapper overhead
+                    if not dones[0]:
+                        wrapper_samples.append(max(vec_step_time - timer.samples['step'][-1], 0.0))
+                elapsed = time.perf_counter() - start
+                timer.samples['VecFrameStack+VecNormalize'] = wrapper_samples
+                results['vec_env'] = {
+                    "steps_per_sec": args.frames / elapsed,
+                    "stages": timer.summary('vec_env_step'),
+                }
+            env.close()
+        finally:
+            stop_event.set()
+            process.join(timeout=5)
+
+    return results
+
+
+def bench_observation(args) -> dict:
+    from stable_baselines3.common.vec_env import DummyVecEnv, VecNormalize
+    from stable_baselines3.common.vec_env.vec_frame_stack import VecFrameStack
+    from sf6_agent_env import SF6AgentEnv
+
+    fps = 0.0 if args.fps is None else args.fps
+    # the pipeline of train_eval_model against the flat observation with the frame stack in the env
+    pipelines = {
+        "dict+VecFrameStack+VecNormalize": (
+            {"observation_mode": 'dict'},
+            lambda env: VecNormalize(VecFrameStack(DummyVecEnv([lambda: env]), n_stack=3)),
+        ),
+        "flat_stack_3+VecNormalize(reward)": (
+            {"observation_mode": 'flat', "frame_stack": 3, "normalize_observation": True},
+            lambda env: VecNormalize(DummyVecEnv([lambda: env]), norm_obs=False),
+        ),
+        "flat_stack_3": (
+            {"observation_mode": 'flat', "frame_stack": 3, "normalize_observation": True},
+            lambda env: DummyVecEnv([lambda: env]),
+        ),
+    }
+    results = {}
+
+    for name, (env_kwargs, wrap) in pipelines.items():
+        with tempfile.TemporaryDirectory() as env_path, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            process, stop_event = start_emulator_process(env_path, fps=fps, seed=0, transport=args.transport)
+            try:
+                env = SF6AgentEnv(
+                    characters=['luke', 'luke'],
+                    action_space_mapping=action_spaces.create_distinct_action_mapping(),
+                    transport=args.transport,
+                    env_path=env_path,
+                    **env_kwargs,
+                )
+                timer = StageTimer()
+                timer.wrap(env, 'step', 'env_step')
+                vec_env = wrap(env)
+                rng = np.random.default_rng(0)
+                actions = rng.integers(0, env.action_space_size, size=args.frames)
+
+                vec_env.reset()
+                start = time.perf_counter()
+                for action in actions:
+                    step_start = time.perf_counter()
+                    vec_env.step(np.array([action]))
+                    timer.samples['vec_env_step'].append(time.perf_counter() - step_start)
+                elapsed = time.perf_counter() - start
+                overhead = np.asarray(timer.samples['vec_env_step'][-len(timer.samples['env_step']):]) - \
+                    np.asarray(timer.samples['env_step'])
+                timer.samples['wrappers'] = list(np.maximum(overhead, 0.0))
+                results[name] = {
+                    "observation_shape": {key: list(space.shape) for key, space in vec_env.observation_space.spaces.items()}
+                    if hasattr(vec_env.observation_space, 'spaces') else list(vec_env.observation_space.shape),
+                    "steps_per_sec": args.frames / elapsed,
+                    "stages": timer.summary('vec_env_step'),
+                }
+                vec_env.close()
+            finally:
+                stop_event.set()
+                process.join(timeout=5)
+
+    return results
+
+
+def bench_mapping(args) -> dict:
+    from sf6_agent_env import agent_features, create_observation_space
+
+    # every character with a data file
+    characters = sorted(os.path.splitext(name)[0] for name in os.listdir(state_spaces.default_data_path)
+                        if name.endswith('.json') and name != 'act_st.json')
+    repeats = 20
+
+    def timed(fn, clear, cache_path=None):
+        samples = []
+        state_spaces.mapping_cache_path = cache_path
+        for _ in range(repeats):
+            if clear:
+                state_spaces.clear_mapping_caches()
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return float(np.median(samples) * 1e3)
+
+    def load_all():
+        state_spaces.preload_feature_mappings(characters)
+
+    def create_space():
+        create_observation_space(['luke', 'luke'], agent_features, len(action_spaces.create_distinct_action_mapping()),
+                                 True)
+
+    cache_path = state_spaces.mapping_cache_path
+    try:
+        with tempfile.TemporaryDirectory() as binary_cache_path:
+            timed(load_all, clear=True, cache_path=binary_cache_path)  # writes the binary cache
+            results = {
+                "characters": characters,
+                "all_characters_cold_json_ms": timed(load_all, clear=True),
+                "all_characters_cold_binary_cache_ms": timed(load_all, clear=True, cache_path=binary_cache_path),
+                "all_characters_memoized_ms": timed(load_all, clear=False),
+                "observation_space_cold_ms": timed(create_space, clear=True),
+                "observation_space_memoized_ms": timed(create_space, clear=False),
+            }
+    finally:
+        state_spaces.mapping_cache_path = cache_path
+    return results
+
+
+def bench_reward(args) -> dict:
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    all_weights = {name: 1.0 for name in reward_terms}
+    results = {}
+
+    for name, weights in [('hp_delta', None), ('all_terms', all_weights)]:
+        engine = RewardEngine(weights, game_env_format=game_env_format)
+        engine.reset(row)
+        latencies = []
+        for _ in range(args.frames):
+            start = time.perf_counter()
+            engine.step(row)
+            latencies.append(time.perf_counter() - start)
+        results[f"step_{name}"] = summarize_latencies(latencies)
+
+        # relabel of 100 episodes of frames random frames each
+        rows = args.frames * 100
+        rng = np.random.default_rng(0)
+        frame_values = rng.uniform(0, 10000, size=(rows, 2, len(reward_frame_features))).astype(np.float32)
+        episodes = np.stack([np.arange(0, rows, args.frames), np.full(100, args.frames)], axis=1)
+        start = time.perf_counter()
+        relabel_rewards(frame_values, episodes, engine)
+        elapsed = time.perf_counter() - start
+        results[f"relabel_{name}"] = {"rows": rows, "rows_per_sec": rows / elapsed}
+    return results
+
+
+def bench_codec(args) -> dict:
+    from episode_codec import decode_chunk, encode_chunk
+    from sf6_agent_env import SF6AgentEnv
+
+    # records args.frames emulator transitions once, then stores the same rows in every format
+    fps = 0.0 if args.fps is None else args.fps
+    with tempfile.TemporaryDirectory() as env_path, tempfile.TemporaryDirectory() as history_path, \
+            warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        process, stop_event = start_emulator_process(env_path, fps=fps, seed=0, transport=args.transport)
+        try:
+            env = SF6AgentEnv(
+                characters=['luke', 'luke'],
+                action_space_mapping=action_spaces.create_distinct_action_mapping(),
+                transport=args.transport,
+                env_path=env_path,
+                store_history=True,
+                history_path=history_path,
+            )
+            rng = np.random.default_rng(0)
+            env.reset()
+            for _ in range(args.frames):
+                _, _, terminated, _, _ = env.step(int(rng.integers(env.action_space_size)))
+                if terminated:
+                    env.reset()
+            env.close()
+        finally:
+            stop_event.set()
+            process.join(timeout=5)
+
+        from episode_dataset import read_recorded_episode
+        chunks = [chunk for episode in sorted(os.listdir(history_path))
+                  for chunk in read_recorded_episode(os.path.join(history_path, episode))]
+
+    rows = sum(len(chunk['action']) for chunk in chunks)
+    repeats = 5
+
+    def npz_encode(chunk, compressed):
+        with tempfile.TemporaryFile() as f:
+            (np.savez_compressed if compressed else np.savez)(f, **chunk)
+            f.seek(0)
+            return f.read()
+
+    def npz_decode(data):
+        with np.load(io.BytesIO(data)) as chunk:
+            return {key: chunk[key] for key in chunk.files}
+
+    def json_encode(chunk):
+        # observations and actions as lists like the json history of older versions
+        return json.dumps({key: value.tolist() for key, value in chunk.items()}).encode()
+
+    def json_decode(data):
+        return {key: np.asarray(value) for key, value in json.loads(data).items()}
+
+    formats = {
+        "json": (json_encode, json_decode),
+        "npz": (lambda chunk: npz_encode(chunk, False), npz_decode),
+        "npz_compressed": (lambda chunk: npz_encode(chunk, True), npz_decode),
+        "packed": (lambda chunk: encode_chunk(chunk, compress_level=0), decode_chunk),
+        "packed_compressed": (encode_chunk, decode_chunk),
+    }
+    results = {"rows": rows}
+    for name, (encode, decode) in formats.items():
+        start = time.perf_counter()
+        encoded = [encode(chunk) for chunk in chunks]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for data in encoded:
+                decode(data)
+        decode_time = (time.perf_counter() - start) / repeats
+        size = sum(len(data) for data in encoded)
+        results[name] = {
+            "bytes_per_row": size / rows,
+            "encode_rows_per_sec": rows / encode_time,
+            "decode_rows_per_sec": rows / decode_time,
+        }
+
+    # packed chunks decode to the recorded columns exactly
+    for chunk, data in zip(chunks, [encode_chunk(chunk) for chunk in chunks]):
+        decoded = decode_chunk(data)
+        for key, value in chunk.items():
+            if decoded[key].dtype != value.dtype or not np.array_equal(decoded[key], value, equal_nan=True):
+                raise AssertionError(f"Packed column {key} does not decode to the recorded values.")
+    results["size_ratio_npz_compressed"] = results['npz_compressed']['bytes_per_row'] / \
+        results['packed_compressed']['bytes_per_row']
+    return results
+
+
+def bench_policy(args) -> dict:
+    import gymnasium as gym
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.vec_env import DummyVecEnv, VecFrameStack, VecNormalize
+    from numpy_policy import NumpyPolicy, export_policy
+    from sf6_agent_env import agent_features, create_categorical_keys, create_observation_space
+    from sf6_feature_extractors import EmbeddingFeatureExtractor
+
+    action_space_size = len(action_spaces.create_distinct_action_mapping())
+    categorical_keys = create_categorical_keys(['luke', 'luke'], agent_features)
+    frame_stack = 3
+    batch_size = 64
+    rng = np.random.default_rng(0)
+
+    class SpaceEnv(gym.Env):
+        # random observations of the env spaces, no game needed to build and export a policy
+        def __init__(self, observation_space):
+            self.observation_space = observation_space
+            self.action_space = gym.spaces.Discrete(action_space_size)
+
+        def reset(self, seed=None, options=None):
+            return self.observation_space.sample(), {}
+
+        def step(self, action):
+            return self.observation_space.sample(), 0.0, False, False, {}
+
+    dict_space = create_observation_space(['luke', 'luke'], agent_features, action_space_size, True)
+    index_space = create_observation_space(['luke', 'luke'], agent_features, action_space_size, True,
+                                           categorical_encoding='index')
+    flat_space = gym.spaces.Box(-1, 1, (frame_stack * 700,), dtype=np.float32)  # about the size of a flat frame
+    # the policies of train_eval_model for each observation mode
+    setups = {
+        "dict": (dict_space, frame_stack, {}, {}),
+        "index": (index_space, frame_stack, {"norm_obs_keys": [key for key in index_space.spaces
+                                                                 if key not in categorical_keys]},
+                  {"features_extractor_class": EmbeddingFeatureExtractor,
+                   "features_extractor_kwargs": {"categorical_keys": categorical_keys}}),
+        "flat": (flat_space, 1, {"norm_obs": False}, {}),
+    }
+    results = {"device": "cpu"}
+
+    for name, (space, n_stack, normalize_kwargs, extractor_kwargs) in setups.items():
+        vec_env = DummyVecEnv([lambda: SpaceEnv(space)])
+        if n_stack > 1:
+            vec_env = VecFrameStack(vec_env, n_stack=n_stack)
+        vec_env = VecNormalize(vec_env, **normalize_kwargs)
+        vec_env.reset()
+        for _ in range(100):  # running statistics away from the initial ones
+            vec_env.step(np.zeros(1, dtype=np.int64))
+        vec_env.training = False
+        policy = "MultiInputPolicy" if isinstance(space, gym.spaces.Dict) else "MlpPolicy"
+        model = PPO(policy, vec_env, device='cpu',
+                    policy_kwargs=dict(net_arch=dict(pi=[32, 32], vf=[32, 32]), **extractor_kwargs))
+
+        with tempfile.TemporaryDirectory() as path:
+            model.save(os.path.join(path, "model.zip"))
+            vec_env.save(os.path.join(path, "vec_normalize.pkl"))
+            export_policy(os.path.join(path, "model.zip"), os.path.join(path, "policy.npz"),
+                          vec_normalize_path=os.path.join(path, "vec_normalize.pkl"), frame_stack=n_stack)
+            numpy_policy = NumpyPolicy(os.path.join(path, "policy.npz"))
+            batch_policy = NumpyPolicy(os.path.join(path, "policy.npz"), env_num=batch_size)
+
+        observations = [space.sample() for _ in range(200)]
+
+        # same stacked observations through VecNormalize and model.predict
+        torch_latencies = []
+        numpy_latencies = []
+        mismatches = 0
+        for observation in observations:
+            start = time.perf_counter()
+            action = numpy_policy.predict(observation)
+            numpy_latencies.append(time.perf_counter() - start)
+            stacked = numpy_policy.stacked_observations()
+            stacked = stacked if isinstance(space, gym.spaces.Dict) else stacked['obs']
+            start = time.perf_counter()
+            torch_action, _ = model.predict(vec_env.normalize_obs(stacked), deterministic=True)
+            torch_latencies.append(time.perf_counter() - start)
+            mismatches += int(torch_action[0] != action)
+
+        if isinstance(space, gym.spaces.Dict):
+            batch = {key: np.stack([observation[key] for observation in observations[:batch_size]])
+                     for key in observations[0]}
+        else:
+            batch = np.stack(observations[:batch_size])
+        batch_policy.predict_batch(batch)
+        stacked = batch_policy.stacked_observations()
+        stacked = stacked if isinstance(space, gym.spaces.Dict) else stacked['obs']
+        repeats = 100
+        start = time.perf_counter()
+        for _ in range(repeats):
+            batch_policy.predict_batch(batch)
+        numpy_batch = (time.perf_counter() - start) / repeats
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model.predict(vec_env.normalize_obs(stacked), deterministic=True)
+        torch_batch = (time.perf_counter() - start) / repeats
+
+        results[name] = {
+            "model_predict": summarize_latencies(torch_latencies),
+            "numpy_predict": summarize_latencies(numpy_latencies),
+            f"model_predict_batch_{batch_size}_us": torch_batch * 1e6,
+            f"numpy_predict_batch_{batch_size}_us": numpy_batch * 1e6,
+            "action_mismatches": mismatches,
+        }
+    return results
+
+
+def bench_masks(args) -> dict:
+    from action_masks import ActionMaskTable, allowed_actions, create_action_rule_masks, load_act_st_names
+
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    action_mapping = action_spaces.create_distinct_action_mapping()
+    start = time.perf_counter()
+    table = ActionMaskTable(action_mapping, game_env_format=game_env_format)
+    results = {"table_build_ms": (time.perf_counter() - start) * 1e3, "table_bytes": int(table.table.nbytes)}
+
+    latencies = []
+    for _ in range(args.frames):
+        start = time.perf_counter()
+        table.mask(row)
+        latencies.append(time.perf_counter() - start)
+    results["mask"] = summarize_latencies(latencies)
+
+    # the same rules evaluated for the frame without the table
+    rules = create_action_rule_masks(action_mapping)
+    act_st_names = load_act_st_names()
+    latencies = []
+    for _ in range(args.frames):
+        start = time.perf_counter()
+        allowed_actions(rules, act_st_names[row[table.columns[0]]], 0, 3)
+        latencies.append(time.perf_counter() - start)
+    results["rules"] = summarize_latencies(latencies)
+
+    rng = np.random.default_rng(0)
+    count = args.frames * 100
+    act_st = rng.choice([int(value) for value in act_st_names], size=count)
+    frames = [act_st, rng.uniform(0, 1, count) * (rng.random(count) < 0.2), rng.integers(0, 3, count),
+              rng.integers(0, 3, count), rng.integers(0, 40, count), rng.integers(0, 40, count),
+              rng.uniform(0, 60000, count)]
+    start = time.perf_counter()
+    masks = table.masks(*frames)
+    results["batch"] = {"rows": count, "rows_per_sec": count / (time.perf_counter() - start),
+                        "mean_valid_actions": float(masks.sum(axis=1).mean())}
+    return results
+
+
+def bench_index(args) -> dict:
+    from frame_index import FrameIndex, build_frame_index
+
+    # args.frames * 100 synthetic frames in 100 captures of the sample frame with random act_st and action frames
+    row = load_sample_row()
+    game_env_format = load_game_env_format()
+    act_st_values = [int(value) for value in state_spaces.load_act_st()]
+    rng = np.random.default_rng(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as capture_path, tempfile.TemporaryDirectory() as index_path:
+        for capture in range(100):
+            frames = np.repeat(binary_frame_format.rows_to_frames([row], game_env_format), args.frames)
+            frames['header']['frame'] = np.arange(args.frames)
+            players = frames['players']
+            players['act_st'] = rng.choice(act_st_values, size=(args.frames, 2))
+            players['mActionFrame'] = rng.integers(0, 40, size=(args.frames, 2))
+            players['mEndFrame'] = rng.integers(0, 40, size=(args.frames, 2))
+            players['posX'] = rng.uniform(-7.65, 7.65, size=(args.frames, 2))
+            frames.tofile(os.path.join(capture_path, f"{capture:03d}.bin"))
+
+        start = time.perf_counter()
+        build_frame_index([capture_path], index_path, game_env_format)
+        elapsed = time.perf_counter() - start
+        results["build"] = {"rows": args.frames * 100, "rows_per_sec": args.frames * 100 / elapsed}
+
+        index = FrameIndex(index_path)
+        jump = index.act_st_values['JUMP']
+
+        def query_index():
+            return index.find(equals={'0_act_st': jump},
+                              where=lambda columns: columns['1_mEndFrame'] - columns['1_mActionFrame'] <= 10)
+
+        def query_scan():
+            columns = index.columns
+            return np.flatnonzero((columns['0_act_st'] == jump) &
+                                  (columns['1_mEndFrame'] - columns['1_mActionFrame'] <= 10))
+
+        for name, query in [('query_index', query_index), ('query_scan', query_scan)]:
+            query()
+            latencies = []
+            for _ in range(20):
+                start = time.perf_counter()
+                rows = query()
+                latencies.append(time.perf_counter() - start)
+            results[name] = {"matches": len(rows), "mean_ms": float(np.mean(latencies)) * 1e3}
+
+        start = time.perf_counter()
+        rows = index.find(rows=index.episode_last_rows, where=lambda columns: np.abs(columns['0_posX']) > 7)
+        results["episode_ends"] = {"matches": len(rows), "ms": (time.perf_counter() - start) * 1e3}
+    return results
+
+
+def bench_frame_skip(args) -> dict:
+    from sf6_agent_env import SF6AgentEnv
+
+    fps = 0.0 if args.fps is None else args.fps
+    modes = {
+        "every_frame": {"frame_skip": 1, "skip_inactive": False},
+        "skip_inactive": {"frame_skip": 1, "skip_inactive": True},
+        "frame_skip_4": {"frame_skip": 4, "skip_inactive": False},
+        "frame_skip_4+skip_inactive": {"frame_skip": 4, "skip_inactive": True},
+    }
+    results = {}
+
+    for name, mode in modes.items():
+        with tempfile.TemporaryDirectory() as env_path, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            process, stop_event = start_emulator_process(env_path, fps=fps, seed=0, transport=args.transport)
+            try:
+                env = SF6AgentEnv(
+                    characters=['luke', 'luke'],
+                    action_space_mapping=action_spaces.create_distinct_action_mapping(),
+                    transport=args.transport,
+                    env_path=env_path,
+                    **mode,
+                )
+                rng = np.random.default_rng(0)
+                env.reset()
+                frames = 0
+                policy_calls = 0
+                episodes = 0
+                start = time.perf_counter()
+                # same number of game frames for every mode
+                while frames < args.frames:
+                    _, _, terminated, _, info = env.step(int(rng.integers(env.action_space_size)))
+                    frames += info['frames']
+                    policy_calls += 1
+                    if terminated:
+                        episodes += 1
+                        env.reset()
+                elapsed = time.perf_counter() - start
+                env.close()
+                results[name] = {
+                    "frames": frames,
+                    "policy_calls": policy_calls,
+                    "frames_per_policy_call": frames / policy_calls,
+                    "policy_calls_per_episode": policy_calls / episodes if episodes else None,
+                    "frames_per_sec": frames / elapsed,
+                }
+            finally:
+                stop_event.set()
+                process.join(timeout=5)
+
+    return results
+
+
+def bench_self_play(args) -> dict:
+    from sf6_self_play import SelfPlayVecEnv
+    from sf6_vec_env import create_instance_env_paths, make_sf6_vec_env
+
+    # transitions per emulated frame and per second of single agent envs against mirror self play on the same games,
+    # both with --policy-ms of simulated inference per vec env step (one batched call for both players)
+    # self play sends every action line before waiting on a game, the threaded single agent envs overlap their waits
+    # the same way and are the baseline, dummy steps the games one after another and is only reported for reference
+    fps = 0.0 if args.fps is None else args.fps
+    game_num = args.env_nums[-1]
+    steps = max(args.frames // game_num, 1)
+    action_mapping = action_spaces.create_distinct_action_mapping()
+    results = {"games": game_num, "fps": fps, "policy_ms": args.policy_ms}
+
+    for mode in ['single_dummy', 'single_threaded', 'mirror']:
+        with tempfile.TemporaryDirectory() as base_path, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            env_paths = create_instance_env_paths(base_path, game_num)
+            emulators = [start_emulator_process(env_path, fps=fps, seed=i, transport=args.transport,
+                                                frame_latency=args.frame_latency_ms / 1e3)
+                         for i, env_path in enumerate(env_paths)]
+            try:
+                if mode != 'mirror':
+                    vec_env = make_sf6_vec_env(
+                        env_paths=env_paths,
+                        env_kwargs={"characters": ['luke', 'luke'], "action_space_mapping": action_mapping,
+                                    "transport": args.transport, "wait_strategy": args.wait_strategy},
+                        history_path=os.path.join(base_path, "history"),
+                        vec_env=mode[len('single_'):],
+                    )
+                else:
+                    vec_env = SelfPlayVecEnv(env_paths, ['luke', 'luke'], action_mapping, mode='mirror',
+                                             transport=args.transport, wait_strategy=args.wait_strategy)
+                rng = np.random.default_rng(0)
+                actions = rng.integers(0, len(action_mapping), size=(steps, vec_env.num_envs))
+
+                vec_env.reset()
+                start = time.perf_counter()
+                for action in actions:
+                    time.sleep(args.policy_ms / 1e3)  # stand in for policy inference
+                    vec_env.step(action)
+                elapsed = time.perf_counter() - start
+                vec_env.close()
+                results[mode] = {
+                    "samples_per_frame": vec_env.num_envs / game_num,
+                    "samples_per_sec": steps * vec_env.num_envs / elapsed,
+                    "frames_per_sec": steps * game_num / elapsed,
+                }
+            finally:
+                for process, stop_event in emulators:
+                    stop_event.set()
+                    process.join(timeout=5)
+
+    results['mirror']['speedup'] = results['mirror']['samples_per_sec'] / results['single_threaded']['samples_per_sec']
+    return results
+
+
+def bench_async(args) -> dict:
+    from sf6_vec_env import create_instance_env_paths, make_sf6_vec_env
+
+    # unthrottled games that take frame_latency_ms to answer an action, so the waits of several envs can overlap
+    fps = 0.0 if args.fps is None else args.fps
+    env_num = args.env_nums[-1]
+    steps = max(args.frames // env_num, 1)
+    results = {"env_num": env_num, "fps": fps, "frame_latency_ms": args.frame_latency_ms, "policy_ms": args.policy_ms,
+               "wait_strategy": args.wait_strategy}
+
+    for vec_env_name in ['dummy', 'threaded', 'subproc']:
+        with tempfile.TemporaryDirectory() as base_path, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            env_paths = create_instance_env_paths(base_path, env_num)
+            emulators = [start_emulator_process(env_path, fps=fps, seed=i, transport=args.transport,
+                                                frame_latency=args.frame_latency_ms / 1e3)
+                         for i, env_path in enumerate(env_paths)]
+            try:
+                vec_env = make_sf6_vec_env(
+                    env_paths=env_paths,
+                    env_kwargs={
+                        "characters": ['luke', 'luke'],
+                        "action_space_mapping": action_spaces.create_distinct_action_mapping(),
+                        "transport": args.transport,
+                        "wait_strategy": args.wait_strategy,
+                    },
+                    history_path=os.path.join(base_path, "history"),
+                    vec_env=vec_env_name,
+                )
+                rng = np.random.default_rng(0)
+                actions = rng.integers(0, vec_env.action_space.n, size=(steps, env_num))
+
+                vec_env.reset()
+                start = time.perf_counter()
+                for action in actions:
+                    time.sleep(args.policy_ms / 1e3)  # stand in for policy inference
+                    vec_env.step(action)
+                elapsed = time.perf_counter() - start
+                vec_env.close()
+                results[vec_env_name] = {
+                    "steps_per_sec": steps * env_num / elapsed,
+                    "vec_step_ms": elapsed / steps * 1e3,
+                }
+            finally:
+                for process, stop_event in emulators:
+                    stop_event.set()
+                    process.join(timeout=5)
+
+    return results
+
+
+def bench_scaling(args) -> dict:
+    from sf6_vec_env import create_instance_env_paths, make_sf6_vec_env
+
+    fps = 0.0 if args.fps is None else args.fps
+    results = {"cpu_count": os.cpu_count()}
+
+    for env_num in args.env_nums:
+        with tempfile.TemporaryDirectory() as base_path, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            env_paths = create_instance_env_paths(base_path, env_num)
+            emulators = [start_emulator_process(env_path, fps=fps, seed=i, transport=args.transport,
+                                                frame_latency=args.frame_latency_ms / 1e3)
+                         for i, env_path in enumerate(env_paths)]
+            try:
+                vec_env = make_sf6_vec_env(
+                    env_paths=env_paths,
+                    env_kwargs={
+                        "characters": ['luke', 'luke'],
+                        "action_space_mapping": action_spaces.create_distinct_action_mapping(),
+                        "keep_prev_action": True,
+                        "store_history": args.store_history,
+                        "transport": args.transport,
+                        "wait_strategy": args.wait_strategy,
+                    },
+                    history_path=os.path.join(base_path, "history"),
+                )
+                rng = np.random.default_rng(0)
+                steps = max(args.frames // env_num, 1)
+                actions = rng.integers(0, vec_env.action_space.n, size=(steps, env_num))
+
+                vec_env.reset()
+                start = time.perf_counter()
+                for action in actions:
+                    vec_env.step(action)
+                elapsed = time.perf_counter() - start
+                vec_env.close()
+                results[str(env_num)] = {
+                    "steps_per_sec": steps * env_num / elapsed,
+                    "vec_steps_per_sec": steps / elapsed,
+                }
+            finally:
+                for process, stop_event in emulators:
+                    stop_event.set()
+                    process.join(timeout=5)
+
+    base = results[str(args.env_nums[0])]['steps_per_sec']
+    for env_num in args.env_nums:
+        results[str(env_num)]['speedup'] = results[str(env_num)]['steps_per_sec'] / base
+    return results
+
+
+benchmarks = {
+    'async': bench_async,
+    'categorical': bench_categorical,
+    'codec': bench_codec,
+    'decode': bench_decode,
+    'mapping': bench_mapping,
+    'masks': bench_masks,
+    'observation': bench_observation,
+    'policy': bench_policy,
+    'reward': bench_reward,
+    'frame-skip': bench_frame_skip,
+    'index': bench_index,
+    'scaling': bench_scaling,
+    'self-play': bench_self_play,
+    'step': bench_step,
+    'frame-format': bench_frame_format,
+    'encode': bench_encode,
+    'transport': bench_transport,
+    'wait': bench_wait,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SF6 env micro benchmarks, results are written as json.")
+    parser.add_argument('benchmark', choices=sorted(benchmarks.keys()))
+    parser.add_argument('--frames', type=int, default=10000)
+    parser.add_argument('--fps', type=float, default=None,
+                        help="frame rate of the stand in game side, 60 for wait and unthrottled for step")
+    parser.add_argument('--transport', choices=['file', 'shm'], default='file')
+    parser.add_argument('--store-history', action='store_true')
+    parser.add_argument('--wait-strategy', choices=sorted(wait_strategies.keys()), default='spin',
+                        help="wait strategy of the envs in the scaling benchmark, spinning envs need a core each")
+    parser.add_argument('--policy-ms', type=float, default=2.0,
+                        help="simulated policy inference time per vec env step in the async and self-play benchmarks")
+    parser.add_argument('--frame-latency-ms', type=float, default=4.0,
+                        help="time the emulators of the async benchmark take to answer an action")
+    parser.add_argument('--env-nums', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="env counts for the scaling benchmark, one emulator per env, the async and self-play "
+                             "benchmarks use the last")
+    parser.add_argument('--capture', default=None,
+                        help="csv capture of game env frames for the decode benchmark, an emulated trace otherwise")
+    parser.add_argument('--output', default=None, help="json output path, defaults to stdout")
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    results = {
+        "benchmark": args.benchmark,
+        "timestamp": time.strftime('%Y%m%d_%H%M%S'),
+        "commit": commit or None,
+        "python": sys.version.split()[0],
+        "results": benchmarks[args.benchmark](args),
+    }
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import warnings
+
+from stable_baselines3.common.callbacks import BaseCallback, CheckpointCallback
+
+from env_telemetry import publish_telemetry, summarize_telemetry
+
+
+class TelemetryCallback(BaseCallback):
+    # collects the telemetry of every env created with telemetry=True and records it to the sb3 logger
+    def __init__(self, log_freq: int = 4096, verbose: int = 0):
+        super().__init__(verbose)
+        self.log_freq = log_freq
+
+    def _on_step(self) -> bool:
+        if self.n_calls % self.log_freq == 0:
+            snapshots = [snapshot for snapshot in self.training_env.env_method('get_telemetry')
+                         if snapshot is not None]
+            if snapshots:
+                publish_telemetry(summarize_telemetry(snapshots), self.logger)
+        return True
+
+
+class SelfPlaySnapshotCallback(BaseCallback):
+    # exports the policy every save_freq calls with numpy_policy.export_policy and adds it to the opponents of the
+    # sf6_self_play.SelfPlayVecEnv under the wrappers, frame_stack is the n_stack of the VecFrameStack
+    def __init__(self, save_freq: int, save_path: str, frame_stack: int = 1, verbose: int = 0):
+        super().__init__(verbose)
+        self.save_freq = save_freq
+        self.save_path = save_path
+        self.frame_stack = frame_stack
+
+    def _init_callback(self) -> None:
+        os.makedirs(self.save_path, exist_ok=True)
+
+    def _on_step(self) -> bool:
+        if self.n_calls % self.save_freq == 0:
+            from numpy_policy import export_policy
+
+            prefix = os.path.join(self.save_path, f"snapshot_{self.num_timesteps}")
+            self.model.save(prefix)
+            vec_normalize_path = None
+            vec_normalize = self.model.get_vec_normalize_env()
+            if vec_normalize is not None:
+                vec_normalize_path = f"{prefix}_vecnormalize.pkl"
+                vec_normalize.save(vec_normalize_path)
+            export_policy(f"{prefix}.zip", f"{prefix}.npz", vec_normalize_path=vec_normalize_path,
+                          frame_stack=self.frame_stack)
+            self.training_env.unwrapped.add_opponent(f"{prefix}.npz")
+            if self.verbose >= 1:
+                print(f"Added self play opponent {prefix}.npz")
+        return True
+
+
+class AsyncEvalCallback(CheckpointCallback):
+    # saves checkpoints like CheckpointCallback and hands each one to an sf6_eval_service.EvaluationService,
+    # training never waits for an evaluation, with wait_on_end the last evaluations finish before learn returns
+    def __init__(self, service, save_freq: int, save_path: str, name_prefix: str = "rl_model",
+                 wait_on_end: bool = True, verbose: int = 0):
+        # the evaluation workers need the normalization of every checkpoint
+        super().__init__(save_freq, save_path, name_prefix=name_prefix, save_vecnormalize=True, verbose=verbose)
+        self.service = service
+        self.wait_on_end = wait_on_end
+
+    def _init_callback(self) -> None:
+        super()._init_callback()
+        if self.logger.get_dir() is not None:
+            self.service.set_log_dir(self.logger.get_dir())
+
+    def _on_step(self) -> bool:
+        super()._on_step()
+        if self.n_calls % self.save_freq == 0:
+            vec_normalize_path = self._checkpoint_path("vecnormalize_", extension="pkl")
+            if not os.path.exists(vec_normalize_path):
+                vec_normalize_path = None
+            self.service.submit(self.num_timesteps, self._checkpoint_path(extension="zip"), vec_normalize_path)
+        return True
+
+    def _on_training_end(self) -> None:
+        # a stalled eval game instance must not keep learn() from returning
+        if self.wait_on_end and not self.service.wait(timeout=self.service.eval_timeout):
+            warnings.warn(f"Evaluations still running after {self.service.eval_timeout}s, not waiting for them.")
@@ -0,0 +1,235 @@
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import warnings
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List
+
+import numpy as np
+
+# state of an evaluation worker process, every worker owns one game instance (env path) for its whole life
+worker_env = None
+worker_env_path = None
+worker_config = None
+
+
+def init_eval_worker(env_path_queue, env_kwargs: dict, frame_stack: int, torch_threads: int):
+    global worker_env_path, worker_config
+    import torch as th
+
+    # workers share the machine with training, torch would start a thread per core in every worker
+    th.set_num_threads(torch_threads)
+    worker_env_path = env_path_queue.get()
+    worker_config = (env_kwargs, frame_stack)
+
+
+def get_worker_env():
+    # created on the first evaluation and reused, VecNormalize statistics are loaded per checkpoint on top of it
+    global worker_env
+    if worker_env is None:
+        from stable_baselines3.common.vec_env import DummyVecEnv, VecFrameStack
+
+        from sf6_vec_env import make_env_fn
+
+        env_kwargs, frame_stack = worker_config
+        worker_env = DummyVecEnv([make_env_fn(worker_env_path, env_kwargs, monitor=True)])
+        if frame_stack is not None:
+            worker_env = VecFrameStack(worker_env, n_stack=frame_stack)
+    return worker_env
+
+
+def evaluate_checkpoint(model_path: str, vec_normalize_path: str, n_eval_episodes: int, deterministic: bool) -> dict:
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.evaluation import evaluate_policy
+    from stable_baselines3.common.vec_env import VecNormalize
+
+    start = time.perf_counter()
+    env = get_worker_env()
+    if vec_normalize_path is not None:
+        env = VecNormalize.load(vec_normalize_path, env)
+        # frozen statistics of the checkpoint, rewards are reported unnormalized
+        env.training = False
+        env.norm_reward = False
+    model = PPO.load(model_path, device='cpu')
+    rewards, lengths = evaluate_policy(model, env, n_eval_episodes=n_eval_episodes, deterministic=deterministic,
+                                       return_episode_rewards=True)
+    return {"rewards": rewards, "lengths": lengths, "env_path": worker_env_path,
+            "seconds": time.perf_counter() - start}
+
+
+class EvaluationService:
+    # evaluates checkpoints in a pool of worker processes, one per eval env path, against their own game instances
+    # with the frozen VecNormalize statistics of each checkpoint, results are written to tensorboard and
+    # <log_path>/evaluations.npz when they arrive and the best checkpoint is copied to best_model_save_path
+    # frame_stack is the n_stack of the VecFrameStack of dict observations, None for flat observations
+    # eval_timeout bounds every evaluation, frame waits of a stalled game instance never return so an evaluation
+    # running longer is counted as failed and its pool recreated on the next submit, close() waits as long at most
+    def __init__(self, env_paths: List[str], env_kwargs: dict, frame_stack: int = None, n_eval_episodes: int = 5,
+                 deterministic: bool = True, best_model_save_path: str = None, log_path: str = None,
+                 torch_threads: int = 1, eval_timeout: float = 600.0):
+        self.env_paths = env_paths
+        self.n_eval_episodes = n_eval_episodes
+        self.deterministic = deterministic
+        self.best_model_save_path = best_model_save_path
+        self.log_path = log_path
+        self.eval_timeout = eval_timeout
+
+        # evaluation envs never record history or telemetry
+        env_kwargs = dict(env_kwargs)
+        env_kwargs.update({"store_history": False, "telemetry": False})
+        self.worker_args = (env_kwargs, frame_stack, torch_threads)
+        self.executor = self.create_executor()
+
+        self.lock = threading.Lock()
+        # notified when a result was handled, futures stay pending until their results are written
+        self.handled = threading.Condition(self.lock)
+        self.writer = None
+        self.pending = []
+        self.submit_times = {}  # pending future -> time it was submitted
+        self.skipped = 0  # checkpoints not evaluated as every worker was busy
+        self.failed = 0
+        self.timed_out = 0  # evaluations still running after eval_timeout, also counted as failed
+        self.restarts = 0  # pools recreated after a worker crashed or an evaluation timed out
+        self.timesteps = []
+        self.results = []
+        self.ep_lengths = []
+        self.best_mean_reward = -np.inf
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        env_kwargs, frame_stack, torch_threads = self.worker_args
+        context = multiprocessing.get_context('spawn')
+        env_path_queue = context.Queue()
+        for env_path in self.env_paths:
+            env_path_queue.put(env_path)
+        return ProcessPoolExecutor(max_workers=len(self.env_paths), mp_context=context, initializer=init_eval_worker,
+                                   initargs=(env_path_queue, env_kwargs, frame_stack, torch_threads))
+
+    def terminate_workers(self, executor: ProcessPoolExecutor):
+        # the pool has no api to stop a running task, its futures fail with BrokenProcessPool
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def set_log_dir(self, log_dir: str):
+        # tensorboard directory of the training run, the results are written to their own event file in it
+        from torch.utils.tensorboard import SummaryWriter
+
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = SummaryWriter(log_dir=log_dir)
+
+    def submit(self, timesteps: int, model_path: str, vec_normalize_path: str = None) -> Future:
+        # returns None without evaluating when every worker is still busy, training never waits for an evaluation
+        with self.lock:
+            self.restart_stalled()
+            if len(self.pending) >= len(self.env_paths):
+                self.skipped += 1
+                warnings.warn(f"Every evaluation worker is busy, {model_path} is skipped ({self.skipped} skipped).")
+                return None
+            try:
+                future = self.executor.submit(evaluate_checkpoint, model_path, vec_normalize_path,
+                                              self.n_eval_episodes, self.deterministic)
+            except BrokenProcessPool:
+                # a worker crashed, the checkpoint is counted as failed and the next one goes to a new pool
+                self.failed += 1
+                self.restarts += 1
+                warnings.warn(f"Evaluation pool broke, {model_path} was not evaluated and the pool is recreated.")
+                self.terminate_workers(self.executor)
+                self.executor = self.create_executor()
+                return None
+            self.pending.append(future)
+            self.submit_times[future] = time.perf_counter()
+        future.add_done_callback(lambda done: self.on_result(timesteps, model_path, vec_normalize_path, done))
+        return future
+
+    def restart_stalled(self):
+        # called with the lock held, a stalled evaluation would keep its worker busy forever and every later
+        # checkpoint skipped, the pool is terminated and recreated and all its running evaluations are dropped
+        now = time.perf_counter()
+        stalled = [future for future in self.pending if now - self.submit_times[future] > self.eval_timeout]
+        if not stalled:
+            return
+        self.timed_out += len(stalled)
+        self.failed += len(self.pending)
+        self.restarts += 1
+        warnings.warn(f"{len(stalled)} evaluations did not finish within {self.eval_timeout}s, terminating the "
+                      f"workers and dropping {len(self.pending)} running evaluations.")
+        # dropped futures fail with BrokenProcessPool, on_result ignores futures no longer pending
+        self.pending.clear()
+        self.submit_times.clear()
+        self.terminate_workers(self.executor)
+        self.executor = self.create_executor()
+        self.handled.notify_all()
+
+    def on_result(self, timesteps: int, model_path: str, vec_normalize_path: str, future: Future):
+        with self.lock:
+            dropped = future not in self.submit_times
+        try:
+            if not future.cancelled() and not dropped:
+                self.write_result(timesteps, model_path, vec_normalize_path, future)
+        finally:
+            with self.lock:
+                if future in self.submit_times:
+                    self.pending.remove(future)
+                    del self.submit_times[future]
+                self.handled.notify_all()
+
+    def write_result(self, timesteps: int, model_path: str, vec_normalize_path: str, future: Future):
+        if future.exception() is not None:
+            self.failed += 1
+            warnings.warn(f"Evaluation of {model_path} failed: {future.exception()!r}")
+            return
+        result = future.result()
+        rewards = np.asarray(result["rewards"], dtype=np.float64)
+        lengths = np.asarray(result["lengths"], dtype=np.int64)
+        mean_reward = float(rewards.mean())
+
+        with self.lock:
+            self.timesteps.append(timesteps)
+            self.results.append(rewards)
+            self.ep_lengths.append(lengths)
+            if self.writer is not None:
+                self.writer.add_scalar("eval/mean_reward", mean_reward, timesteps)
+                self.writer.add_scalar("eval/std_reward", float(rewards.std()), timesteps)
+                self.writer.add_scalar("eval/mean_ep_length", float(lengths.mean()), timesteps)
+                self.writer.add_scalar("eval/seconds", result["seconds"], timesteps)
+                self.writer.flush()
+            if self.log_path is not None:
+                os.makedirs(self.log_path, exist_ok=True)
+                # same layout as the evaluations.npz of EvalCallback, in the order the results arrived
+                np.savez(os.path.join(self.log_path, "evaluations"), timesteps=self.timesteps,
+                         results=self.results, ep_lengths=self.ep_lengths)
+            if mean_reward > self.best_mean_reward:
+                self.best_mean_reward = mean_reward
+                if self.best_model_save_path is not None:
+                    os.makedirs(self.best_model_save_path, exist_ok=True)
+                    shutil.copyfile(model_path, os.path.join(self.best_model_save_path, "best_model.zip"))
+                    if vec_normalize_path is not None:
+                        shutil.copyfile(vec_normalize_path,
+                                        os.path.join(self.best_model_save_path, "best_model_vecnormalize.pkl"))
+
+    def wait(self, timeout: float = None) -> bool:
+        # True once every submitted evaluation was written, False when timeout seconds passed before
+        with self.lock:
+            return self.handled.wait_for(lambda: not self.pending, timeout=timeout)
+
+    def stats(self) -> dict:
+        return {"evaluations": len(self.results), "skipped": self.skipped, "failed": self.failed,
+                "timed_out": self.timed_out, "restarts": self.restarts, "best_mean_reward": self.best_mean_reward}
+
+    def close(self, wait: bool = True):
+        # with wait the running evaluations get eval_timeout seconds to finish, workers still running are terminated
+        if wait and not self.wait(timeout=self.eval_timeout):
+            warnings.warn(f"Evaluations did not finish within {self.eval_timeout}s, terminating the workers.")
+        if wait and not self.pending:
+            self.executor.shutdown(wait=True)
+        else:
+            self.terminate_workers(self.executor)
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -0,0 +1,37 @@
+from typing import Dict, List
+
+import torch as th
+from gymnasium import spaces
+from stable_baselines3.common.preprocessing import get_flattened_obs_dim
+from stable_baselines3.common.torch_layers import BaseFeaturesExtractor
+from torch import nn
+
+
+class EmbeddingFeatureExtractor(BaseFeaturesExtractor):
+    # feature extractor for SF6AgentEnv(categorical_encoding='index'), the index of every categorical key is
+    # looked up in its own embedding table and every other key is flattened as in CombinedExtractor
+    # works with VecFrameStack, a stacked key holds one index per frame and gets one embedding per frame
+    def __init__(self, observation_space: spaces.Dict, categorical_keys: List[str], embedding_dim: int = 16):
+        embeddings = {}
+        features_dim = 0
+        for key, subspace in observation_space.spaces.items():
+            if key in categorical_keys:
+                # the highest index marks values missing from the mapping
+                embeddings[key] = nn.Embedding(int(subspace.high.max()) + 1, embedding_dim)
+                features_dim += get_flattened_obs_dim(subspace) * embedding_dim
+            else:
+                features_dim += get_flattened_obs_dim(subspace)
+        super().__init__(observation_space, features_dim=features_dim)
+
+        self.keys = list(observation_space.spaces.keys())
+        self.embeddings = nn.ModuleDict(embeddings)
+
+    def forward(self, observations: Dict[str, th.Tensor]) -> th.Tensor:
+        encoded = []
+        for key in self.keys:
+            observation = observations[key]
+            if key in self.embeddings:
+                encoded.append(self.embeddings[key](observation.long()).flatten(start_dim=1))
+            else:
+                encoded.append(observation.flatten(start_dim=1))
+        return th.cat(encoded, dim=1)
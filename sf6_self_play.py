@@ -0,0 +1,301 @@
+import os
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Callable, List
+
+import gymnasium as gym
+import numpy as np
+from stable_baselines3.common.vec_env import VecEnv
+
+import state_spaces
+from action_spaces import ActionTable
+from game_state import SF6GameState
+from numpy_policy import NumpyPolicy
+from observation_encoder import ObservationEncoder, parse_row
+from reward_engine import RewardEngine, reward_frame_features
+from sf6_agent_env import agent_features, create_observation_space
+
+# 'mirror' both players of every game are agents of the vec env, env 2 * game is player 0 and 2 * game + 1 player 1
+# 'snapshot' player 0 is the agent and player 1 is played by a frozen exported policy
+self_play_modes = ['mirror', 'snapshot']
+
+
+def create_swap_columns(game_env_format: List[str]) -> np.ndarray:
+    # columns of a frame row with the players swapped, the row as player 1 sees it
+    feature_count = len(game_env_format)
+    return np.concatenate([[0], np.arange(1 + feature_count, 1 + 2 * feature_count),
+                           np.arange(1, 1 + feature_count)])
+
+
+class PolicyCache:
+    # least recently used exported policies, loading a snapshot only happens on a miss
+    # games keep a reference to their policy so an evicted policy lives until its games pick another one
+    def __init__(self, capacity: int = 4, env_num: int = 1, loader: Callable[..., NumpyPolicy] = NumpyPolicy):
+        self.capacity = capacity
+        self.env_num = env_num
+        self.loader = loader
+        self.policies = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str) -> NumpyPolicy:
+        policy = self.policies.get(path)
+        if policy is not None:
+            self.policies.move_to_end(path)
+            self.hits += 1
+            return policy
+        self.misses += 1
+        policy = self.loader(path, env_num=self.env_num)
+        self.policies[path] = policy
+        while len(self.policies) > self.capacity:
+            self.policies.popitem(last=False)
+        return policy
+
+
+class SelfPlayVecEnv(VecEnv):
+    # plays both sides of every game, the action line of a game carries the keys of both players and the
+    # observations of both players are encoded from one parsed frame, player 1 sees the frame with the players swapped
+    # in 'mirror' mode the policy acts for both players in the same batched forward pass, in 'snapshot' mode the
+    # opponents are exported policies (numpy_policy.export_policy) sampled from opponent_paths at every reset,
+    # games without an opponent (no opponent_paths yet) are played against the game side
+    def __init__(self, env_paths: List[str], characters, action_space_mapping, mode: str = 'mirror',
+                 opponent_paths: List[str] = None, opponent_cache_size: int = 4, keep_prev_action: bool = True,
+                 reward_weights=None, categorical_encoding: str = 'one_hot', transport: str = 'file',
+                 wait_strategy: str = 'spin', reset_timeout: float = 2.0, reset_retries: int = 3, seed: int = None):
+        if mode not in self_play_modes:
+            raise ValueError(f"Unknown self play mode {mode}, expected one of {self_play_modes}.")
+        self.mode = mode
+        self.game_num = len(env_paths)
+        self.keep_prev_action = keep_prev_action
+        self.features = list(agent_features)
+
+        feature_mappings = [state_spaces.create_feature_mapping_for_character(character) for character in characters]
+        self.games = [
+            SF6GameState(
+                feature_mapping={0: feature_mappings[0], 1: feature_mappings[1]},
+                game_env_player_features={0: self.features, 1: self.features},
+                transport=transport,
+                wait_strategy=wait_strategy,
+                env_path=env_path,
+                reset_timeout=reset_timeout,
+                reset_retries=reset_retries,
+                categorical_encoding=categorical_encoding,
+            )
+            for env_path in env_paths
+        ]
+        for game in self.games:
+            # without the player 2 key mapping the lua script drops the keys of player 1 and the game plays it
+            opponent_mapping_path = game.env_paths['opponent_action_key_mapping_path']
+            if not os.path.exists(opponent_mapping_path):
+                raise FileNotFoundError(f"No player 2 key mapping at {opponent_mapping_path}, the game side can not "
+                                        f"accept inputs for player 1, copy env/action_key_mapping_p2.json there and "
+                                        f"bind its keys to player 2 in the game.")
+        self.game_env_format = self.games[0].game_env_format
+        self.game_env_length = self.games[0].game_env_length
+        self.swap_columns = create_swap_columns(self.game_env_format)
+
+        # encoders of the frame as player 0 and of the swapped frame as player 1
+        self.encoders = [
+            ObservationEncoder(self.game_env_format, {0: self.features, 1: self.features},
+                               {0: feature_mappings[player_id], 1: feature_mappings[1 - player_id]},
+                               categorical_encoding=categorical_encoding)
+            for player_id in [0, 1]
+        ]
+        self.observation_spaces = [
+            create_observation_space(characters=[characters[player_id], characters[1 - player_id]],
+                                     features=self.features, action_space_size=len(action_space_mapping),
+                                     keep_prev_action=keep_prev_action, categorical_encoding=categorical_encoding)
+            for player_id in [0, 1]
+        ]
+        if mode == 'mirror' and self.observation_spaces[0] != self.observation_spaces[1]:
+            raise ValueError(f"Mirror self play needs the same observation space for both players, got {characters}.")
+
+        self.action_table = ActionTable(action_space_mapping, len(self.games[0].action_event_mapping))
+        self.reward_engine = RewardEngine(reward_weights)
+        self.reward_columns = np.array([
+            [1 + player_id * len(self.game_env_format) + self.game_env_format.index(feature)
+             for feature in reward_frame_features]
+            for player_id in [0, 1]
+        ])
+
+        self.frames = np.zeros((self.game_num, self.game_env_length), dtype=np.float64)
+        self.previous_values = np.zeros((self.game_num, 2, len(reward_frame_features)), dtype=np.float64)
+        # last action of each player of each game, -1 before the first action of an episode
+        self.last_actions = np.full((self.game_num, 2), -1, dtype=np.int64)
+        self.episode_steps = np.zeros(self.game_num, dtype=np.int64)
+
+        self.opponent_paths = list(opponent_paths or [])
+        self.policy_cache = PolicyCache(capacity=opponent_cache_size, env_num=self.game_num)
+        self.opponents = [None] * self.game_num  # policy playing player 1 of each game
+        self.opponent_names = [None] * self.game_num
+        self.rng = np.random.default_rng(seed)
+
+        env_num = 2 * self.game_num if mode == 'mirror' else self.game_num
+        super().__init__(env_num, self.observation_spaces[0], gym.spaces.Discrete(len(action_space_mapping)))
+        self.actions = None
+
+    def add_opponent(self, path: str):
+        # new snapshots are sampled from the next reset of a game on
+        self.opponent_paths.append(path)
+
+    def read_frame(self, game_idx: int):
+        # values that do not parse are nan, the encoders treat them like encode() does
+        parse_row(self.games[game_idx].current_game_state[:self.game_env_length], self.frames[game_idx])
+
+    def encode(self, player_id: int, frames: np.ndarray) -> dict:
+        encoded = self.encoders[player_id].encode_batch(frames)
+        if self.keep_prev_action:
+            actions = self.last_actions[:, player_id]
+            encoded['prev_action'] = np.where((actions >= 0)[:, None], self.action_table.one_hot[actions],
+                                              self.action_table.no_action)
+        return {key: encoded[key] for key in self.observation_space.spaces}
+
+    def get_observations(self):
+        # (agent observations, player 1 observations), the players of a game are encoded from the same parsed row
+        swapped = self.frames[:, self.swap_columns]
+        if self.mode == 'mirror':
+            interleaved = np.empty((2 * self.game_num, self.game_env_length), dtype=np.float64)
+            interleaved[0::2] = self.frames
+            interleaved[1::2] = swapped
+            # prev actions are interleaved the same way
+            encoded = self.encoders[0].encode_batch(interleaved)
+            if self.keep_prev_action:
+                actions = self.last_actions.reshape(-1)
+                encoded['prev_action'] = np.where((actions >= 0)[:, None], self.action_table.one_hot[actions],
+                                                  self.action_table.no_action)
+            return {key: encoded[key] for key in self.observation_space.spaces}, None
+        return self.encode(0, self.frames), self.encode(1, swapped)
+
+    def select_opponents(self, game_indices):
+        for game_idx in game_indices:
+            if not self.opponent_paths:
+                self.opponents[game_idx] = None
+                self.opponent_names[game_idx] = None
+                continue
+            path = self.opponent_paths[int(self.rng.integers(len(self.opponent_paths)))]
+            self.opponents[game_idx] = self.policy_cache.get(path)
+            self.opponents[game_idx].reset(game_idx)
+            self.opponent_names[game_idx] = path
+
+    def act_opponents(self, opponent_observations):
+        # one batched forward pass per snapshot in play, every snapshot stacks the frames of all games
+        opponent_actions = np.full(self.game_num, -1, dtype=np.int64)
+        for policy in {id(policy): policy for policy in self.opponents if policy is not None}.values():
+            actions = policy.predict_batch(opponent_observations)
+            for game_idx, opponent in enumerate(self.opponents):
+                if opponent is policy:
+                    opponent_actions[game_idx] = actions[game_idx]
+        return opponent_actions
+
+    def reset_games(self, game_indices):
+        # the resets of all games run together, the game side of each is answered as its frames arrive
+        pending = []
+        for game_idx in game_indices:
+            if self.games[game_idx].start_reset():
+                pending.append(game_idx)
+            else:
+                self.games[game_idx].send_reset()
+        while pending:
+            pending = [game_idx for game_idx in pending if not self.games[game_idx].poll_reset()]
+        for game_idx in game_indices:
+            self.start_episode(game_idx)
+
+    def start_episode(self, game_idx: int):
+        self.read_frame(game_idx)
+        self.previous_values[game_idx] = np.nan_to_num(self.frames[game_idx][self.reward_columns])
+        self.last_actions[game_idx] = -1
+        self.episode_steps[game_idx] = 0
+
+    def reset(self):
+        self.reset_games(range(self.game_num))
+        if self.mode == 'snapshot':
+            self.select_opponents(range(self.game_num))
+        observations, opponent_observations = self.get_observations()
+        self.opponent_actions = None if opponent_observations is None else self.act_opponents(opponent_observations)
+        self._reset_seeds()
+        self._reset_options()
+        return observations
+
+    def step_async(self, actions: np.ndarray):
+        actions = np.asarray(actions, dtype=np.int64).reshape(-1)
+        if self.mode == 'mirror':
+            actions = actions.reshape(self.game_num, 2)
+        else:
+            actions = np.stack([actions, self.opponent_actions], axis=1)
+        self.actions = actions
+
+        action_lines = self.action_table.action_lines
+        key_lines = self.action_table.key_lines
+        # every game gets its line before waiting on any of them so the games advance together
+        for game_idx, game in enumerate(self.games):
+            action, opponent_action = actions[game_idx]
+            opponent_line = key_lines[opponent_action] if opponent_action >= 0 else ""
+            game.send_action_line(action_lines[action] + opponent_line)
+
+    def step_wait(self):
+        for game_idx, game in enumerate(self.games):
+            game.wait_for_game_env_update()
+            self.read_frame(game_idx)
+        self.last_actions[:] = self.actions
+        self.episode_steps += 1
+
+        current_values = self.frames[:, self.reward_columns]
+        # a reward feature that did not parse keeps its value of the previous frame
+        current_values = np.where(np.isnan(current_values), self.previous_values, current_values)
+        rewards = np.stack([
+            self.reward_engine.compute(self.previous_values, current_values),
+            # the same terms with the players swapped
+            self.reward_engine.compute(self.previous_values[:, ::-1], current_values[:, ::-1]),
+        ], axis=1)
+        self.previous_values[:] = current_values
+        dones = (current_values[:, :, reward_frame_features.index('current_HP')] <= 0).any(axis=1)
+
+        observations, opponent_observations = self.get_observations()
+        agents_per_game = 2 if self.mode == 'mirror' else 1
+        infos = [{"total_steps": int(self.episode_steps[env_idx // agents_per_game]), "frames": 1,
+                  "skipped_frames": 0, "TimeLimit.truncated": False} for env_idx in range(self.num_envs)]
+        if self.mode == 'snapshot':
+            rewards = rewards[:, :1]
+            for game_idx, name in enumerate(self.opponent_names):
+                infos[game_idx]["opponent"] = name
+
+        done_games = np.flatnonzero(dones)
+        if len(done_games):
+            for game_idx in done_games:
+                for env_idx in range(game_idx * agents_per_game, (game_idx + 1) * agents_per_game):
+                    infos[env_idx]["terminal_observation"] = {key: deepcopy(value[env_idx])
+                                                              for key, value in observations.items()}
+            self.reset_games(done_games)
+            if self.mode == 'snapshot':
+                self.select_opponents(done_games)
+            observations, opponent_observations = self.get_observations()
+        if opponent_observations is not None:
+            self.opponent_actions = self.act_opponents(opponent_observations)
+
+        return (observations, rewards.reshape(-1).astype(np.float32), np.repeat(dones, agents_per_game),
+                infos)
+
+    def get_policy_cache_stats(self) -> dict:
+        return {"hits": self.policy_cache.hits, "misses": self.policy_cache.misses,
+                "cached": len(self.policy_cache.policies), "opponents": len(self.opponent_paths)}
+
+    def close(self):
+        for game in self.games:
+            game.action_event_buffer.close()
+            game.game_env_transport.close()
+
+    def get_attr(self, attr_name: str, indices=None) -> List:
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name: str, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs) -> List:
+        # games are not gym envs, methods of the vec env are answered for every index
+        if method_name == 'get_telemetry':
+            return [None for _ in self._get_indices(indices)]
+        method = getattr(self, method_name)
+        return [method(*method_args, **method_kwargs) for _ in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+        return [False for _ in self._get_indices(indices)]
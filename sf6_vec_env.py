@@ -0,0 +1,107 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Callable, List
+
+import gymnasium as gym
+import numpy as np
+from stable_baselines3.common.monitor import Monitor
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv, VecEnv
+
+
+
+def create_instance_env_paths(base_path: str, env_num: int) -> List[str]:
+    # one buffer directory per game or emulator instance
+    return [os.path.join(base_path, f"env_{i}") for i in range(env_num)]
+
+
+def make_env_fn(env_path: str, env_kwargs: dict, history_path: str = None, monitor: bool = True) -> Callable[[], gym.Env]:
+    def make_env():
+        import sf6_agent_env  # registers SF6AgentEnv in the worker process
+        kwargs = dict(env_kwargs)
+        kwargs['env_path'] = env_path
+        if history_path is not None:
+            kwargs['history_path'] = history_path
+        e = gym.make('SF6AgentEnv', **kwargs)
+        return Monitor(e) if monitor else e
+    return make_env
+
+
+class ThreadedVecEnv(DummyVecEnv):
+    # steps every env of this process on its own thread, the frame waits and encoding of all envs overlap
+    # each other and the caller between step_async and step_wait, envs are reset on their thread when done
+    def __init__(self, env_fns: List[Callable[[], gym.Env]]):
+        super().__init__(env_fns)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_envs, thread_name_prefix="sf6_vec_step")
+        self.pending_steps = None
+
+    def step_env(self, env_idx: int, action):
+        env = self.envs[env_idx]
+        obs, reward, terminated, truncated, info = env.step(action)
+        done = terminated or truncated
+        info["TimeLimit.truncated"] = truncated and not terminated
+        reset_info = None
+        if done:
+            info["terminal_observation"] = obs
+            obs, reset_info = env.reset()
+        return obs, reward, done, info, reset_info
+
+    def step_async(self, actions: np.ndarray) -> None:
+        self.actions = actions
+        self.pending_steps = [self.executor.submit(self.step_env, env_idx, actions[env_idx])
+                              for env_idx in range(self.num_envs)]
+
+    def step_wait(self):
+        for env_idx, pending_step in enumerate(self.pending_steps):
+            obs, self.buf_rews[env_idx], self.buf_dones[env_idx], self.buf_infos[env_idx], reset_info = \
+                pending_step.result()
+            if reset_info is not None:
+                self.reset_infos[env_idx] = reset_info
+            self._save_obs(env_idx, obs)
+        self.pending_steps = None
+        return self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos)
+
+    def reset(self):
+        def reset_env(env_idx):
+            maybe_options = {"options": self._options[env_idx]} if self._options[env_idx] else {}
+            return self.envs[env_idx].reset(seed=self._seeds[env_idx], **maybe_options)
+
+        resets = list(self.executor.map(reset_env, range(self.num_envs)))
+        for env_idx, (obs, self.reset_infos[env_idx]) in enumerate(resets):
+            self._save_obs(env_idx, obs)
+        self._reset_seeds()
+        self._reset_options()
+        return self._obs_from_buf()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        super().close()
+
+
+vec_env_classes = {
+    'subproc': SubprocVecEnv,
+    'threaded': ThreadedVecEnv,
+    'dummy': DummyVecEnv,
+}
+
+
+def make_sf6_vec_env(env_paths: List[str], env_kwargs: dict, history_path: str = 'history', monitor: bool = True,
+                     start_method: str = None, vec_env: str = 'subproc') -> VecEnv:
+    # 'subproc' runs each env in its own process, 'threaded' steps the envs on threads of this process
+    # and 'dummy' steps them one after another, every env uses its own buffer directory
+    env_fns = [
+        make_env_fn(
+            env_path=env_path,
+            env_kwargs=env_kwargs,
+            history_path=os.path.join(history_path, str(i)),
+            monitor=monitor,
+        )
+        for i, env_path in enumerate(env_paths)
+    ]
+    if vec_env not in vec_env_classes:
+        raise ValueError(f"Unknown vec env {vec_env}, expected one of {sorted(vec_env_classes)}.")
+    if vec_env == 'subproc':
+        if len(env_fns) == 1:
+            return DummyVecEnv(env_fns)
+        return SubprocVecEnv(env_fns, start_method=start_method)
+    return vec_env_classes[vec_env](env_fns)
@@ -1,34 +1,93 @@
-import numpy as np
+import hashlib
 import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+# data files are found next to this module so envs can be created from any working directory
+default_data_path = os.environ.get("SF6_DATA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# directory of the compiled action id tables keyed by the hash of their json file, unset disables the cache
+mapping_cache_path = os.environ.get("SF6_MAPPING_CACHE")
+
+# every table is loaded at most once per process, the returned tables are shared and must not be modified
+act_st_cache = {}
+action_id_cache = {}
+feature_mapping_cache = {}
+
+
+def load_act_st(data_path: str = None) -> Dict[str, int]:
+    path = os.path.join(default_data_path if data_path is None else data_path, "act_st.json")
+    if path not in act_st_cache:
+        with open(path) as f:
+            act_st_cache[path] = {key: index for index, key in enumerate(json.load(f))}
+    return act_st_cache[path]
+
+
+def __getattr__(name):
+    # act_st used to be parsed at import time
+    if name == 'act_st':
+        return load_act_st()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def load_action_id_keys(path: str, cache_path: str = None) -> np.ndarray:
+    # action ids of a character file in file order, read from the binary cache when the file is unchanged
+    with open(path, 'rb') as f:
+        content = f.read()
+    if cache_path is None:
+        return np.asarray([int(key) for key in json.loads(content)], dtype=np.int64)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    cached_path = os.path.join(cache_path, f"{name}_{hashlib.sha1(content).hexdigest()[:16]}.npy")
+    if os.path.exists(cached_path):
+        return np.load(cached_path)
+
+    keys = np.asarray([int(key) for key in json.loads(content)], dtype=np.int64)
+    os.makedirs(cache_path, exist_ok=True)
+    temp_path = f"{cached_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.save(f, keys)
+    os.replace(temp_path, cached_path)  # other workers never see a partial file
+    return keys
+
 
-with open("data/act_st.json") as f:
-    act_st_file = json.load(f)
-    act_st = {key: index for index, key in enumerate(act_st_file)}
+def create_action_id_for_characters(character_name: str, data_path: str = None):
+    path = os.path.join(default_data_path if data_path is None else data_path, f"{character_name}.json")
+    if path not in action_id_cache:
+        keys = load_action_id_keys(path, cache_path=mapping_cache_path)
+        action_id_cache[path] = {str(key): index for index, key in enumerate(keys.tolist())}
+    return action_id_cache[path]
 
 
-def create_action_id_for_characters(character_name: str):
-    with open(f"data/{character_name}.json") as file:
-        action_ids = json.load(file)
-        action_id_mapping = {str(int(key)): index for index, key in enumerate(action_ids)}
+def create_feature_mapping_for_character(character_name: str, data_path: str = None):
+    cache_key = (character_name, data_path)
+    if cache_key not in feature_mapping_cache:
+        feature_mapping_cache[cache_key] = {
+            'act_st': (load_act_st(data_path), np.int32),
+            'dir': ({
+                '0': 0,
+                '1': 1,
+            }, np.int32),
+            'current_HP': ([0, 10000], np.int32),
+            'posY': ([0, 3], np.float32),
+            'posX': ([-7.65, 1.38], np.float32),
+            'super': ([0, 30000], np.int32),
+            'drive': ([0, 60000], np.int32),
+            'mActionId': (create_action_id_for_characters(character_name, data_path), np.int32),
+            'mActionFrame': ([0, 335], np.int32)
+        }
 
-    return action_id_mapping
+    # the tables inside are shared between callers
+    return dict(feature_mapping_cache[cache_key])
 
 
-def create_feature_mapping_for_character(character_name: str):
-    feature_mappings = {
-        'act_st': (act_st, np.int32),
-        'dir': ({
-            '0': 0,
-            '1': 1,
-        }, np.int32),
-        'current_HP': ([0, 10000], np.int32),
-        'posY': ([0, 3], np.float32),
-        'posX': ([-7.65, 1.38], np.float32),
-        'super': ([0, 30000], np.int32),
-        'drive': ([0, 60000], np.int32),
-        'mActionId': (create_action_id_for_characters(character_name), np.int32),
-        'mActionFrame': ([0, 335], np.int32)
-    }
+def preload_feature_mappings(character_names: List[str], data_path: str = None) -> Dict[str, dict]:
+    # loads the mappings of every character once, e.g. before forking env workers
+    return {name: create_feature_mapping_for_character(name, data_path) for name in character_names}
 
-    return feature_mappings
 
+def clear_mapping_caches():
+    act_st_cache.clear()
+    action_id_cache.clear()
+    feature_mapping_cache.clear()
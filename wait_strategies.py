@@ -0,0 +1,166 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import numpy as np
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class WaitStrategy:
+    # polls until poll() returns something other than None
+    # wake latency is the time between the frame being written, as reported by frame_time(), and it being returned
+    # without frame_time it is the time between the last empty poll and the poll that found the frame
+    def __init__(self, stats_size: int = 10000):
+        self.wake_latencies = deque(maxlen=stats_size)
+        self.wait_count = 0
+        self.wait_wall_time = 0.0
+        self.wait_cpu_time = 0.0
+
+    def idle(self, attempt: int):
+        pass
+
+    def wait(self, poll: Callable[[], Optional[object]], frame_time: Callable[[], Optional[float]] = None,
+             timeout: float = None):
+        # returns None when nothing was found within timeout seconds
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        last_empty_poll = wall_start
+        attempt = 0
+
+        while True:
+            result = poll()
+            now = time.perf_counter()
+            if result is not None:
+                written_time = frame_time() if frame_time is not None else None
+                if written_time is not None:
+                    self.wake_latencies.append(max(time.time() - written_time, 0.0))
+                else:
+                    self.wake_latencies.append(now - last_empty_poll)
+                self.wait_count += 1
+                self.wait_wall_time += now - wall_start
+                self.wait_cpu_time += time.thread_time() - cpu_start
+                return result
+            if timeout is not None and now - wall_start > timeout:
+                self.wait_wall_time += now - wall_start
+                self.wait_cpu_time += time.thread_time() - cpu_start
+                return None
+            last_empty_poll = now
+            self.idle(attempt)
+            attempt += 1
+
+    def stats(self) -> dict:
+        latencies = np.asarray(self.wake_latencies, dtype=np.float64) * 1e6
+        stats = {
+            "strategy": type(self).__name__,
+            "waits": self.wait_count,
+            "wait_wall_time": self.wait_wall_time,
+            "wait_cpu_time": self.wait_cpu_time,
+            "cpu_fraction": self.wait_cpu_time / self.wait_wall_time if self.wait_wall_time > 0 else 0.0,
+        }
+        if len(latencies) > 0:
+            stats.update({
+                "wake_latency_p50_us": float(np.percentile(latencies, 50)),
+                "wake_latency_p90_us": float(np.percentile(latencies, 90)),
+                "wake_latency_p99_us": float(np.percentile(latencies, 99)),
+                "wake_latency_max_us": float(latencies.max()),
+            })
+        return stats
+
+    def reset_stats(self):
+        self.wake_latencies.clear()
+        self.wait_count = 0
+        self.wait_wall_time = 0.0
+        self.wait_cpu_time = 0.0
+
+    def close(self):
+        pass
+
+
+class SpinWaitStrategy(WaitStrategy):
+    # lowest latency, uses a whole core while waiting
+    pass
+
+
+class SpinYieldWaitStrategy(WaitStrategy):
+    # spins for spin_count polls then yields the cpu between polls
+    def __init__(self, spin_count: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.spin_count = spin_count
+        self.yield_cpu = getattr(os, 'sched_yield', lambda: time.sleep(0))
+
+    def idle(self, attempt: int):
+        if attempt >= self.spin_count:
+            self.yield_cpu()
+
+
+class BackoffSleepWaitStrategy(WaitStrategy):
+    # spins for spin_count polls then sleeps, doubling the sleep up to max_sleep
+    def __init__(self, spin_count: int = 100, min_sleep: float = 50e-6, max_sleep: float = 2e-3, **kwargs):
+        super().__init__(**kwargs)
+        self.spin_count = spin_count
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+
+    def idle(self, attempt: int):
+        if attempt >= self.spin_count:
+            time.sleep(min(self.min_sleep * (2 ** min(attempt - self.spin_count, 16)), self.max_sleep))
+
+
+class InotifyWaitStrategy(WaitStrategy):
+    # blocks on inotify modify events for the watched file, linux only
+    # writes through a mmap do not raise inotify events so the block is bounded by max_block
+    def __init__(self, watch_path: str, max_block: float = 0.005, **kwargs):
+        super().__init__(**kwargs)
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify wait strategy is only available on linux.")
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(watch_path), IN_MODIFY | IN_CLOSE_WRITE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {watch_path}")
+        self.max_block = max_block
+
+    def idle(self, attempt: int):
+        readable, _, _ = select.select([self.fd], [], [], self.max_block)
+        if readable:
+            try:
+                while os.read(self.fd, 4096):  # drain pending events
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+wait_strategies = {
+    'spin': SpinWaitStrategy,
+    'spin_yield': SpinYieldWaitStrategy,
+    'backoff': BackoffSleepWaitStrategy,
+    'inotify': InotifyWaitStrategy,
+}
+
+
+def create_wait_strategy(wait_strategy, watch_path: str = None) -> WaitStrategy:
+    if isinstance(wait_strategy, WaitStrategy):
+        return wait_strategy
+    if wait_strategy not in wait_strategies:
+        raise ValueError(f"Unknown wait strategy {wait_strategy}.")
+    if wait_strategy == 'inotify':
+        return InotifyWaitStrategy(watch_path=watch_path)
+    return wait_strategies[wait_strategy]()